@@ -51,6 +51,7 @@ if "bpy" in locals():
     imp.reload(t_pose)
     imp.reload(simplify)
     imp.reload(load)
+    imp.reload(catalog)
     imp.reload(retarget)
     imp.reload(action)
     imp.reload(loop)
@@ -68,6 +69,7 @@ else:
     from . import t_pose
     from . import simplify
     from . import load
+    from . import catalog
     from . import retarget
     from . import action
     from . import loop
@@ -81,6 +83,7 @@ else:
 
 from .utils import getErrorMessage, setSilentMode
 from .retarget import ensureInited
+from .catalog import scanCatalog, filterCatalog
 
 #----------------------------------------------------------
 #   Initialize
@@ -91,6 +94,7 @@ def register():
     action.initialize()
     edit.initialize()
     load.initialize()
+    catalog.initialize()
     loop.initialize()
     retarget.initialize()
     simplify.initialize()
@@ -105,6 +109,7 @@ def unregister():
     action.uninitialize()
     edit.uninitialize()
     load.uninitialize()
+    catalog.uninitialize()
     loop.uninitialize()
     retarget.uninitialize()
     simplify.uninitialize()
@@ -0,0 +1,262 @@
+# ------------------------------------------------------------------------------
+#   BSD 2-Clause License
+#
+#   Copyright (c) 2019-2020, Thomas Larsson
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this
+#      list of conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#   IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#   DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#   FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#   DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#   SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#   CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#   OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#   OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ------------------------------------------------------------------------------
+
+#
+#   Catalog of bvh libraries.
+#   Only the headers of the bvh files are read, so that a large library
+#   can be browsed and filtered without loading any motion.
+#   The catalog is stored as bvh_catalog.json in the library folder.
+#   Files are listed with their frame count and frame rate, and refer to
+#   a skeleton by topology hash. Skeletons hold the joint names and the
+#   matching known rig. Unchanged files are not scanned again.
+#
+
+import bpy
+import os
+import json
+from bpy.props import *
+from .utils import *
+
+CatalogVersion = 1
+CatalogName = "bvh_catalog.json"
+
+#
+#   loadCatalog(folder):
+#   saveCatalog(catalog, folder):
+#
+
+def getCatalogPath(folder):
+    return os.path.join(folder, CatalogName)
+
+
+def loadCatalog(folder):
+    filepath = getCatalogPath(folder)
+    try:
+        with open(filepath, "r", encoding="utf-8") as fp:
+            catalog = json.load(fp)
+    except (OSError, ValueError):
+        catalog = None
+    if catalog is None or catalog.get("version") != CatalogVersion:
+        catalog = {"version" : CatalogVersion, "files" : {}, "skeletons" : {}}
+    return catalog
+
+
+def saveCatalog(catalog, folder):
+    filepath = getCatalogPath(folder)
+    tmppath = filepath + ".tmp"
+    try:
+        with open(tmppath, "w", encoding="utf-8") as fp:
+            json.dump(catalog, fp, separators=(",", ":"))
+        os.replace(tmppath, filepath)
+    except OSError as err:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise MocapError("Could not save catalog\n%s:\n%s" % (filepath, err))
+
+#
+#   findBvhFiles(folder, recursive):
+#   Paths are relative to folder, with forward slashes.
+#
+
+def findBvhFiles(folder, recursive):
+    relpaths = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            if os.path.splitext(fname)[-1].lower() == ".bvh":
+                relpath = os.path.relpath(os.path.join(dirpath, fname), folder)
+                relpaths.append(relpath.replace(os.sep, "/"))
+        if not recursive:
+            break
+    return relpaths
+
+#
+#   matchKnownRig(joints, scn):
+#
+
+def matchKnownRig(joints, scn):
+    from . import source
+    from .target import matchBoneNames
+    source.ensureSourceInited(scn)
+    for name,info in source._sourceInfos.items():
+        if name != "Automatic" and matchBoneNames(joints, info, scn):
+            return name
+    return "Automatic"
+
+#
+#   scanCatalog(context, folder, recursive=True):
+#   Update the catalog of the bvh files in folder, and save it as
+#   bvh_catalog.json in that folder. Only new and modified files are
+#   scanned, in worker processes.
+#   Returns the catalog, a dict with the keys "files" and "skeletons".
+#   files maps the path of each file, relative to folder, to a dict with
+#   the keys "nFrames", "fps" and "topology", or "error" if the file could
+#   not be read. skeletons maps each topology hash to a dict with the keys
+#   "joints", "parents" and "rig", the matching known rig.
+#
+
+def scanCatalog(context, folder, recursive=True):
+    scn = context.scene
+    folder = os.path.realpath(os.path.expanduser(folder))
+    if not os.path.isdir(folder):
+        raise MocapError("Not a directory:\n%s" % folder)
+    catalog = loadCatalog(folder)
+    oldFiles = catalog["files"]
+    files = {}
+    skeletons = catalog["skeletons"]
+
+    todo = []
+    for relpath in findBvhFiles(folder, recursive):
+        filepath = os.path.join(folder, relpath)
+        entry = oldFiles.get(relpath)
+        if entry:
+            stat = os.stat(filepath)
+            if entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+                files[relpath] = entry
+                continue
+        todo.append(relpath)
+
+    print("Scanning %d of %d bvh files in %s" % (len(todo), len(files)+len(todo), folder))
+    startProgress("Scanning bvh headers")
+    motion = getWorkerModule("motion")
+    argslist = [(os.path.join(folder, relpath),) for relpath in todo]
+    results = iterPoolResults(scn, motion.scanBvhFile, argslist)
+    for n,(relpath,result) in enumerate(zip(todo, results)):
+        if result is None:
+            result = motion.scanBvhFile(os.path.join(folder, relpath))
+        entry = {"mtime" : result["mtime"], "size" : result["size"]}
+        if "error" in result:
+            entry["error"] = result["error"]
+        else:
+            topology = result["topology"]
+            entry["topology"] = topology
+            entry["nFrames"] = result["nFrames"]
+            frameTime = result["frameTime"]
+            entry["fps"] = (round(1.0/frameTime, 3) if frameTime > 0 else 0)
+            if topology not in skeletons:
+                skeletons[topology] = {
+                    "joints" : result["joints"],
+                    "parents" : result["parents"],
+                    "rig" : matchKnownRig(result["joints"], scn),
+                }
+        files[relpath] = entry
+        showProgress(n+1, n+1, len(todo), step=500)
+    endProgress("Scanned %d bvh files" % len(todo))
+
+    used = set([entry.get("topology") for entry in files.values()])
+    catalog["skeletons"] = dict([(key,skel) for key,skel in skeletons.items() if key in used])
+    catalog["files"] = files
+    saveCatalog(catalog, folder)
+    return catalog
+
+#
+#   filterCatalog(catalog, rig=None, minFrames=0, maxFrames=0, fps=0, joint=None):
+#   The sorted relative paths of the files in a catalog returned by
+#   scanCatalog, whose skeleton matches the known rig named rig and has a
+#   joint named joint, with between minFrames and maxFrames frames, recorded
+#   at fps frames per second. Criteria that are None or zero are ignored.
+#
+
+def filterCatalog(catalog, rig=None, minFrames=0, maxFrames=0, fps=0, joint=None):
+    skeletons = catalog["skeletons"]
+    relpaths = []
+    for relpath,entry in catalog["files"].items():
+        if "error" in entry:
+            continue
+        skel = skeletons[entry["topology"]]
+        if rig and skel["rig"] != rig:
+            continue
+        if joint and joint not in skel["joints"]:
+            continue
+        if entry["nFrames"] < minFrames:
+            continue
+        if maxFrames and entry["nFrames"] > maxFrames:
+            continue
+        if fps and abs(entry["fps"] - fps) > 0.01*fps:
+            continue
+        relpaths.append(relpath)
+    relpaths.sort()
+    return relpaths
+
+########################################################################
+#
+#   class MCP_OT_ScanBvhCatalog(BvhOperator):
+#
+
+class MCP_OT_ScanBvhCatalog(BvhOperator):
+    bl_idname = "mcp.scan_bvh_catalog"
+    bl_label = "Scan BVH Library"
+    bl_description = "Catalog the skeletons, frame counts and frame rates of all bvh files in a directory, without loading any motion"
+
+    directory : StringProperty(
+        name = "Directory",
+        subtype = 'DIR_PATH')
+
+    useRecursive : BoolProperty(
+        name = "Include Subdirectories",
+        description = "Also scan bvh files in subdirectories",
+        default = True)
+
+    def draw(self, context):
+        self.layout.prop(self, "useRecursive")
+
+    def run(self, context):
+        catalog = scanCatalog(context, self.directory, self.useRecursive)
+        files = catalog["files"]
+        nErrors = len([entry for entry in files.values() if "error" in entry])
+        rigs = {}
+        for entry in files.values():
+            if "topology" in entry:
+                rig = catalog["skeletons"][entry["topology"]]["rig"]
+                rigs[rig] = rigs.get(rig, 0) + 1
+        msg = ("Cataloged %d bvh files with %d skeletons.\n" % (len(files), len(catalog["skeletons"])) +
+               "".join(["%s: %d files\n" % (rig, count) for rig,count in sorted(rigs.items())]))
+        if nErrors:
+            msg += "%d files could not be read.\n" % nErrors
+        raise MocapMessage(msg + "Saved %s" % getCatalogPath(self.directory))
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+#----------------------------------------------------------
+#   Initialize
+#----------------------------------------------------------
+
+classes = [
+    MCP_OT_ScanBvhCatalog,
+]
+
+def initialize():
+    for cls in classes:
+        bpy.utils.register_class(cls)
+
+
+def uninitialize():
+    for cls in classes:
+        bpy.utils.unregister_class(cls)
@@ -26,7 +26,8 @@
 #   OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ------------------------------------------------------------------------------
 
-import bpy, os, mathutils, math, time
+import bpy, os, mathutils, math, time, hashlib
+import numpy as np
 from bpy_extras.io_utils import ImportHelper
 from math import sin, cos
 from mathutils import *
@@ -36,6 +37,10 @@ from .utils import *
 from .source import Source
 from .target import Target
 from .simplify import TimeScaler
+from collections import OrderedDict
+from .mcp_kernels.motion import parseMotion
+from .mcp_kernels.kinematics import boneRestMatrix
+from .mcp_kernels.decode import decodeMotion, getSceneTimes
 
 class BvhFile:
     filename_ext = ".bvh"
@@ -88,6 +93,7 @@ class CNode:
         self.channels = []
         self.matrix = None
         self.inverse = None
+        self.isJoint = (words[0].upper() in ['ROOT', 'JOINT'])
         return
 
     def __repr__(self):
@@ -133,6 +139,101 @@ class CNode:
         else:
             return eb.head
 
+
+    def buildRest(self, orig, parent):
+        self.head = orig + self.offset
+        if not self.children:
+            return self.head
+
+        zero = (self.offset.length < Epsilon)
+        tails = Vector((0,0,0))
+        for child in self.children:
+            tails += child.buildRest(self.head, self)
+        tail = tails/len(self.children)
+        if (tail-self.head).length == 0:
+            vec = self.head - parent.head
+            tail = self.head + vec*0.1
+        self.matrix = Matrix(boneRestMatrix(self.head, tail))
+        self.inverse = self.matrix.inverted()
+        if zero:
+            return tail
+        else:
+            return self.head
+
+#
+#    packNodes(root):
+#    unpackNodes(struct):
+#    Flatten the CNode tree into arrays for the motion cache, and back.
+#
+
+def packNodes(root):
+    allNodes = []
+    def traverse(node):
+        allNodes.append(node)
+        for child in node.children:
+            traverse(child)
+    traverse(root)
+
+    numbers = dict([(node, n) for n,node in enumerate(allNodes)])
+    parents = [numbers[node.parent] if node.parent else -1 for node in allNodes]
+    chans = []
+    for n,node in enumerate(allNodes):
+        for (mode, indices) in node.channels:
+            for (index, sign) in indices:
+                if mode == Rotation:
+                    index = "XYZ".index(index)
+                chans.append((n, mode, index, sign))
+    return {
+        "names" : np.array([node.name for node in allNodes]),
+        "parents" : np.array(parents, dtype=int),
+        "offsets" : np.array([tuple(node.offset) for node in allNodes]).reshape((-1,3)),
+        "isJoint" : np.array([node.isJoint for node in allNodes], dtype=bool),
+        "channels" : np.array(chans, dtype=int).reshape((-1,4)),
+    }
+
+
+def unpackNodes(struct):
+    allNodes = []
+    for name,parent,offset in zip(struct["names"], struct["parents"], struct["offsets"]):
+        node = CNode(["", str(name)], allNodes[parent] if parent >= 0 else None)
+        node.offset = Vector(offset)
+        allNodes.append(node)
+    for n,mode,index,sign in struct["channels"]:
+        node = allNodes[n]
+        if mode == Rotation:
+            index = "XYZ"[index]
+        else:
+            index = int(index)
+        if not node.channels or node.channels[-1][0] != mode:
+            node.channels.append((mode, []))
+        node.channels[-1][1].append((index, int(sign)))
+    for node,isJoint in zip(allNodes, struct["isJoint"]):
+        node.isJoint = bool(isJoint)
+    nodes = [node for node in allNodes if node.isJoint]
+    return allNodes[0], nodes
+
+#
+#    getMotionCache(scn):
+#
+
+def getMotionCache(scn):
+    from .mcp_kernels.motion import MotionCache
+    if not scn.McpUseBvhCache:
+        return None
+    folder = bpy.path.abspath(scn.McpBvhCacheDir)
+    if not folder:
+        import tempfile
+        folder = os.path.join(tempfile.gettempdir(), "retarget_bvh_cache")
+    return MotionCache(folder, scn.McpBvhCacheSize * 1024 * 1024)
+
+#
+#    getSceneFps(scn):
+#    The true scene frame rate, e.g. 29.97 for NTSC.
+#
+
+def getSceneFps(scn):
+    return scn.render.fps/scn.render.fps_base
+
 #
 #    readBvhFile(context, filepath, scn, scan):
 #    Custom importer
@@ -199,6 +300,16 @@ class BvhLoader(FrameRange):
         description = "Subsample based on difference in frame rates between BVH file and Blender",
         default=True)
 
+    useResample : BoolProperty(
+        name="Resample To Scene Rate",
+        description = "Interpolate the motion at the scene frame rate, instead of keeping every n:th frame",
+        default=True)
+
+    useBulkKeys : BoolProperty(
+        name="Bulk Keyframes",
+        description = "Create each F-curve in one go instead of inserting keyframes frame by frame",
+        default=True)
+
     def draw(self, context):
         FrameRange.draw(self, context)
         self.layout.separator()
@@ -213,36 +324,233 @@ class BvhLoader(FrameRange):
         row.label(text="Z:")
         row.prop(self, "z", expand=True)
         self.layout.separator()
-        self.layout.prop(self, "useDefaultSS")
-        if not self.useDefaultSS:
-            self.layout.prop(self, "ssFactor")
+        self.layout.prop(self, "useResample")
+        if not self.useResample:
+            self.layout.prop(self, "useDefaultSS")
+            if not self.useDefaultSS:
+                self.layout.prop(self, "ssFactor")
+        self.layout.prop(self, "useBulkKeys")
         self.layout.separator()
 
 
-    def readBvhFile(self, context, filepath, scn, scan):
-        frameno = 1
-        euler = Euler((int(self.x)*D, int(self.y)*D, int(self.z)*D))
-        flipMatrix = euler.to_matrix()
-        ssFactor = self.ssFactor
+    def readBvhFile(self, context, filepath, scn, scan, motion=None, pool=None):
+        flipMatrix = self.getFlipMatrix()
 
         fileName = os.path.realpath(os.path.expanduser(filepath))
         (shortName, ext) = os.path.splitext(fileName)
         if ext.lower() != ".bvh":
             raise MocapError("Not a bvh file: " + fileName)
+        if scan:
+            with open(fileName, "r") as fp:
+                root,nodes = self.readHierarchy(fp, flipMatrix)
+            return root
         startProgress( "Loading BVH file "+ fileName )
-
         time1 = time.perf_counter()
-        level = 0
-        nErrors = 0
-        coll = context.scene.collection
-        rig = None
 
-        fp = open(fileName, "r")
-        print( "Reading skeleton" )
-        lineNo = 0
+        root,nodes,motion = self.loadBvhMotion(fileName, filepath, scn, flipMatrix, motion)
+        data = motion["data"]
+        nFrames = int(motion["nFrames"])
+        ssFactor = int(motion["ssFactor"])
+        first = int(motion["first"])
+        times = self.getMotionTimes(motion, scn)
+        nKeys = (len(data) if times is None else len(times))
+
+        entry = None
+        if pool is not None:
+            key = pool.getKey(root, self)
+            entry = pool.find(key)
+        if entry:
+            print("Reusing skeleton %s" % entry.rig.name)
+            rig = entry.rig
+            root.buildRest(Vector((0,0,0)), None)
+            setActiveObject(context, rig)
+            bpy.ops.object.mode_set(mode='POSE')
+            bones = self.getMotionBones(motion, nodes, flipMatrix, scn)
+            self.addFrames(bones, nKeys, rig, entry)
+        else:
+            rig = self.buildBvhRig(context, root)
+            if pool is not None:
+                pool.reserve(key, rig)
+            bpy.ops.object.mode_set(mode='POSE')
+            pbones = rig.pose.bones
+            for pb in pbones:
+                pb.rotation_mode = 'QUATERNION'
+            if self.useBulkKeys or times is not None:
+                bones = self.getMotionBones(motion, nodes, flipMatrix, scn)
+                self.addFrames(bones, nKeys, rig)
+            else:
+                flipInv = flipMatrix.inverted()
+                for n,values in enumerate(data):
+                    self.addFrame(values, n+1, nodes, pbones, flipMatrix, flipInv)
+                    showProgress(n+1, first+n*ssFactor, nFrames, step=200)
+
+        setInterpolation(rig)
+        time2 = time.perf_counter()
+        endProgress("Bvh file %s loaded in %.3f s" % (filepath, time2-time1))
+        if len(data) == 0:
+            print("Warning: No frames in range %d -- %d." % (int(motion["startFrame"]), int(motion["endFrame"])))
+        renameBvhRig(rig, filepath)
+        rig.McpIsSourceRig = True
+        return rig
+
+
+    def getFlipMatrix(self):
+        euler = Euler((int(self.x)*D, int(self.y)*D, int(self.z)*D))
+        return euler.to_matrix()
+
+    #
+    #   loadBvhMotion(fileName, filepath, scn, flipMatrix, motion=None):
+    #   The hierarchy and motion of a bvh file, from a motion already
+    #   parsed by a worker or loaded before, or from the motion cache,
+    #   or parsed here.
+    #
+
+    def loadBvhMotion(self, fileName, filepath, scn, flipMatrix, motion=None):
+        cache = getMotionCache(scn)
+        key = None
+        if cache:
+            key = cache.getKey(fileName, self.getCacheSettings(scn))
+        if motion is None and cache:
+            cached = cache.load(key)
+            if cached:
+                print("Using cached motion")
+                root,nodes = unpackNodes(cached)
+                return root, nodes, cached
+        if motion is None:
+            root,nodes,motion = self.parseBvhFile(fileName, filepath, scn, flipMatrix)
+        else:
+            print("Reading skeleton")
+            with open(fileName, "r") as fp:
+                root,nodes = self.readHierarchy(fp, flipMatrix)
+        if cache and not cache.contains(key):
+            struct = packNodes(root)
+            struct.update([(name, value) for name,value in motion.items() if name != "bones"])
+            cache.save(key, struct)
+        return root, nodes, motion
+
+
+    def getMotionTimes(self, motion, scn):
+        if not self.useResample:
+            return None
+        return getSceneTimes(motion, getSceneFps(scn))
+
+    #
+    #   getMotionBones(motion, nodes, flipMatrix, scn):
+    #   The bone locations and quaternions of a motion, decoded by a
+    #   worker or decoded here. nodes must have their rest matrices.
+    #   Locations are in bvh units.
+    #
+
+    def getMotionBones(self, motion, nodes, flipMatrix, scn):
+        bones = motion.get("bones")
+        if bones is None:
+            plan = getDecodePlan(nodes, flipMatrix, self.scale)
+            bones = decodeMotion(motion, plan, getSceneFps(scn), self.useResample)
+        return bones
+
+
+    #
+    #   openMotionStream(fileName, filepath, root, nodes, flipMatrix, scn, blockSize=1000):
+    #   A MotionStream that decodes the file in blocks, through the motion
+    #   cache if it is enabled. nodes must have their rest matrices.
+    #   Locations are in bvh units.
+    #
+
+    def openMotionStream(self, fileName, filepath, root, nodes, flipMatrix, scn, blockSize=1000):
+        from .mcp_kernels.decode import MotionStream
+        cache = getMotionCache(scn)
+        key = None
+        if cache:
+            key = cache.getKey(fileName, self.getCacheSettings(scn))
+        plan = getDecodePlan(nodes, flipMatrix, self.scale)
+        try:
+            return MotionStream(fileName, plan, self.getMotionSettings(scn), cache, key, packNodes(root), blockSize)
+        except ValueError as err:
+            raise MocapError("Bvh file \n%s\n is corrupt:\n%s" % (filepath, err))
+
+
+    def getCacheSettings(self, scn):
+        return (self.scale, self.x, self.y, self.z,
+                self.useDefaultSS, self.ssFactor, getSceneFps(scn),
+                self.startFrame, self.endFrame, self.useResample)
+
+
+    def getMotionSettings(self, scn):
+        return (getSceneFps(scn), self.useDefaultSS, self.ssFactor,
+                self.startFrame, self.endFrame, self.useResample)
+
+    #
+    #   iterBvhMotions(context, filepaths):
+    #   Parse and decode the motion of all files in worker processes,
+    #   while the main thread builds the rigs and keys. Only the
+    #   hierarchy is read here, for the decode plan. Yields
+    #   (filepath, motion), where motion is None if the file must be
+    #   parsed by readBvhFile. Cached motions are loaded by the workers.
+    #   Only a few files are parsed ahead of the file that is retargeted.
+    #
+
+    def iterBvhMotions(self, context, filepaths):
+        scn = context.scene
+        decode = getWorkerModule("decode")
+        settings = self.getMotionSettings(scn)
+        cache = getMotionCache(scn)
+        flipMatrix = self.getFlipMatrix()
+        argslist = []
+        for filepath in filepaths:
+            fileName = os.path.realpath(os.path.expanduser(filepath))
+            plan = None
+            if self.useBulkKeys or self.useResample:
+                plan = self.readDecodePlan(fileName, flipMatrix)
+            argslist.append((fileName, plan, settings, self.getCachedKey(cache, fileName, scn)))
+        results = iterPoolResults(scn, decode.decodeMotionFile, argslist)
+        try:
+            for filepath in filepaths:
+                yield filepath, next(results)
+        finally:
+            results.close()
+
+
+    def readDecodePlan(self, fileName, flipMatrix):
+        try:
+            with open(fileName, "r") as fp:
+                root,nodes = self.readHierarchy(fp, flipMatrix)
+        except (MocapError, OSError, ValueError, UnicodeDecodeError):
+            return None
+        root.buildRest(Vector((0,0,0)), None)
+        return getDecodePlan(nodes, flipMatrix, self.scale)
+
+
+    def getCachedKey(self, cache, fileName, scn):
+        if cache is None:
+            return None
+        try:
+            key = cache.getKey(fileName, self.getCacheSettings(scn))
+        except OSError:
+            return None
+        if cache.contains(key):
+            return (cache.folder, key)
+        return None
+
+
+    def parseBvhFile(self, fileName, filepath, scn, flipMatrix):
+        with open(fileName, "r") as fp:
+            print( "Reading skeleton" )
+            root,nodes = self.readHierarchy(fp, flipMatrix)
+            print("Reading motion")
+            nChannels = getChannelCount(nodes)
+            try:
+                motion = parseMotion(fp, fileName, nChannels, *self.getMotionSettings(scn))
+            except ValueError as err:
+                raise MocapError("Bvh file \n%s\n is corrupt:\n%s" % (filepath, err))
+        return root, nodes, motion
+
+
+    def readHierarchy(self, fp, flipMatrix):
+        level = 0
+        status = None
+        root = None
         for line in fp:
             words= line.split()
-            lineNo += 1
             if len(words) == 0:
                 continue
             key = words[0].upper()
@@ -252,20 +560,7 @@ class BvhLoader(FrameRange):
             elif key == 'MOTION':
                 if level != 0:
                     raise MocapError("Tokenizer out of kilter %d" % level)
-                if scan:
-                    return root
-                amt = bpy.data.armatures.new("BvhAmt")
-                rig = bpy.data.objects.new("BvhRig", amt)
-                coll.objects.link(rig)
-                setActiveObject(context, rig)
-                updateScene()
-                bpy.ops.object.mode_set(mode='EDIT')
-                bpy.ops.object.mode_set(mode='EDIT')
-                root.build(amt, Vector((0,0,0)), None)
-                #root.display('')
-                bpy.ops.object.mode_set(mode='OBJECT')
-                status = Motion
-                print("Reading motion")
+                break
             elif status == Hierarchy:
                 if key == 'ROOT':
                     node = CNode(words, None)
@@ -302,51 +597,29 @@ class BvhLoader(FrameRange):
                     node = node.parent
                 else:
                     raise MocapError("Did not expect %s" % words[0])
-            elif status == Motion:
-                if key == 'FRAMES:':
-                    nFrames = int(words[1])
-                elif key == 'FRAME' and words[1].upper() == 'TIME:':
-                    frameTime = float(words[2])
-                    frameFactor = int(1.0/(scn.render.fps*frameTime) + 0.49)
-                    if self.useDefaultSS:
-                        ssFactor = frameFactor if frameFactor > 0 else 1
-                    self.startFrame *= ssFactor
-                    self.endFrame *= ssFactor
-                    status = Frames
-                    frame = 0
-                    frameno = 1
-
-                    bpy.ops.object.mode_set(mode='POSE')
-                    pbones = rig.pose.bones
-                    for pb in pbones:
-                        pb.rotation_mode = 'QUATERNION'
-            elif status == Frames:
-                if (frame >= self.startFrame and
-                    frame <= self.endFrame and
-                    frame % ssFactor == 0 and
-                    frame < nFrames):
-                    self.addFrame(words, frameno, nodes, pbones, flipMatrix)
-                    showProgress(frameno, frame, nFrames, step=200)
-                    frameno += 1
-                frame += 1
-
-        fp.close()
-        if not rig:
-            raise MocapError("Bvh file \n%s\n is corrupt: No rig defined" % filepath)
-        setInterpolation(rig)
-        time2 = time.perf_counter()
-        endProgress("Bvh file %s loaded in %.3f s" % (filepath, time2-time1))
-        if frameno == 1:
-            print("Warning: No frames in range %d -- %d." % (self.startFrame, self.endFrame))
-        renameBvhRig(rig, filepath)
-        rig.McpIsSourceRig = True
+        if root is None:
+            raise MocapError("Bvh file \n%s\n is corrupt: No rig defined" % fp.name)
+        return root, nodes
+
+
+    def buildBvhRig(self, context, root):
+        coll = context.scene.collection
+        amt = bpy.data.armatures.new("BvhAmt")
+        rig = bpy.data.objects.new("BvhRig", amt)
+        coll.objects.link(rig)
+        setActiveObject(context, rig)
+        updateScene()
+        bpy.ops.object.mode_set(mode='EDIT')
+        bpy.ops.object.mode_set(mode='EDIT')
+        root.build(amt, Vector((0,0,0)), None)
+        #root.display('')
+        bpy.ops.object.mode_set(mode='OBJECT')
         return rig
 
 
-    def addFrame(self, words, frame, nodes, pbones, flipMatrix):
+    def addFrame(self, values, frame, nodes, pbones, flipMatrix, flipInv):
         m = 0
         first = True
-        flipInv = flipMatrix.inverted()
         for node in nodes:
             bname = node.name
             if bname not in pbones.keys():
@@ -358,7 +631,7 @@ class BvhLoader(FrameRange):
                     if mode == Location:
                         vec = Vector((0,0,0))
                         for (index, sign) in indices:
-                            vec[index] = sign*float(words[m])
+                            vec[index] = sign*values[m]
                             m += 1
                         if first:
                             pb.location = node.inverse @ (self.scale * flipMatrix @ vec) - node.head
@@ -367,12 +640,78 @@ class BvhLoader(FrameRange):
                     elif mode == Rotation:
                         mats = []
                         for (axis, sign) in indices:
-                            angle = sign*float(words[m])*D
+                            angle = sign*values[m]*D
                             mats.append(Matrix.Rotation(angle, 3, axis))
                             m += 1
                         mat = (node.inverse @ flipMatrix) @ mats[0] @ mats[1] @ mats[2] @ (flipInv @ node.matrix)
                         insertRotation(pb, mat, frame)
 
+
+    def addFrames(self, bones, nFrames, rig, entry=None):
+        act = getNewAction(rig)
+        if nFrames == 0:
+            return
+        frames = np.arange(1, nFrames+1)
+        if entry:
+            boneNames = entry.boneNames
+            scale = entry.scale
+        else:
+            boneNames = dict([(bname, bname) for bname in rig.pose.bones.keys()])
+            scale = self.scale
+        for n,(bname, (locs, quats)) in enumerate(bones.items()):
+            if bname not in boneNames.keys():
+                continue
+            bname = boneNames[bname]
+            if locs is not None:
+                setBoneKeys(act, bname, "location", frames, locs*scale)
+            if quats is not None:
+                setBoneKeys(act, bname, "rotation_quaternion", frames, quats)
+            showProgress(n, n, len(bones), step=10)
+
+#
+#    getChannelCount(nodes):
+#    getDecodePlan(nodes, flipMatrix, scale):
+#    The plan for mcp_kernels.decode.decodeChannels, which converts raw
+#    bvh channels to bone locations and quaternions. Only the first
+#    location channel is used, as in addFrame. Node offsets are scaled
+#    by scale, but the decoded locations are in bvh units.
+#
+
+def getChannelCount(nodes):
+    nChannels = 0
+    for node in nodes:
+        for (mode, indices) in node.channels:
+            nChannels += len(indices)
+    return nChannels
+
+
+def getDecodePlan(nodes, flipMatrix, scale):
+    flipInv = flipMatrix.inverted()
+    plan = []
+    m = 0
+    first = True
+    for node in nodes:
+        if node.matrix is None:
+            m += sum([len(indices) for (mode, indices) in node.channels])
+            continue
+        loc = rot = None
+        for (mode, indices) in node.channels:
+            if mode == Location:
+                if first:
+                    columns = np.arange(m, m+len(indices))
+                    axes = np.array([index for (index, sign) in indices])
+                    signs = np.array([sign for (index, sign) in indices], dtype=float)
+                    mat = np.array(node.inverse @ flipMatrix)
+                    loc = (columns, axes, signs, mat, np.array(node.head)/scale)
+                first = False
+            elif mode == Rotation:
+                pre = np.array(node.inverse @ flipMatrix)
+                post = np.array(flipInv @ node.matrix)
+                rot = (m, indices, pre, post)
+            m += len(indices)
+        plan.append((node.name, loc, rot))
+    return plan
+
 #
 #    channelYup(word):
 #    channelZup(word):
@@ -450,6 +789,7 @@ def renameBones(srcRig, context):
 
     srcBones = []
     trgBones = {}
+    boneNames = {}
 
     setActiveObject(context, srcRig)
     bpy.ops.object.mode_set(mode='EDIT')
@@ -479,19 +819,31 @@ def renameBones(srcRig, context):
             eb.name = trgName
             trgBones[trgName] = CEditBone(eb)
             setbones.append((eb, trgName))
+            boneNames[srcName] = trgName
         else:
             eb.name = '_' + srcName
+            boneNames[srcName] = eb.name
 
     for (eb, name) in setbones:
         eb.name = name
     #createExtraBones(ebones, trgBones)
     bpy.ops.object.mode_set(mode='OBJECT')
+    return boneNames
 
 #
 #    renameBvhRig(srcRig, filepath):
 #
 
 def renameBvhRig(srcRig, filepath):
+    name = getBvhRigName(filepath)
+    srcRig.name = name
+    adata = srcRig.animation_data
+    if adata:
+        adata.action.name = name
+    return
+
+
+def getBvhRigName(filepath):
     base = os.path.basename(filepath)
     (filename, ext) = os.path.splitext(base)
     print("File", filename, len(filename))
@@ -507,12 +859,7 @@ def renameBvhRig(srcRig, filepath):
     else:
         name = 'Y_' + filename
     print("Name", name)
-
-    srcRig.name = name
-    adata = srcRig.animation_data
-    if adata:
-        adata.action.name = name
-    return
+    return name
 
 #
 #    deleteSourceRig(context, rig, prefix):
@@ -543,6 +890,91 @@ def deleteObject(context, ob):
     bpy.ops.object.delete(use_global=False)
     del ob
 
+#
+#   class SkeletonPool:
+#   Source rigs that have been built, renamed and rescaled, keyed by
+#   the bvh hierarchy. A bvh file with the same hierarchy as an earlier
+#   file reuses its rig, and only gets a new action.
+#   boneNames maps bvh joint names to the renamed bones, and scale is
+#   the total scale from bvh units to the rescaled rig.
+#
+
+class SkeletonEntry:
+    def __init__(self, rig):
+        self.rig = rig
+        self.boneNames = None
+        self.scale = 1.0
+
+
+class SkeletonPool:
+    def __init__(self):
+        self.entries = {}
+
+
+    def getKey(self, root, loader):
+        sha = hashlib.sha1()
+        sha.update(("%s %s %s\n" % (loader.x, loader.y, loader.z)).encode("utf-8"))
+        self.hashNode(sha, root, loader.scale)
+        return sha.hexdigest()
+
+
+    def hashNode(self, sha, node, scale):
+        offset = tuple([round(x/scale, 4) for x in node.offset])
+        sha.update(("%s %d %s %s\n" % (node.name, len(node.children), node.channels, offset)).encode("utf-8"))
+        for child in node.children:
+            self.hashNode(sha, child, scale)
+
+
+    def find(self, key):
+        entry = self.entries.get(key)
+        if entry and entry.boneNames is not None:
+            return entry
+        return None
+
+
+    def reserve(self, key, rig):
+        self.entries[key] = SkeletonEntry(rig)
+
+
+    def getEntry(self, rig):
+        for entry in self.entries.values():
+            if entry.rig == rig:
+                return entry
+        return None
+
+
+    def finish(self, rig, boneNames, scale):
+        entry = self.getEntry(rig)
+        if entry:
+            entry.boneNames = boneNames
+            entry.scale = scale
+
+
+    def release(self, context, rig):
+        entry = self.getEntry(rig)
+        if entry is None or entry.boneNames is None:
+            self.discard(rig)
+            deleteSourceRig(context, rig, 'Y_')
+            return
+        adata = rig.animation_data
+        if adata and adata.action:
+            act = adata.action
+            adata.action = None
+            if act.users == 0:
+                bpy.data.actions.remove(act)
+
+
+    def discard(self, rig):
+        for key,entry in list(self.entries.items()):
+            if entry.rig == rig:
+                del self.entries[key]
+
+
+    def clear(self, context):
+        for entry in self.entries.values():
+            deleteSourceRig(context, entry.rig, 'Y_')
+        self.entries = {}
+
 #----------------------------------------------------------
 #   Renamer
 #----------------------------------------------------------
@@ -564,15 +996,19 @@ class BvhRenamer(Source, Target):
         self.layout.separator()
 
 
-    def rescaleRig(self, trgRig, srcRig):
-        if not self.useAutoScale:
-            return
+    def getTargetScale(self, trgRig):
         upleg1 = getTrgBone("thigh.L", trgRig, force=True)
         upleg2 = getTrgBone("thigh_twist.L", trgRig)
         if upleg2:
-            trgScale = upleg1.length + upleg2.length
+            return upleg1.length + upleg2.length
         else:
-            trgScale = upleg1.length
+            return upleg1.length
+
+
+    def rescaleRig(self, trgRig, srcRig):
+        if not self.useAutoScale:
+            return
+        trgScale = self.getTargetScale(trgRig)
         srcScale = srcRig.data.bones["thigh.L"].length
         scale = trgScale/srcScale
         print("Rescale %s with factor %f" % (srcRig.name, scale))
@@ -607,20 +1043,31 @@ class BvhRenamer(Source, Target):
         #(srcRig, srcBones, action) =  renameBvhRig(rig, filepath)
         self.findTarget(context, trgRig)
         self.findSource(context, srcRig)
-        renameBones(srcRig, context)
+        boneNames = renameBones(srcRig, context)
         putInTPose(srcRig, scn.McpSourceTPose, context)
         setInterpolation(srcRig)
         self.rescaleRig(trgRig, srcRig)
         srcRig.McpRenamed = True
+        return boneNames
+
+
+    def tposeRenamedBvh(self, context, srcRig):
+        from .t_pose import putInTPose
+        scn = context.scene
+        scn.frame_current = 0
+        setActiveObject(context, srcRig)
+        putInTPose(srcRig, scn.McpSourceTPose, context)
+        setInterpolation(srcRig)
 
 #----------------------------------------------------------
 #   Object Problems
 #----------------------------------------------------------
 
-def checkObjectProblems(context):
+def checkObjectProblems(context, rig=None):
     problems = ""
     epsilon = 1e-2
-    rig = context.object
+    if rig is None:
+        rig = context.object
 
     eu = rig.rotation_euler
     if abs(eu.x) + abs(eu.y) + abs(eu.z) > epsilon:
@@ -652,8 +1099,8 @@ class MCP_OT_LoadBvh(HideOperator, MultiFile, BvhFile, BvhLoader):
         BvhLoader.draw(self, context)
 
     def run(self, context):
-        for filepath in self.getFilePaths():
-            rig = self.readBvhFile(context, filepath, context.scene, False)
+        for filepath,motion in self.iterBvhMotions(context, self.getFilePaths()):
+            rig = self.readBvhFile(context, filepath, context.scene, False, motion)
             bpy.ops.object.mode_set(mode='OBJECT')
             rig.select_set(True)
             context.view_layer.objects.active = rig
@@ -745,6 +1192,29 @@ def initialize():
 
     bpy.types.Object.McpRenamed = BoolProperty(default = False)
 
+    bpy.types.Scene.McpUseBvhCache = BoolProperty(
+        name = "Cache Parsed BVH Files",
+        description = "Store parsed bvh files on disk and reuse them when the same file is loaded again",
+        default = True)
+
+    bpy.types.Scene.McpBvhCacheDir = StringProperty(
+        name = "Cache Directory",
+        description = "Directory for parsed bvh files. Empty means the system temp directory",
+        subtype = 'DIR_PATH',
+        default = "")
+
+    bpy.types.Scene.McpBvhCacheSize = IntProperty(
+        name = "Cache Size (MB)",
+        description = "Least recently used files are deleted when the cache grows larger than this",
+        min = 1,
+        default = 1024)
+
+    bpy.types.Scene.McpWorkerCount = IntProperty(
+        name = "Worker Processes",
+        description = "Number of processes used for parsing several bvh files and retargeting long animations. 0 means one per CPU core, 1 turns parallel processing off",
+        min = 0,
+        default = 0)
+
     for cls in classes:
         bpy.utils.register_class(cls)
 
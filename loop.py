@@ -29,6 +29,7 @@
 
 
 import bpy
+import numpy as np
 from math import pi, sqrt
 from mathutils import *
 
@@ -514,13 +515,13 @@ class MCP_OT_ShiftBoneFCurves(HideOperator, IsArmature):
 
     def run(self, context):
         from .action import getObjectAction
-        from .retarget import getLocks, correctMatrixForLocks
+        from .retarget import getLocks, getRotationLimits
+        from .mcp_kernels.kinematics import correctMatricesForLocks
 
         startProgress("Shift animation")
         scn = context.scene
         rig = context.object
         frames = [scn.frame_current] + getActiveFrames(rig)
-        nFrames = len(frames)
         act = getObjectAction(rig)
         if not act:
             return
@@ -535,16 +536,18 @@ class MCP_OT_ShiftBoneFCurves(HideOperator, IsArmature):
             deltaMat[pb.name] = pb.matrix_basis @ bmat.inverted()
             orders[pb.name], locks[pb.name] = getLocks(pb, context)
 
-        for n,frame in enumerate(frames[1:]):
-            setFrame(scn, frame)
-            showProgress(n, frame, nFrames)
-            for bname,bmats in basemats.items():
-                pb = rig.pose.bones[bname]
-                mat = deltaMat[pb.name] @ bmats[n+1]
-                mat = correctMatrixForLocks(mat, orders[bname], locks[bname], pb, scn.McpUseLimits)
-                if useLoc[bname]:
-                    insertLocation(pb, mat)
-                insertRotation(pb, mat)
+        shifted = np.array(frames[1:], dtype=float)
+        for n,(bname,bmats) in enumerate(basemats.items()):
+            if len(bmats) < 2:
+                continue
+            pb = rig.pose.bones[bname]
+            mats = np.array(deltaMat[pb.name]) @ np.array(bmats[1:])
+            limits = getRotationLimits(pb, scn.McpUseLimits)
+            mats = correctMatricesForLocks(mats, orders[bname], locks[bname], limits)
+            keys = KeyBuffer(pb, len(mats), useLoc[bname])
+            keys.addBlock(mats, shifted)
+            keys.flush(act)
+            showProgress(n, n, len(basemats))
 
         raise MocapMessage("Animation shifted")
 
@@ -0,0 +1,343 @@
+# ------------------------------------------------------------------------------
+#   BSD 2-Clause License
+#
+#   Copyright (c) 2019-2020, Thomas Larsson
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this
+#      list of conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#   IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#   DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#   FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#   DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#   SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#   CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#   OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#   OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ------------------------------------------------------------------------------
+
+#
+#   Keyframe reduction on NumPy arrays.
+#   Points are given as arrays of times and values, sorted by time.
+#   This module must not import bpy or mathutils.
+#
+
+import numpy as np
+from .kinematics import eulersToMatrices
+
+#
+#   simplifyPoints(xs, ys, maxErr, channel=None, order='XYZ'):
+#   Ramer-Douglas-Peucker on one F-curve, breadth first: starting from
+#   the end points, every segment whose largest deviation from the
+#   straight line between its end points exceeds maxErr is split at its
+#   worst point, until no segment is. Segments that do not advance in
+#   time are never split.
+#   ys is an (n,) array of values, or an (n, k) array with all components
+#   of a channel, which then share the kept points. The error is measured
+#   as in getErrors.
+#   Returns a boolean mask of the points to keep.
+#
+
+def simplifyPoints(xs, ys, maxErr, channel=None, order='XYZ'):
+    n = len(xs)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    points = np.arange(n)
+    while True:
+        kept = np.flatnonzero(keep)
+        if len(kept) < 2:
+            return keep
+        seg = np.minimum(np.searchsorted(kept, points, side="right") - 1, len(kept)-2)
+        yi,ok = getLinearValues(xs, ys, kept[seg], kept[seg+1])
+        errs = getErrors(ys, yi, channel, order)
+        errs[~ok] = 0
+        errs[keep] = 0
+        worst = getWorstPoints(errs, kept, seg, maxErr)
+        if len(worst) == 0:
+            return keep
+        keep[worst] = True
+
+#
+#   getLinearValues(xs, ys, n0, n1):
+#   The values on the line between points n0 and n1 of the segment of
+#   every point, and a mask of the segments that advance in time.
+#
+
+def getLinearValues(xs, ys, n0, n1):
+    dx = xs[n1] - xs[n0]
+    ok = (dx > 0)
+    t = (xs - xs[n0]) / np.where(ok, dx, 1)
+    t = t.reshape((-1,) + (1,)*(ys.ndim-1))
+    return ys[n0] + t*(ys[n1] - ys[n0]), ok
+
+#
+#   getErrors(ys, yi, channel, order):
+#   The deviation of the values ys from the interpolated values yi:
+#   Euclidean distance for locations, the angle between the rotations
+#   for quaternions and Euler angles (in radians), and the absolute
+#   difference for single values.
+#
+
+def getErrors(ys, yi, channel, order):
+    if ys.ndim == 1:
+        return np.abs(ys - yi)
+    elif channel == 'rotation_quaternion':
+        norms = np.linalg.norm(ys, axis=1) * np.linalg.norm(yi, axis=1)
+        dots = np.abs(np.sum(ys*yi, axis=1)) / np.where(norms > 0, norms, 1)
+        return 2*np.arccos(np.minimum(dots, 1))
+    elif channel == 'rotation_euler':
+        traces = np.einsum("nij,nij->n", eulersToMatrices(ys, order), eulersToMatrices(yi, order))
+        return np.arccos(np.clip((traces-1)/2, -1, 1))
+    else:
+        return np.linalg.norm(ys - yi, axis=1)
+
+#
+#   getWorstPoints(errs, kept, seg, maxErr):
+#   The first point with the largest error in each segment, for the
+#   segments where that error exceeds maxErr.
+#
+
+def getWorstPoints(errs, kept, seg, maxErr):
+    segMax = np.maximum.reduceat(errs, kept[:-1])
+    cands = np.flatnonzero((errs > maxErr) & (errs == segMax[seg]))
+    segs,first = np.unique(seg[cands], return_index=True)
+    return cands[first]
+
+#
+#   reduceKeys(xs, ys, maxErr, channel=None, order='XYZ', mode='LINEAR'):
+#   simplifyPoints or fitBezierPoints, depending on mode. Returns the
+#   mask of the kept points, and the slopes or None.
+#   reduceKeysList(argslist):
+#   Worker entry point: reduceKeys for a batch of curves.
+#
+
+def reduceKeys(xs, ys, maxErr, channel=None, order='XYZ', mode='LINEAR'):
+    if mode == 'BEZIER':
+        return fitBezierPoints(xs, ys, maxErr, channel, order)
+    else:
+        return simplifyPoints(xs, ys, maxErr, channel, order), None
+
+
+def reduceKeysList(argslist):
+    return [reduceKeys(*args) for args in argslist]
+
+#
+#   class KeyReducer:
+#   Online simplifyPoints, for points that arrive in blocks. The points
+#   after the last final key are simplified again with each new block,
+#   and all kept points but the last one inside them become final keys.
+#   The straight line between two final keys is then within maxErr from
+#   all points between them, so the final keys meet the same error bound
+#   as simplifyPoints, although they need not be the same keys. Only the
+#   final keys and at most maxWindow pending points are stored.
+#
+
+class KeyReducer:
+    def __init__(self, maxErr, channel=None, order='XYZ', maxWindow=1000):
+        self.maxErr = maxErr
+        self.channel = channel
+        self.order = order
+        self.maxWindow = maxWindow
+        self.keyXs = []
+        self.keyYs = []
+        self.xs = None
+        self.ys = None
+
+
+    def add(self, xs, ys):
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        if self.xs is None:
+            self.xs = xs
+            self.ys = ys
+        else:
+            self.xs = np.concatenate((self.xs, xs))
+            self.ys = np.concatenate((self.ys, ys))
+        n = len(self.xs)
+        if n < 3:
+            return
+        kept = np.flatnonzero(simplifyPoints(self.xs, self.ys, self.maxErr, self.channel, self.order))
+        last = kept[-2]
+        if n - last > self.maxWindow:
+            last = n-1
+        if last > 0:
+            final = kept[kept < last]
+            self.keyXs.append(self.xs[final])
+            self.keyYs.append(self.ys[final])
+            self.xs = self.xs[last:]
+            self.ys = self.ys[last:]
+
+
+    def finish(self):
+        if self.xs is not None:
+            final = np.flatnonzero(simplifyPoints(self.xs, self.ys, self.maxErr, self.channel, self.order))
+            self.keyXs.append(self.xs[final])
+            self.keyYs.append(self.ys[final])
+            self.xs = self.ys = None
+        if not self.keyXs:
+            return np.empty(0), np.empty(0)
+        xs = np.concatenate(self.keyXs)
+        ys = np.concatenate(self.keyYs)
+        self.keyXs = [xs]
+        self.keyYs = [ys]
+        return xs, ys
+
+#
+#   fitBezierPoints(xs, ys, maxErr, channel=None, order='XYZ'):
+#   Like simplifyPoints, but the kept points are joined by cubic Bezier
+#   segments instead of straight lines. The handles are a third of the
+#   segment apart in time, so each segment is a cubic Hermite curve.
+#   There is one slope per kept point, shared by the segments on both
+#   sides, so the handles can be aligned, and the slopes are fitted to
+#   all points by least squares.
+#   Returns the mask of the kept points and their slopes, as an (m,) or
+#   (m, k) array for m kept points.
+#
+
+def fitBezierPoints(xs, ys, maxErr, channel=None, order='XYZ'):
+    n = len(xs)
+    values = ys.reshape((n, -1))
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    points = np.arange(n)
+    while True:
+        kept = np.flatnonzero(keep)
+        seg = np.minimum(np.searchsorted(kept, points, side="right") - 1, len(kept)-2)
+        yi,ok,slopes = getHermiteValues(xs, values, kept, seg)
+        errs = getErrors(ys, yi.reshape(ys.shape), channel, order)
+        errs[~ok] = 0
+        errs[keep] = 0
+        worst = getWorstPoints(errs, kept, seg, maxErr)
+        if len(worst) == 0:
+            return keep, slopes.reshape((len(kept),) + ys.shape[1:])
+        keep[worst] = True
+
+#
+#   getHermiteValues(xs, ys, kept, seg):
+#   The values of the Hermite segments between the kept points at all
+#   points, and the slopes at the kept points. The least squares system
+#   for the slopes is tridiagonal, since each point only depends on the
+#   slopes at the ends of its segment. It is damped slightly towards
+#   getChordSlopes, which decides the slopes that no point depends on.
+#
+
+SlopeDamping = 1e-6
+
+def getHermiteValues(xs, ys, kept, seg):
+    nKeys = len(kept)
+    n0 = kept[seg]
+    n1 = kept[seg+1]
+    dx = xs[n1] - xs[n0]
+    ok = (dx > 0)
+    t = (xs - xs[n0]) / np.where(ok, dx, 1)
+    t2 = t*t
+    t3 = t2*t
+    base = (2*t3 - 3*t2 + 1)[:,None]*ys[n0] + (3*t2 - 2*t3)[:,None]*ys[n1]
+    a = (t3 - 2*t2 + t)*dx
+    b = (t3 - t2)*dx
+    res = ys - base
+    diag = np.bincount(seg, a*a, nKeys) + np.bincount(seg+1, b*b, nKeys)
+    off = np.bincount(seg, a*b, nKeys-1)
+    rhs = np.array([np.bincount(seg, a*r, nKeys) + np.bincount(seg+1, b*r, nKeys)
+                    for r in res.T]).T
+    damping = SlopeDamping*max(diag.max(), 1e-30)
+    rhs += damping*getChordSlopes(xs, ys, kept)
+    slopes = solveTridiagonal(diag + damping, off, rhs)
+    yi = base + a[:,None]*slopes[seg] + b[:,None]*slopes[seg+1]
+    return yi, ok, slopes
+
+#
+#   getChordSlopes(xs, ys, kept):
+#   The mean slope of the chords on both sides of each kept point.
+#
+
+def getChordSlopes(xs, ys, kept):
+    dx = xs[kept[1:]] - xs[kept[:-1]]
+    chords = (ys[kept[1:]] - ys[kept[:-1]]) / np.where(dx > 0, dx, 1)[:,None]
+    slopes = np.empty((len(kept),) + ys.shape[1:])
+    slopes[0] = chords[0]
+    slopes[-1] = chords[-1]
+    slopes[1:-1] = (chords[:-1] + chords[1:])/2
+    return slopes
+
+#
+#   solveTridiagonal(diag, off, rhs):
+#   Solve the symmetric tridiagonal system with diagonal diag and off
+#   diagonal off for the columns of rhs, by Gaussian elimination without
+#   pivoting, which is stable since the system is positive definite.
+#   The recurrences run on Python floats, which is much faster than
+#   NumPy for single rows.
+#
+
+def solveTridiagonal(diag, off, rhs):
+    n = len(diag)
+    diag = diag.tolist()
+    off = off.tolist()
+    c = [0.0]*n
+    denoms = [diag[0]]
+    for i in range(1, n):
+        c[i-1] = off[i-1]/denoms[i-1]
+        denoms.append(diag[i] - off[i-1]*c[i-1])
+    result = np.empty(rhs.shape)
+    for col,column in enumerate(rhs.reshape((n, -1)).T.tolist()):
+        d = column[0]/denoms[0]
+        column[0] = d
+        for i in range(1, n):
+            d = column[i] = (column[i] - off[i-1]*d)/denoms[i]
+        for i in range(n-2, -1, -1):
+            d = column[i] = column[i] - c[i]*d
+        result.reshape((n, -1))[:,col] = column
+    return result
+
+#
+#   mergeKeyPoints(points, frames, values, interpolation, handleType):
+#   Insert keys into the keyframe data of an F-curve, as returned by
+#   utils.getFCurvePoints, like keyframe_insert does. Keys at other
+#   frames are kept unchanged. A key that is replaced keeps its
+#   interpolation and handle types, and its handles move with its value.
+#   New keys get interpolation and handleType, with handles at the key,
+#   to be recalculated by FCurve.update.
+#
+
+def mergeKeyPoints(points, frames, values, interpolation, handleType):
+    co = points["co"]
+    n = len(frames)
+    new = {"co" : np.empty((n, 2), dtype=np.float32)}
+    new["co"][:,0] = frames
+    new["co"][:,1] = values
+    new["interpolation"] = np.full(n, interpolation, dtype=np.int32)
+    new["handle_left_type"] = np.full(n, handleType, dtype=np.int32)
+    new["handle_right_type"] = np.full(n, handleType, dtype=np.int32)
+    new["handle_left"] = new["co"].copy()
+    new["handle_right"] = new["co"].copy()
+    if len(co) == 0:
+        return new
+
+    sorter = np.argsort(co[:,0], kind="stable")
+    pos = np.minimum(np.searchsorted(co[sorter,0], new["co"][:,0]), len(co)-1)
+    replaced = (co[sorter[pos],0] == new["co"][:,0])
+    old = sorter[pos[replaced]]
+    for attr in ["interpolation", "handle_left_type", "handle_right_type"]:
+        new[attr][replaced] = points[attr][old]
+    delta = new["co"][replaced] - co[old]
+    for attr in ["handle_left", "handle_right"]:
+        new[attr][replaced] = points[attr][old] + delta
+
+    keep = ~np.isin(co[:,0], new["co"][:,0])
+    merged = {}
+    for attr,value in new.items():
+        merged[attr] = np.concatenate((points[attr][keep], value))
+    order = np.argsort(merged["co"][:,0], kind="stable")
+    return dict([(attr, value[order]) for attr,value in merged.items()])
@@ -0,0 +1,257 @@
+# ------------------------------------------------------------------------------
+#   BSD 2-Clause License
+#
+#   Copyright (c) 2019-2020, Thomas Larsson
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this
+#      list of conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#   IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#   DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#   FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#   DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#   SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#   CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#   OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#   OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ------------------------------------------------------------------------------
+
+#
+#   Decoding of raw bvh channels to bone locations and quaternions.
+#   The decode plan is made from the bvh hierarchy by load.getDecodePlan,
+#   and only holds NumPy arrays, so that the channels of several files
+#   can be parsed and decoded in worker processes.
+#
+
+import numpy as np
+from collections import OrderedDict
+
+from .motion import parseMotionFile, MotionCache, readHeader, getMotionWindow, iterMotionBlocks
+from .kinematics import eulerChannelsToQuaternions
+from .kinematics import getResampleTimes, resampleLocations, resampleQuaternions
+
+#
+#   decodeChannels(data, plan):
+#   plan has one item (bname, loc, rot) for each joint. loc is None or
+#   (columns, axes, signs, mat, head), and rot is None or
+#   (column, indices, pre, post), with pre and post as in
+#   eulerChannelsToQuaternions. Locations are returned in bvh units,
+#   and must be multiplied by the scale of the rig.
+#
+
+def decodeChannels(data, plan):
+    nFrames = len(data)
+    bones = OrderedDict()
+    for bname,loc,rot in plan:
+        locs = quats = None
+        if loc is not None:
+            columns,axes,signs,mat,head = loc
+            vecs = np.zeros((nFrames, 3))
+            vecs[:,axes] = data[:,columns]*signs
+            locs = vecs @ mat.T - head
+        if rot is not None:
+            column,indices,pre,post = rot
+            values = data[:,column:column+len(indices)]
+            quats = eulerChannelsToQuaternions(values, indices, pre, post)
+        bones[bname] = (locs, quats)
+    return bones
+
+#
+#   getSceneTimes(motion, fps):
+#   getKeyTimes(first, nRows, frameTime, fps):
+#   resampleBones(bones, times):
+#   Resample the output of decodeChannels at the scene frame rate.
+#
+
+def getSceneTimes(motion, fps):
+    return getKeyTimes(int(motion["first"]), len(motion["data"]), float(motion["frameTime"]), fps)
+
+
+def getKeyTimes(first, nRows, frameTime, fps):
+    step = 1.0/(fps*frameTime)
+    return getResampleTimes(first, first+nRows-1, step)
+
+
+def resampleBones(bones, times):
+    resampled = OrderedDict()
+    for bname,(locs, quats) in bones.items():
+        if locs is not None:
+            locs = resampleLocations(locs, times)
+        if quats is not None:
+            quats = resampleQuaternions(quats, times)
+        resampled[bname] = (locs, quats)
+    return resampled
+
+#
+#   decodeMotion(motion, plan, fps, useResample):
+#   decodeMotionFile(filepath, plan, settings, cached=None):
+#   settings are the arguments of parseMotionFile after filepath. If
+#   cached is (folder, key), the motion is taken from the motion cache.
+#   The decoded bones are returned in the "bones" item of the motion.
+#   decodeMotionFile is the entry point for worker processes.
+#
+
+def decodeMotion(motion, plan, fps, useResample):
+    bones = decodeChannels(motion["data"], plan)
+    if useResample:
+        bones = resampleBones(bones, getSceneTimes(motion, fps))
+    return bones
+
+
+def decodeMotionFile(filepath, plan, settings, cached=None):
+    motion = None
+    if cached:
+        folder,key = cached
+        motion = MotionCache(folder, 0).load(key)
+    if motion is None:
+        motion = parseMotionFile(filepath, *settings)
+    if plan is not None:
+        fps,useResample = settings[0], settings[-1]
+        motion["bones"] = decodeMotion(motion, plan, fps, useResample)
+    return motion
+
+#
+#   countKeys(bones):
+#   sliceBones(bones, first, last=None):
+#   joinBones(bones1, bones2):
+#   Frame ranges of the output of decodeChannels.
+#
+
+def countKeys(bones):
+    for locs,quats in bones.values():
+        if locs is not None:
+            return len(locs)
+        elif quats is not None:
+            return len(quats)
+    return 0
+
+
+def sliceBones(bones, first, last=None):
+    sliced = OrderedDict()
+    for bname,(locs, quats) in bones.items():
+        if locs is not None:
+            locs = locs[first:last]
+        if quats is not None:
+            quats = quats[first:last]
+        sliced[bname] = (locs, quats)
+    return sliced
+
+
+def joinBones(bones1, bones2):
+    if not bones1:
+        return bones2
+    joined = OrderedDict()
+    for bname,(locs, quats) in bones2.items():
+        locs1,quats1 = bones1[bname]
+        if locs is not None:
+            locs = np.concatenate((locs1, locs))
+        if quats is not None:
+            quats = np.concatenate((quats1, quats))
+        joined[bname] = (locs, quats)
+    return joined
+
+#
+#   iterResampledBlocks(blocks, plan, times):
+#   Decode and resample blocks of consecutive raw frames. times are the
+#   key positions relative to the first frame, as from getKeyTimes.
+#   Each key is interpolated as soon as both of its frames have been
+#   read, so only the last frame of the previous block is kept.
+#   Yields (start, bones), where start is the index of the first key.
+#
+
+def iterResampledBlocks(blocks, plan, times):
+    carry = None
+    base = end = start = 0
+    for data in blocks:
+        bones = decodeChannels(data, plan)
+        if carry is not None:
+            bones = joinBones(carry, bones)
+        end += len(data)
+        stop = int(np.searchsorted(times, end-1, side="right"))
+        if stop > start:
+            yield start, resampleBones(bones, times[start:stop] - base)
+            start = stop
+        carry = sliceBones(bones, -1)
+        base = end-1
+
+#
+#   class MotionStream:
+#   Reads, decodes and resamples a bvh file in blocks of blockSize
+#   frames, so that memory use does not grow with the take length.
+#   The frames are read from the motion cache if cache contains key.
+#   Otherwise they are read with the frame index, and are written to
+#   the cache on the way, together with struct, e.g. the packed nodes.
+#   settings are the arguments of parseMotionFile after filepath.
+#   nKeys is the number of keys that iterBlocks will yield in total.
+#
+
+class MotionStream:
+    def __init__(self, filepath, plan, settings, cache=None, key=None, struct=None, blockSize=1000):
+        self.filepath = filepath
+        self.plan = plan
+        self.cache = cache
+        self.key = key
+        self.blockSize = blockSize
+        fps,useResample = settings[0], settings[-1]
+        with open(filepath, "r") as fp:
+            self.nChannels, nFrames, frameTime = readHeader(fp)
+        self.first,self.last,self.motion = getMotionWindow(nFrames, frameTime, *settings)
+        self.motion.update(struct or {})
+        self.nRows = len(range(self.first, self.last+1, self.motion["ssFactor"]))
+        self.times = None
+        self.nKeys = self.nRows
+        if useResample:
+            self.times = getKeyTimes(self.first, self.nRows, frameTime, fps)
+            self.nKeys = len(self.times)
+
+
+    def iterBlocks(self):
+        rows = self.iterRows()
+        try:
+            if self.times is None:
+                start = 0
+                for data in rows:
+                    yield start, decodeChannels(data, self.plan)
+                    start += len(data)
+            else:
+                yield from iterResampledBlocks(rows, self.plan, self.times)
+        finally:
+            rows.close()
+
+
+    def iterRows(self):
+        cached = None
+        if self.cache and self.key and self.cache.contains(self.key):
+            cached = self.cache.load(self.key, useMmap=True)
+        if cached:
+            data = cached["data"]
+            for start in range(0, len(data), self.blockSize):
+                yield np.array(data[start:start+self.blockSize])
+            return
+        writer = None
+        if self.cache and self.key and self.nRows > 0:
+            writer = self.cache.openWriter(self.key, (self.nRows, self.nChannels))
+        try:
+            nRows = 0
+            for data in iterMotionBlocks(self.filepath, self.nChannels, self.first, self.last, self.motion["ssFactor"], self.blockSize):
+                if writer:
+                    writer.write(data)
+                nRows += len(data)
+                yield data
+            if nRows != self.nRows:
+                raise ValueError("File has fewer than %d frames" % (self.last+1))
+            if writer:
+                writer.finish(self.motion)
+        finally:
+            if writer:
+                writer.close()
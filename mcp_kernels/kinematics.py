@@ -0,0 +1,453 @@
+# ------------------------------------------------------------------------------
+#   BSD 2-Clause License
+#
+#   Copyright (c) 2019-2020, Thomas Larsson
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this
+#      list of conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#   IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#   DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#   FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#   DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#   SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#   CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#   OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#   OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ------------------------------------------------------------------------------
+
+#
+#   Batched rotation math on NumPy arrays.
+#   Conventions follow mathutils: matrices act on column vectors, so an
+#   array of matrices has shape (n, 3, 3) or (n, 4, 4) indexed [frame, row, col],
+#   and quaternions are stored as (w, x, y, z).
+#   This module must not import bpy or mathutils.
+#
+
+import numpy as np
+
+D = np.pi/180
+
+Axes = {'X' : 0, 'Y' : 1, 'Z' : 2}
+
+#
+#   axisRotations(angles, axis):
+#   Same as Matrix.Rotation(angle, 3, axis) for every angle in the array.
+#
+
+def axisRotations(angles, axis):
+    n = len(angles)
+    c = np.cos(angles)
+    s = np.sin(angles)
+    mats = np.zeros((n, 3, 3))
+    i = Axes[axis]
+    j = (i+1) % 3
+    k = (i+2) % 3
+    mats[:,i,i] = 1
+    mats[:,j,j] = c
+    mats[:,j,k] = -s
+    mats[:,k,j] = s
+    mats[:,k,k] = c
+    return mats
+
+#
+#   eulerChannelsToMatrices(values, indices):
+#   values: (n, k) array of bvh rotation channels in degrees.
+#   indices: the (axis, sign) pairs of the channels, as made by channelYup.
+#
+
+def eulerChannelsToMatrices(values, indices):
+    mats = None
+    for k,(axis, sign) in enumerate(indices):
+        rot = axisRotations(sign*D*values[:,k], axis)
+        if mats is None:
+            mats = rot
+        else:
+            mats = mats @ rot
+    return mats
+
+#
+#   matricesToQuaternions(mats):
+#   Same branches as mathutils Matrix.to_quaternion, so that the sign of
+#   the quaternions agrees with keys inserted by insertRotation.
+#
+
+def matricesToQuaternions(mats):
+    m = mats[:,:3,:3]
+    n = len(m)
+    quats = np.empty((n, 4))
+    m00 = m[:,0,0]
+    m11 = m[:,1,1]
+    m22 = m[:,2,2]
+
+    tr = 0.25*(1 + m00 + m11 + m22)
+    case0 = (tr > 1e-4)
+    case1 = ~case0 & (m00 > m11) & (m00 > m22)
+    case2 = ~case0 & ~case1 & (m11 > m22)
+    case3 = ~case0 & ~case1 & ~case2
+
+    if case0.any():
+        c = m[case0]
+        s = np.sqrt(tr[case0])
+        f = 1/(4*s)
+        quats[case0] = np.stack((
+            s,
+            (c[:,2,1] - c[:,1,2])*f,
+            (c[:,0,2] - c[:,2,0])*f,
+            (c[:,1,0] - c[:,0,1])*f), axis=-1)
+    if case1.any():
+        c = m[case1]
+        s = 2*np.sqrt(np.maximum(1 + c[:,0,0] - c[:,1,1] - c[:,2,2], 0))
+        f = 1/s
+        quats[case1] = np.stack((
+            (c[:,2,1] - c[:,1,2])*f,
+            0.25*s,
+            (c[:,0,1] + c[:,1,0])*f,
+            (c[:,0,2] + c[:,2,0])*f), axis=-1)
+    if case2.any():
+        c = m[case2]
+        s = 2*np.sqrt(np.maximum(1 + c[:,1,1] - c[:,0,0] - c[:,2,2], 0))
+        f = 1/s
+        quats[case2] = np.stack((
+            (c[:,0,2] - c[:,2,0])*f,
+            (c[:,0,1] + c[:,1,0])*f,
+            0.25*s,
+            (c[:,1,2] + c[:,2,1])*f), axis=-1)
+    if case3.any():
+        c = m[case3]
+        s = 2*np.sqrt(np.maximum(1 + c[:,2,2] - c[:,0,0] - c[:,1,1], 0))
+        f = 1/s
+        quats[case3] = np.stack((
+            (c[:,1,0] - c[:,0,1])*f,
+            (c[:,0,2] + c[:,2,0])*f,
+            (c[:,1,2] + c[:,2,1])*f,
+            0.25*s), axis=-1)
+
+    quats /= np.linalg.norm(quats, axis=1)[:,None]
+    return quats
+
+#
+#   normalizeMatrices(mats):
+#   The 3x3 parts of (n, 3, 3) or (n, 4, 4) matrices with unit columns,
+#   as mathutils does before converting a matrix to a rotation.
+#
+
+def normalizeMatrices(mats):
+    m = mats[:,:3,:3]
+    norm = np.linalg.norm(m, axis=1)
+    return m/np.where(norm > 0, norm, 1)[:,None,:]
+
+#
+#   matricesToEulers(mats, order):
+#   Same as Matrix.to_euler(order) without a compatible euler: of the two
+#   Euler solutions, the one with the smallest sum of absolute angles.
+#
+
+EulerOrders = {
+    'XYZ' : ((0, 1, 2), False),
+    'XZY' : ((0, 2, 1), True),
+    'YXZ' : ((1, 0, 2), True),
+    'YZX' : ((1, 2, 0), False),
+    'ZXY' : ((2, 0, 1), False),
+    'ZYX' : ((2, 1, 0), True),
+}
+
+def matricesToEulers(mats, order):
+    (i,j,k),parity = EulerOrders[order]
+    m = normalizeMatrices(mats)
+    # Blender indexes mat[col][row]
+    mii = m[:,i,i]
+    mij = m[:,j,i]
+    mik = m[:,k,i]
+    mjk = m[:,k,j]
+    mkk = m[:,k,k]
+    cy = np.hypot(mii, mij)
+    eul1 = np.empty((len(m), 3))
+    eul2 = np.empty((len(m), 3))
+    eul1[:,i] = np.arctan2(mjk, mkk)
+    eul1[:,j] = np.arctan2(-mik, cy)
+    eul1[:,k] = np.arctan2(mij, mii)
+    eul2[:,i] = np.arctan2(-mjk, -mkk)
+    eul2[:,j] = np.arctan2(-mik, -cy)
+    eul2[:,k] = np.arctan2(-mij, -mii)
+    gimbal = (cy <= 16*np.finfo(np.float32).eps)
+    if gimbal.any():
+        eul1[gimbal,i] = np.arctan2(-m[gimbal,j,k], m[gimbal,j,j])
+        eul1[gimbal,j] = np.arctan2(-mik[gimbal], cy[gimbal])
+        eul1[gimbal,k] = 0
+        eul2[gimbal] = eul1[gimbal]
+    if parity:
+        eul1 = -eul1
+        eul2 = -eul2
+    d1 = np.abs(eul1).sum(axis=1)
+    d2 = np.abs(eul2).sum(axis=1)
+    return np.where((d1 > d2)[:,None], eul2, eul1)
+
+#
+#   correctMatricesForLocks(mats, order, locks, limits):
+#   Batched version of correctMatrixForLocks in retarget.py, for an
+#   (n, 4, 4) array. locks and order are as returned by getLocks, and
+#   limits is a list of (uses, mins, maxs) triples with three entries
+#   each, one per active Limit Rotation constraint.
+#
+
+def correctMatricesForLocks(mats, order, locks, limits):
+    rots = mats[:,:3,:3]
+    if locks:
+        eulers = matricesToEulers(rots, order)
+        eulers[:,locks] = 0
+        rots = eulersToMatrices(eulers, order)
+    for uses,mins,maxs in limits:
+        eulers = matricesToEulers(rots, order)
+        for n in range(3):
+            if uses[n]:
+                eulers[:,n] = np.minimum(maxs[n], np.maximum(mins[n], eulers[:,n]))
+        rots = eulersToMatrices(eulers, order)
+    result = np.zeros(mats.shape)
+    result[:,:3,:3] = rots
+    result[:,:,3] = mats[:,:,3]
+    return result
+
+#
+#   retargetMatrices(src, parentTrg, aMat, bMat, locScale, order, locks, limits):
+#   Batched retarget of one bone, as CBoneAnim.retarget in retarget.py.
+#   src are the global source matrices, and parentTrg the global target
+#   matrices of the parent, or None for a root bone. Returns the local
+#   matrices to key and the global target matrices.
+#
+
+def retargetMatrices(src, parentTrg, aMat, bMat, locScale, order, locks, limits):
+    trg = src @ aMat
+    trg[:,:,3] = src[:,:,3]
+    trg[:,:3,3] *= locScale
+    if parentTrg is None:
+        mat1 = trg
+    else:
+        mat1 = np.linalg.inv(parentTrg) @ trg
+    mat3 = correctMatricesForLocks(bMat @ mat1, order, locks, limits)
+    mat1 = np.linalg.inv(bMat) @ mat3
+    if parentTrg is None:
+        trg = mat1
+    else:
+        trg = parentTrg @ mat1
+    return mat3, trg
+
+#
+#   retargetChunk(srcPoses, rigs):
+#   Worker entry point: retarget one block of frames to several targets.
+#   srcPoses maps source bone names to (n, 4, 4) global matrices. Each
+#   rig is a list of bones (srcName, parent, aMat, bMat, locScale, order,
+#   locks, limits), parents first, where parent is the index of the
+#   parent bone in the list, or -1. Returns one list of the matrices to
+#   key per rig.
+#
+
+def retargetChunk(srcPoses, rigs):
+    results = []
+    for bones in rigs:
+        keys = []
+        trgPoses = []
+        for srcName,parent,aMat,bMat,locScale,order,locks,limits in bones:
+            parentTrg = (trgPoses[parent] if parent >= 0 else None)
+            mat3,trg = retargetMatrices(srcPoses[srcName], parentTrg, aMat, bMat, locScale, order, locks, limits)
+            keys.append(mat3)
+            trgPoses.append(trg)
+        results.append(keys)
+    return results
+
+#
+#   matricesToAxisAngles(mats):
+#   Same as Matrix.to_axis_angle, stored as PoseBone.rotation_axis_angle
+#   (angle, x, y, z).
+#
+
+def matricesToAxisAngles(mats):
+    quats = matricesToQuaternions(normalizeMatrices(mats))
+    halfAngles = np.arccos(np.clip(quats[:,0], -1, 1))
+    sines = np.sin(halfAngles)
+    sines = np.where(np.abs(sines) < 0.0005, 1.0, sines)
+    axisAngles = np.empty((len(quats), 4))
+    axisAngles[:,0] = 2*halfAngles
+    axisAngles[:,1:] = quats[:,1:]/sines[:,None]
+    zero = ~axisAngles[:,1:].any(axis=1)
+    axisAngles[zero,2] = 1
+    return axisAngles
+
+#
+#   quaternionsToMatrices(quats):
+#
+
+def quaternionsToMatrices(quats):
+    norm = np.linalg.norm(quats, axis=1)
+    q = np.where((norm > 0)[:,None], quats/np.maximum(norm, 1e-30)[:,None], [1,0,0,0])
+    w,x,y,z = q[:,0], q[:,1], q[:,2], q[:,3]
+    mats = np.empty((len(q), 3, 3))
+    mats[:,0,0] = 1 - 2*(y*y + z*z)
+    mats[:,0,1] = 2*(x*y - w*z)
+    mats[:,0,2] = 2*(x*z + w*y)
+    mats[:,1,0] = 2*(x*y + w*z)
+    mats[:,1,1] = 1 - 2*(x*x + z*z)
+    mats[:,1,2] = 2*(y*z - w*x)
+    mats[:,2,0] = 2*(x*z - w*y)
+    mats[:,2,1] = 2*(y*z + w*x)
+    mats[:,2,2] = 1 - 2*(x*x + y*y)
+    return mats
+
+#
+#   eulersToMatrices(eulers, order):
+#   Same as Euler(euler, order).to_matrix() for an (n, 3) array of
+#   angles in radians. The first axis of order is applied first.
+#
+
+def eulersToMatrices(eulers, order):
+    mats = np.broadcast_to(np.identity(3), (len(eulers), 3, 3))
+    for axis in order:
+        mats = axisRotations(eulers[:,Axes[axis]], axis) @ mats
+    return mats
+
+#
+#   axisAnglesToMatrices(axisAngles):
+#   Rotation matrices of an (n, 4) array of (angle, x, y, z).
+#
+
+def axisAnglesToMatrices(axisAngles):
+    angles = axisAngles[:,0]
+    axes = axisAngles[:,1:]
+    norm = np.linalg.norm(axes, axis=1)
+    axes = np.where((norm > 0)[:,None], axes/np.maximum(norm, 1e-30)[:,None], 0)
+    quats = np.empty((len(angles), 4))
+    quats[:,0] = np.cos(angles/2)
+    quats[:,1:] = axes*np.sin(angles/2)[:,None]
+    return quaternionsToMatrices(quats)
+
+#
+#   composeMatrices(locs, rots, scales):
+#   Same as Matrix.LocRotScale: (n, 4, 4) matrices T @ R @ S from
+#   (n, 3) locations, (n, 3, 3) rotations and (n, 3) scales.
+#
+
+def composeMatrices(locs, rots, scales):
+    mats = np.zeros((len(locs), 4, 4))
+    mats[:,:3,:3] = rots * scales[:,None,:]
+    mats[:,:3,3] = locs
+    mats[:,3,3] = 1
+    return mats
+
+#
+#   eulerChannelsToQuaternions(values, indices, pre, post):
+#   Converts all frames of one bvh joint in one pass:
+#   quat = (pre @ R(channel 0) @ R(channel 1) @ R(channel 2) @ post).to_quaternion()
+#   pre and post are constant 3x3 matrices, e.g. node.inverse @ flipMatrix
+#   and flipMatrix.inverted() @ node.matrix for the bvh importer.
+#
+
+def eulerChannelsToQuaternions(values, indices, pre=None, post=None):
+    mats = eulerChannelsToMatrices(values, indices)
+    if pre is not None:
+        mats = np.asarray(pre) @ mats
+    if post is not None:
+        mats = mats @ np.asarray(post)
+    return matricesToQuaternions(mats)
+
+#
+#   boneRestMatrix(head, tail):
+#   The rotation part of EditBone.matrix for a bone with zero roll,
+#   computed as in Blender's vec_roll_to_mat3, so that bone rest
+#   matrices are available without creating an armature.
+#
+
+def boneRestMatrix(head, tail):
+    vec = np.asarray(tail, dtype=float) - np.asarray(head, dtype=float)
+    x,y,z = vec/np.linalg.norm(vec)
+    theta = 1 + y
+    thetaAlt = x*x + z*z
+    if theta > 6.1e-3 or thetaAlt > 6.25e-8:
+        if theta <= 6.1e-3:
+            theta = thetaAlt*0.5 + thetaAlt*thetaAlt*0.125
+        return np.array((
+            (1 - x*x/theta, x, -x*z/theta),
+            (-x, y, -z),
+            (-x*z/theta, z, 1 - z*z/theta)))
+    else:
+        return np.array(((-1.0, 0, 0), (0, -1, 0), (0, 0, 1)))
+
+#
+#   getResampleTimes(first, last, step):
+#   The positions, in source frames relative to first, of all target
+#   frames that fall inside the source frames first ... last.
+#   step is the number of source frames per target frame. Frame times
+#   in bvh files are rounded, so a step close to an integer ratio is
+#   snapped to it, and the last target frame is rounded rather than
+#   floored. An unchanged frame rate then copies all frames exactly.
+#   The relative tolerance covers frame times written with six
+#   decimals up to 120 fps, but not 29.97 fps against 30 fps.
+#
+
+ResampleTolerance = 5e-5
+
+def getResampleTimes(first, last, step):
+    step = snapResampleStep(step)
+    k0 = int(np.ceil(first/step - ResampleTolerance))
+    k1 = int(np.round(last/step))
+    if k1 < k0:
+        return np.zeros(0)
+    times = np.arange(k0, k1+1)*step - first
+    return np.clip(times, 0, last-first)
+
+
+def snapResampleStep(step):
+    if step >= 1:
+        n = np.round(step)
+        if abs(step - n) < ResampleTolerance*step:
+            return float(n)
+    else:
+        n = np.round(1/step)
+        if abs(1/step - n) < ResampleTolerance/step:
+            return 1/n
+    return step
+
+#
+#   resampleLocations(locs, times):
+#   resampleQuaternions(quats, times):
+#   Sample (n, 3) locations linearly and (n, 4) quaternions with slerp
+#   at fractional frame positions.
+#
+
+def getResampleWeights(n, times):
+    i0 = np.minimum(np.floor(times).astype(int), n-1)
+    i1 = np.minimum(i0+1, n-1)
+    return i0, i1, times-i0
+
+
+def resampleLocations(locs, times):
+    i0,i1,t = getResampleWeights(len(locs), times)
+    t = t[:,None]
+    return locs[i0]*(1-t) + locs[i1]*t
+
+
+def resampleQuaternions(quats, times):
+    i0,i1,t = getResampleWeights(len(quats), times)
+    return slerpQuaternions(quats[i0], quats[i1], t)
+
+
+def slerpQuaternions(q0, q1, t):
+    dot = np.sum(q0*q1, axis=1)
+    q1 = np.where((dot < 0)[:,None], -q1, q1)
+    dot = np.minimum(np.abs(dot), 1.0)
+    theta = np.arccos(dot)
+    sin = np.sin(theta)
+    small = (sin < 1e-6)
+    sin[small] = 1.0
+    w0 = np.where(small, 1-t, np.sin((1-t)*theta)/sin)
+    w1 = np.where(small, t, np.sin(t*theta)/sin)
+    return w0[:,None]*q0 + w1[:,None]*q1
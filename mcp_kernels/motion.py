@@ -0,0 +1,665 @@
+# ------------------------------------------------------------------------------
+#   BSD 2-Clause License
+#
+#   Copyright (c) 2019-2020, Thomas Larsson
+#   All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or without
+#   modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this
+#      list of conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice,
+#      this list of conditions and the following disclaimer in the documentation
+#      and/or other materials provided with the distribution.
+#
+#   THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#   AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#   IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#   DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+#   FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#   DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#   SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+#   CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+#   OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#   OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# ------------------------------------------------------------------------------
+
+#
+#   Bulk reader for the MOTION block of bvh files.
+#   This module must not import bpy or mathutils, so that it can be
+#   run and benchmarked outside Blender.
+#
+
+import os
+import re
+import math
+import mmap
+import time
+import hashlib
+import zipfile
+import warnings
+from collections import deque
+from itertools import islice
+import numpy as np
+
+#
+#   getFrameWindow(nFrames, startFrame, endFrame, ssFactor):
+#   The frames kept by the importer are first, first+ssFactor, ..., last,
+#   i.e. all frames in [startFrame, endFrame] that are multiples of ssFactor.
+#
+
+def getFrameWindow(nFrames, startFrame, endFrame, ssFactor):
+    first = max(startFrame, 0)
+    first = ((first + ssFactor - 1)//ssFactor)*ssFactor
+    last = min(endFrame, nFrames-1)
+    return first, last
+
+#
+#   readMotion(fp, nChannels, first, last, ssFactor):
+#   fp must be positioned at the first frame line, i.e. right after the
+#   Frame Time line. Returns a (nKept, nChannels) float array.
+#
+
+def readMotion(fp, nChannels, first, last, ssFactor):
+    if last < first or nChannels == 0:
+        return np.zeros((0, nChannels))
+    lines = (line for line in fp if not line.isspace())
+    deque(islice(lines, first), maxlen=0)
+    rows = list(islice(lines, last-first+1))
+    data = getFrameArray("".join(rows), len(rows), nChannels, first)
+    return data[::ssFactor]
+
+#
+#   getFrameArray(text, nLines, nChannels, first):
+#   Convert the text of nLines frame lines, starting at frame first, to
+#   an (nLines, nChannels) array. A line with too few or too many values
+#   would shift all frames after it, so ValueError is raised instead.
+#   Depending on the NumPy version, fromstring stops at a word that is
+#   not a number with a warning or with ValueError.
+#
+
+def getFrameArray(text, nLines, nChannels, first):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        try:
+            data = np.fromstring(text, dtype=float, sep=" ")
+        except ValueError:
+            data = None
+    if data is None or len(data) != nLines*nChannels:
+        raise ValueError(getFrameError(text, nChannels, first))
+    return data.reshape((nLines, nChannels))
+
+
+def getFrameError(text, nChannels, first):
+    if isinstance(text, bytes):
+        text = text.decode("latin-1")
+    frame = first
+    for line in text.splitlines():
+        words = line.split()
+        if len(words) == 0:
+            continue
+        if len(words) != nChannels:
+            return "Frame %d has %d values instead of %d" % (frame, len(words), nChannels)
+        try:
+            [float(word) for word in words]
+        except ValueError:
+            return "Frame %d has values that are not numbers" % frame
+        frame += 1
+    return "Frames do not have %d values each" % nChannels
+
+#
+#   class FrameIndex:
+#   Byte offsets of every step:th frame line in a bvh file, so that a frame
+#   range can be read without tokenizing the frames before it.
+#   The index is extended lazily, only as far as the frames asked for,
+#   by scanning for newlines in large binary chunks. Blank lines are not
+#   frames, as in readMotion.
+#
+
+FrameTimeLine = re.compile(rb"^[ \t]*frame[ \t]+time[ \t]*:[^\n]*\n", re.IGNORECASE | re.MULTILINE)
+
+class FrameIndex:
+    def __init__(self, filepath, step=256, chunkSize=1<<24):
+        self.filepath = filepath
+        self.step = step
+        self.chunkSize = chunkSize
+        self.stamp = getFileStamp(filepath)
+        with open(filepath, "rb") as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                match = FrameTimeLine.search(mm)
+                if match is None:
+                    raise ValueError("No Frame Time line found")
+                self.dataStart = match.end()
+                self.fileSize = len(mm)
+            finally:
+                mm.close()
+        self.offsets = []
+        self.scanned = self.dataStart
+        self.nLines = 0
+
+
+    def extend(self, fp, line):
+        while len(self.offsets) <= line//self.step and self.scanned < self.fileSize:
+            fp.seek(self.scanned)
+            buf = np.frombuffer(fp.read(self.chunkSize), dtype=np.uint8)
+            ends = np.flatnonzero(buf == 10)
+            if self.scanned + len(buf) < self.fileSize:
+                if len(ends) == 0:
+                    raise ValueError("Too long frame line")
+                buf = buf[:ends[-1]+1]
+            elif buf[-1] != 10:
+                ends = np.append(ends, len(buf))
+            starts = getLineStarts(buf, ends) + self.scanned
+            lineNos = self.nLines + np.arange(len(starts))
+            self.offsets += list(starts[lineNos % self.step == 0])
+            self.nLines += len(starts)
+            self.scanned += len(buf)
+
+
+    def getOffset(self, fp, mm, line):
+        self.extend(fp, line)
+        block = min(line//self.step, len(self.offsets)-1)
+        if block < 0:
+            return len(mm)
+        pos = self.offsets[block]
+        for n in range(line - block*self.step):
+            pos = getNextLine(mm, pos)
+            if pos >= len(mm):
+                return len(mm)
+        return pos
+
+
+    def readRange(self, nChannels, first, last, ssFactor):
+        if last < first or nChannels == 0:
+            return np.zeros((0, nChannels))
+        with open(self.filepath, "rb") as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = self.getOffset(fp, mm, first)
+                end = self.getOffset(fp, mm, last+1)
+                text = mm[start:end]
+            finally:
+                mm.close()
+        data = getFrameArray(text, countLines(text), nChannels, first)
+        return data[::ssFactor]
+
+#
+#   getLineStarts(buf, ends):
+#   The offsets of the lines in buf that are not blank, where ends are
+#   the offsets of the newlines, or the end of the last line.
+#   countLines(text):
+#   The number of lines in text that are not blank.
+#
+
+Whitespace = np.frombuffer(b" \t\r\n\v\f", dtype=np.uint8)
+
+def getLineStarts(buf, ends):
+    if len(ends) == 0:
+        return np.zeros(0, dtype=int)
+    starts = np.concatenate(([0], ends[:-1]+1))
+    chars = np.concatenate(([0], np.cumsum(~np.isin(buf, Whitespace))))
+    return starts[chars[ends] > chars[starts]]
+
+
+def countLines(text):
+    buf = np.frombuffer(text, dtype=np.uint8)
+    ends = np.flatnonzero(buf == 10)
+    if len(buf) > 0 and buf[-1] != 10:
+        ends = np.append(ends, len(buf))
+    return len(getLineStarts(buf, ends))
+
+
+def getNextLine(mm, pos):
+    while True:
+        pos = mm.find(b"\n", pos)
+        if pos < 0:
+            return len(mm)
+        pos += 1
+        end = mm.find(b"\n", pos)
+        if end < 0:
+            end = len(mm)
+        if mm[pos:end].strip():
+            return pos
+        elif end == len(mm):
+            return end
+
+
+def getFileStamp(filepath):
+    stat = os.stat(filepath)
+    return (stat.st_size, stat.st_mtime)
+
+_frameIndices = {}
+
+def getFrameIndex(filepath):
+    index = _frameIndices.get(filepath)
+    if index is None or index.stamp != getFileStamp(filepath):
+        index = _frameIndices[filepath] = FrameIndex(filepath)
+    return index
+
+#
+#   readMotionRange(filepath, nChannels, first, last, ssFactor):
+#   Like readMotion, but seeks straight to the first frame using the frame index.
+#
+
+def readMotionRange(filepath, nChannels, first, last, ssFactor):
+    index = getFrameIndex(filepath)
+    return index.readRange(nChannels, first, last, ssFactor)
+
+#
+#   iterMotionBlocks(filepath, nChannels, first, last, ssFactor, blockSize=1000):
+#   Generator version of readMotionRange, which yields at most blockSize
+#   kept frames at a time, so memory use does not grow with the take length.
+#
+
+def iterMotionBlocks(filepath, nChannels, first, last, ssFactor, blockSize=1000):
+    index = getFrameIndex(filepath)
+    step = blockSize*ssFactor
+    for start in range(first, last+1, step):
+        data = index.readRange(nChannels, start, min(start+step-1, last), ssFactor)
+        if len(data) == 0:
+            return
+        yield data
+
+#
+#   class MotionCache:
+#   Content-addressed on-disk cache of parsed bvh files. Each entry is a
+#   .npy file with the frame data, which can be memory mapped, and a .npz
+#   file with everything else, which is written last and marks the entry
+#   as complete. The key is a hash of the file bytes and the import settings.
+#   Least recently used entries are deleted when the cache exceeds maxSize bytes.
+#   Keys are remembered for unchanged files, so a file is hashed only once.
+#
+
+_cacheKeys = {}
+
+class MotionCache:
+    version = 3
+
+    def __init__(self, folder, maxSize):
+        self.folder = folder
+        self.maxSize = maxSize
+
+
+    def getKey(self, filepath, settings):
+        stat = os.stat(filepath)
+        fileKey = (filepath, stat.st_mtime_ns, stat.st_size, tuple(settings))
+        key = _cacheKeys.get(fileKey)
+        if key is None:
+            key = _cacheKeys[fileKey] = self.hashFile(filepath, settings)
+        return key
+
+
+    def hashFile(self, filepath, settings):
+        sha = hashlib.sha1()
+        with open(filepath, "rb") as fp:
+            while True:
+                chunk = fp.read(1<<24)
+                if not chunk:
+                    break
+                sha.update(chunk)
+        sha.update(repr((self.version,) + tuple(settings)).encode("utf-8"))
+        return sha.hexdigest()
+
+
+    def getPath(self, key):
+        return os.path.join(self.folder, key + ".npz")
+
+
+    def getDataPath(self, key):
+        return os.path.join(self.folder, key + ".npy")
+
+
+    def contains(self, key):
+        return os.path.exists(self.getPath(key))
+
+
+    def load(self, key, useMmap=False):
+        path = self.getPath(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                struct = dict(npz)
+            mode = ("r" if useMmap else None)
+            struct["data"] = np.load(self.getDataPath(key), mmap_mode=mode, allow_pickle=False)
+        except (OSError, ValueError, zipfile.BadZipFile) as err:
+            print("Removing bad cache file %s: %s" % (path, err))
+            self.remove(key)
+            return None
+        os.utime(path)
+        return struct
+
+
+    def save(self, key, struct):
+        writer = self.openWriter(key, struct["data"].shape)
+        if writer:
+            writer.write(struct["data"])
+            writer.finish(struct)
+
+
+    def openWriter(self, key, shape):
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            return MotionCacheWriter(self, key, shape)
+        except OSError as err:
+            print("Could not write cache file %s: %s" % (self.getDataPath(key), err))
+            return None
+
+
+    def remove(self, key):
+        for path in [self.getPath(key), self.getDataPath(key)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+    def evict(self):
+        entries = {}
+        for fname in os.listdir(self.folder):
+            key,ext = os.path.splitext(fname)
+            if ext in [".npz", ".npy"]:
+                stat = os.stat(os.path.join(self.folder, fname))
+                mtime,size = entries.get(key, (0, 0))
+                if ext == ".npz":
+                    mtime = stat.st_mtime
+                entries[key] = (mtime, size + stat.st_size)
+        entries = sorted([(mtime, size, key) for key,(mtime, size) in entries.items()])
+        size = sum([entry[1] for entry in entries])
+        for mtime,esize,key in entries:
+            if size <= self.maxSize:
+                break
+            self.remove(key)
+            size -= esize
+
+#
+#   class MotionCacheWriter:
+#   Writes the frame data of a cache entry in blocks, so that a streamed
+#   file is cached without holding all frames in memory. The entry is
+#   only added by finish, after exactly shape[0] rows have been written.
+#   close removes the unfinished file.
+#
+
+class MotionCacheWriter:
+    def __init__(self, cache, key, shape):
+        self.cache = cache
+        self.key = key
+        self.shape = tuple(shape)
+        self.count = 0
+        self.tmppath = cache.getDataPath(key) + ".tmp"
+        self.fp = open(self.tmppath, "wb")
+        header = {"descr": np.lib.format.dtype_to_descr(np.dtype(float)), "fortran_order": False, "shape": self.shape}
+        try:
+            np.lib.format.write_array_header_1_0(self.fp, header)
+        except OSError:
+            self.close()
+            raise
+
+
+    def write(self, data):
+        if self.fp is None:
+            return
+        try:
+            self.fp.write(np.ascontiguousarray(data, dtype=float).tobytes())
+            self.count += len(data)
+        except OSError as err:
+            print("Could not write cache file %s: %s" % (self.tmppath, err))
+            self.close()
+
+
+    def finish(self, struct):
+        if self.fp is None:
+            return
+        if self.count != self.shape[0]:
+            self.close()
+            return
+        path = self.cache.getPath(self.key)
+        try:
+            self.fp.close()
+            self.fp = None
+            os.replace(self.tmppath, self.cache.getDataPath(self.key))
+            with open(path + ".tmp", "wb") as fp:
+                np.savez(fp, **dict([(name, value) for name,value in struct.items() if name != "data"]))
+            os.replace(path + ".tmp", path)
+        except OSError as err:
+            print("Could not write cache file %s: %s" % (path, err))
+            self.close()
+            self.cache.remove(self.key)
+            return
+        self.cache.evict()
+
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+        if os.path.exists(self.tmppath):
+            os.remove(self.tmppath)
+
+#
+#   readHeader(fp):
+#   Skip the HIERARCHY block without building nodes.
+#   Returns (nChannels, nFrames, frameTime) with fp positioned at the first frame line.
+#
+
+def readHeader(fp):
+    nChannels = 0
+    nFrames = 0
+    for line in fp:
+        words = line.split()
+        if len(words) == 0:
+            continue
+        key = words[0].upper()
+        if key == 'CHANNELS':
+            nChannels += int(words[1])
+        elif key == 'FRAMES:':
+            nFrames = int(words[1])
+        elif key == 'FRAME' and words[1].upper() == 'TIME:':
+            return nChannels, nFrames, float(words[2])
+    raise ValueError("No MOTION block found")
+
+#
+#   getSubsampleFactor(frameTime, fps, useDefaultSS, ssFactor):
+#   parseMotion(fp, filepath, nChannels, fps, useDefaultSS, ssFactor, startFrame, endFrame, useResample=False):
+#   parseMotionFile(filepath, fps, useDefaultSS, ssFactor, startFrame, endFrame, useResample=False):
+#   getMotionWindow(nFrames, frameTime, fps, useDefaultSS, ssFactor, startFrame, endFrame, useResample=False):
+#   Read the frame info and the motion data. fp must be positioned after
+#   the channels already counted in nChannels. startFrame and endFrame are
+#   given in scene frames and are returned in bvh frames.
+#   With useResample, all frames in the range are kept, and are resampled
+#   to the scene rate after decoding.
+#   parseMotionFile is the entry point for worker processes.
+#   getMotionWindow returns the kept frames first ... last, and the
+#   motion without data.
+#
+
+def getSubsampleFactor(frameTime, fps, useDefaultSS, ssFactor):
+    if useDefaultSS:
+        frameFactor = int(1.0/(fps*frameTime) + 0.49)
+        return frameFactor if frameFactor > 0 else 1
+    return ssFactor
+
+
+def parseMotion(fp, filepath, nChannels, fps, useDefaultSS, ssFactor, startFrame, endFrame, useResample=False):
+    n, nFrames, frameTime = readHeader(fp)
+    nChannels += n
+    first,last,motion = getMotionWindow(nFrames, frameTime, fps, useDefaultSS, ssFactor, startFrame, endFrame, useResample)
+    if first > 0:
+        motion["data"] = readMotionRange(filepath, nChannels, first, last, motion["ssFactor"])
+    else:
+        motion["data"] = readMotion(fp, nChannels, first, last, motion["ssFactor"])
+    return motion
+
+
+def parseMotionFile(filepath, fps, useDefaultSS, ssFactor, startFrame, endFrame, useResample=False):
+    with open(filepath, "r") as fp:
+        return parseMotion(fp, filepath, 0, fps, useDefaultSS, ssFactor, startFrame, endFrame, useResample)
+
+
+def getMotionWindow(nFrames, frameTime, fps, useDefaultSS, ssFactor, startFrame, endFrame, useResample=False):
+    if useResample:
+        rate = 1.0/(fps*frameTime)
+        ssFactor = 1
+        startFrame = int(math.floor(startFrame*rate))
+        endFrame = int(math.ceil(endFrame*rate))
+    else:
+        ssFactor = getSubsampleFactor(frameTime, fps, useDefaultSS, ssFactor)
+        startFrame *= ssFactor
+        endFrame *= ssFactor
+    first,last = getFrameWindow(nFrames, startFrame, endFrame, ssFactor)
+    return first, last, {
+        "nFrames" : nFrames,
+        "ssFactor" : ssFactor,
+        "first" : first,
+        "frameTime" : frameTime,
+        "startFrame" : startFrame,
+        "endFrame" : endFrame,
+    }
+
+#
+#   scanHeader(filepath):
+#   Read the HIERARCHY block and the frame info of a bvh file, without
+#   building nodes or reading any motion. Returns a dict with the joint
+#   names, the parent index of each joint (-1 for the root), the channel
+#   names of each joint, the frame count and the frame time.
+#
+
+def scanHeader(filepath):
+    names = []
+    parents = []
+    channels = []
+    stack = []
+    current = None
+    with open(filepath, "r") as fp:
+        for line in fp:
+            words = line.split()
+            if len(words) == 0:
+                continue
+            key = words[0].upper()
+            if key in ['ROOT', 'JOINT']:
+                parent = stack[-1] if stack else -1
+                if parent is None:
+                    raise ValueError("Joint %s inside End Site" % words[1])
+                current = len(names)
+                names.append(" ".join(words[1:]))
+                parents.append(parent)
+                channels.append([])
+            elif key == 'END':
+                current = None
+            elif key == 'CHANNELS':
+                if stack and stack[-1] is not None:
+                    channels[stack[-1]] += words[2:]
+            elif key == '{':
+                stack.append(current)
+            elif key == '}':
+                if not stack:
+                    raise ValueError("Unbalanced braces")
+                stack.pop()
+            elif key == 'MOTION':
+                break
+        if not names:
+            raise ValueError("No rig defined")
+        nChannels, nFrames, frameTime = readHeader(fp)
+    return {
+        "joints" : names,
+        "parents" : parents,
+        "channels" : channels,
+        "nFrames" : nFrames,
+        "frameTime" : frameTime,
+    }
+
+
+def getTopologyHash(header):
+    sha = hashlib.sha1()
+    for name,parent,chans in zip(header["joints"], header["parents"], header["channels"]):
+        sha.update(("%d %s %s\n" % (parent, name, " ".join(chans))).encode("utf-8"))
+    return sha.hexdigest()
+
+#
+#   scanBvhFile(filepath):
+#   Entry point for catalog worker processes. Like scanHeader, but also
+#   returns the topology hash and the file stamp, and reports errors in
+#   the result instead of raising.
+#
+
+def scanBvhFile(filepath):
+    stat = os.stat(filepath)
+    result = {"mtime" : stat.st_mtime, "size" : stat.st_size}
+    try:
+        header = scanHeader(filepath)
+    except (ValueError, IndexError, UnicodeDecodeError) as err:
+        result["error"] = str(err)
+        return result
+    header["topology"] = getTopologyHash(header)
+    result.update(header)
+    return result
+
+#
+#   readMotionLines(fp, nChannels, first, last, ssFactor):
+#   Reference implementation: the line by line loop used by the importer
+#   before readMotion. Only used for benchmarking and verification.
+#
+
+def readMotionLines(fp, nChannels, first, last, ssFactor):
+    rows = []
+    frame = 0
+    for line in fp:
+        words = line.split()
+        if len(words) == 0:
+            continue
+        if (frame >= first and
+            frame <= last and
+            frame % ssFactor == 0):
+            rows.append([float(words[m]) for m in range(nChannels)])
+        frame += 1
+    return np.array(rows).reshape((len(rows), nChannels))
+
+#
+#   benchmark(filepath, repeat):
+#
+
+def benchmark(filepath, repeat=3):
+    results = {}
+    for reader in [readMotionLines, readMotion]:
+        best = 1e10
+        for n in range(repeat):
+            with open(filepath, "r") as fp:
+                nChannels, nFrames, frameTime = readHeader(fp)
+                time1 = time.perf_counter()
+                data = reader(fp, nChannels, 0, nFrames-1, 1)
+                time2 = time.perf_counter()
+            best = min(best, time2-time1)
+        results[reader.__name__] = data
+        print("%-16s %8d frames %5d channels %8.3f s %12.0f frames/s" %
+              (reader.__name__, len(data), nChannels, best, len(data)/best))
+    if not np.allclose(results["readMotionLines"], results["readMotion"]):
+        print("Warning: readers disagree")
+
+
+def writeTestFile(filepath, nFrames=30000, nJoints=31):
+    rng = np.random.default_rng(0)
+    with open(filepath, "w") as fp:
+        fp.write("HIERARCHY\nROOT Hips\n{\n  OFFSET 0 0 0\n")
+        fp.write("  CHANNELS 6 Xposition Yposition Zposition Zrotation Xrotation Yrotation\n")
+        for n in range(1, nJoints):
+            fp.write("  JOINT J%d\n  {\n    OFFSET 0 1 0\n" % n)
+            fp.write("    CHANNELS 3 Zrotation Xrotation Yrotation\n")
+            fp.write("    End Site\n    {\n      OFFSET 0 1 0\n    }\n  }\n")
+        fp.write("}\nMOTION\nFrames: %d\nFrame Time: 0.008333\n" % nFrames)
+        data = rng.uniform(-180, 180, (nFrames, 3*nJoints+3))
+        np.savetxt(fp, data, fmt="%.6f")
+
+
+if __name__ == "__main__":
+    import sys, tempfile
+    if len(sys.argv) > 1:
+        filepaths = sys.argv[1:]
+    else:
+        filepath = os.path.join(tempfile.gettempdir(), "bvh_benchmark.bvh")
+        if not os.path.exists(filepath):
+            writeTestFile(filepath)
+        filepaths = [filepath]
+    for filepath in filepaths:
+        print(filepath)
+        benchmark(filepath)
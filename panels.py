@@ -53,9 +53,13 @@ class MCP_PT_Main(bpy.types.Panel):
         ob = context.object
         scn = context.scene
         layout.operator("mcp.load_and_retarget")
+        layout.operator("mcp.load_and_retarget_modal")
         layout.separator()
         layout.operator("mcp.load_bvh")
+        layout.operator("mcp.scan_bvh_catalog")
         layout.operator("mcp.retarget_selected_to_active")
+        layout.operator("mcp.retarget_active_to_selected")
+        layout.operator("mcp.update_retarget")
         layout.separator()
         layout.label(text="Debugging")
         layout.operator("mcp.rename_active_to_selected")
@@ -80,6 +84,15 @@ class MCP_PT_Options(bpy.types.Panel):
         self.layout.prop(scn, "McpIncludeFingers")
         self.layout.prop(scn, "McpUseLimits")
         self.layout.prop(scn, "McpClearLocks")
+        self.layout.prop(scn, "McpUseDirectFK")
+        self.layout.prop(scn, "McpUseMappingCache")
+        self.layout.prop(scn, "McpStoreSourceHashes")
+        self.layout.separator()
+        self.layout.prop(scn, "McpUseBvhCache")
+        if scn.McpUseBvhCache:
+            self.layout.prop(scn, "McpBvhCacheDir")
+            self.layout.prop(scn, "McpBvhCacheSize")
+        self.layout.prop(scn, "McpWorkerCount")
 
 ########################################################################
 #
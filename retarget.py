@@ -47,6 +47,10 @@ import bpy
 import mathutils
 import time
 import os
+import hashlib
+import json
+import numpy as np
+from math import pi
 from collections import OrderedDict
 from mathutils import *
 from bpy.props import *
@@ -142,14 +146,195 @@ class MCP_OT_LimbsBendPositive(HidePropsOperator, IsArmature, Bender, FrameRange
         rig.data.layers = layers
         return HidePropsOperator.sequel(self, context, data)
 
+#-------------------------------------------------------------
+#   Direct forward kinematics
+#
+#   The global matrices of the source bones, computed from the F-curves
+#   of the source action and the rest matrices, for a block of frames:
+#   M_b = M_p R_p^-1 R_b L_b
+#   This replaces scene.frame_set and reading PoseBone.matrix for every
+#   frame. Only rigs where this formula holds can be used. Connected
+#   bones ignore the pose location, so L_b has no translation for them.
+#   Muted F-curves are not evaluated by Blender, so the current pose
+#   value is used for their channels.
+#-------------------------------------------------------------
+
+def getDirectFKProblem(rig):
+    adata = rig.animation_data
+    if adata is None or adata.action is None:
+        return "has no action"
+    elif adata.drivers:
+        return "has drivers"
+    elif adata.use_tweak_mode or (adata.use_nla and hasNlaStrips(adata)):
+        return "has NLA strips"
+    for pb in rig.pose.bones:
+        bone = pb.bone
+        if (not bone.use_inherit_rotation or
+            not bone.use_local_location or
+            getattr(bone, "inherit_scale", 'FULL') != 'FULL'):
+            return "has bones that do not inherit the parent transform"
+        for cns in pb.constraints:
+            if not cns.mute and cns.influence > 0:
+                return "has constraints"
+    return None
+
+
+def hasNlaStrips(adata):
+    for track in adata.nla_tracks:
+        if not track.mute and len(track.strips) > 0:
+            return True
+    return False
+
+
+class CSourceFK:
+
+    def __init__(self, rig):
+        self.rig = rig
+        self.bones = []
+        self.getBones(rig.pose.bones, None)
+        self.fcurves = {}
+        for fcu in rig.animation_data.action.fcurves:
+            if not fcu.mute:
+                self.fcurves[fcu.data_path, fcu.array_index] = fcu
+
+
+    def getBones(self, pbones, parent):
+        for pb in pbones:
+            if pb.parent == parent:
+                self.bones.append(pb)
+                self.getBones(pb.children, pb)
+
+
+    def getChannel(self, pb, channel, frames):
+        path = 'pose.bones["%s"].%s' % (pb.name, channel)
+        default = getattr(pb, channel)
+        values = np.empty((len(frames), len(default)))
+        for index,value in enumerate(default):
+            fcu = self.fcurves.get((path, index))
+            if fcu:
+                values[:,index] = getFCurveValues(fcu, frames)
+            else:
+                values[:,index] = value
+        return values
+
+
+    def getBasisMatrices(self, pb, frames):
+        from .mcp_kernels.kinematics import quaternionsToMatrices, eulersToMatrices, axisAnglesToMatrices, composeMatrices
+        if pb.bone.use_connect:
+            locs = np.zeros((len(frames), 3))
+        else:
+            locs = self.getChannel(pb, "location", frames)
+        scales = self.getChannel(pb, "scale", frames)
+        if pb.rotation_mode == 'QUATERNION':
+            rots = quaternionsToMatrices(self.getChannel(pb, "rotation_quaternion", frames))
+        elif pb.rotation_mode == 'AXIS_ANGLE':
+            rots = axisAnglesToMatrices(self.getChannel(pb, "rotation_axis_angle", frames))
+        else:
+            rots = eulersToMatrices(self.getChannel(pb, "rotation_euler", frames), pb.rotation_mode)
+        return composeMatrices(locs, rots, scales)
+
+
+    def getMatrices(self, frames):
+        frames = np.array(frames, dtype=float)
+        mats = {}
+        for pb in self.bones:
+            rest = np.array(pb.bone.matrix_local)
+            if pb.parent:
+                rest = np.array(pb.parent.bone.matrix_local.inverted()) @ rest
+                mats[pb.name] = mats[pb.parent.name] @ rest @ self.getBasisMatrices(pb, frames)
+            else:
+                mats[pb.name] = rest @ self.getBasisMatrices(pb, frames)
+        return mats
+
+
+#
+#   class CMotionFK:
+#   The same FK, but from decoded bvh channels instead of F-curves, so
+#   that a bvh file can be retargeted without keying a source rig.
+#   blocks yields (start, motion), where motion maps source bone names
+#   to (locations, quaternions) arrays, and index n is frame start+n+1.
+#   Blocks are read as the frames are asked for, and frames before the
+#   first frame asked for are dropped, so frames must be asked for in
+#   increasing order. Frame 0 is the T-pose, as keyed on a source rig:
+#   tpose maps bone names to basis matrices, whose rotations are used,
+#   and the locations are those of frame 1.
+#
+
+class CMotionFK(CSourceFK):
+
+    def __init__(self, rig, blocks, tpose=None):
+        self.rig = rig
+        self.bones = []
+        self.getBones(rig.pose.bones, None)
+        self.blocks = blocks
+        self.motion = {}
+        self.start = 0
+        self.count = 0
+        self.tpose = {}
+        for bname,mat in (tpose or {}).items():
+            self.tpose[bname] = np.array(mat.to_quaternion().to_matrix())
+
+
+    def getMatrices(self, frames):
+        index = np.maximum(np.array(frames, dtype=int) - 1, 0)
+        self.readBlocks(index.min(), index.max())
+        return CSourceFK.getMatrices(self, frames)
+
+
+    def readBlocks(self, first, last):
+        from .mcp_kernels.decode import sliceBones, joinBones, countKeys
+        if first < self.start:
+            raise MocapError("Frame %d has already been dropped" % (first+1))
+        self.motion = sliceBones(self.motion, first-self.start)
+        self.count -= min(first-self.start, self.count)
+        self.start = first
+        while self.start + self.count <= last:
+            try:
+                start,motion = next(self.blocks)
+            except StopIteration:
+                raise MocapError("Bvh file ends before frame %d" % (last+1))
+            except ValueError as err:
+                raise MocapError("Bvh file is corrupt:\n%s" % err)
+            if start != self.start + self.count:
+                raise MocapError("Frame %d was expected, but %d was read" % (self.start+self.count+1, start+1))
+            self.motion = joinBones(self.motion, motion)
+            self.count += countKeys(motion)
+
+
+    def getBasisMatrices(self, pb, frames):
+        from .mcp_kernels.kinematics import quaternionsToMatrices, composeMatrices
+        n = len(frames)
+        index = np.maximum(frames.astype(int) - 1, 0) - self.start
+        locs,quats = self.motion.get(pb.name, (None, None))
+        if locs is None or pb.bone.use_connect:
+            locs = np.zeros((n,3))
+        else:
+            locs = locs[index]
+        if quats is None:
+            rots = np.tile(np.identity(3), (n,1,1))
+        else:
+            rots = quaternionsToMatrices(quats[index])
+        rots[frames == 0] = self.tpose.get(pb.name, np.identity(3))
+        return composeMatrices(locs, rots, np.ones((n,3)))
+
 
 class CAnimation:
 
-    def __init__(self, srcRig, trgRig, info, context):
+    def __init__(self, srcRig, trgRig, info, context, locScale=1.0, srcFK=None):
         self.srcRig = srcRig
         self.trgRig = trgRig
         self.scene = context.scene
         self.boneAnims = OrderedDict()
+        self.locScale = locScale
+        self.keyErrors = None
+        self.oldAction = None
+        self.srcFK = srcFK
+        if srcFK is None and context.scene.McpUseDirectFK:
+            problem = getDirectFKProblem(srcRig)
+            if problem is None:
+                self.srcFK = CSourceFK(srcRig)
+            else:
+                print("%s %s. Using scene evaluation" % (srcRig.name, problem))
 
         scn = context.scene
         for (trgName, srcName) in info.bones:
@@ -185,6 +370,11 @@ class CAnimation:
             banim.printResult(frame)
 
 
+    def setTPoseMatrices(self, mapping):
+        for trgName,banim in self.boneAnims.items():
+            banim.aMatrix = mapping.aMatrices[trgName].copy()
+
+
     def putInTPoses(self, context):
         from .t_pose import putInTPose, putInRestPose
         scn = context.scene
@@ -197,31 +387,188 @@ class CAnimation:
             banim.getTPoseMatrix()
 
 
-    def retarget(self, frames, context, offset, nFrames):
-        objects = hideObjects(context, self.srcRig)
-        scn = context.scene
-        try:
-            for n,frame in enumerate(frames):
+    def initKeyBuffers(self, nFrames):
+        for banim in self.boneAnims.values():
+            useLocation = (banim.parent is None)
+            if self.keyErrors:
+                maxErrLoc,maxErrRot = self.keyErrors
+                banim.keys = ReducedKeyBuffer(banim.trgBone, useLocation, maxErrLoc, maxErrRot)
+            else:
+                banim.keys = KeyBuffer(banim.trgBone, nFrames, useLocation)
+
+
+    def rollback(self):
+        adata = self.trgRig.animation_data
+        if adata is None:
+            return
+        act = adata.action
+        adata.action = self.oldAction
+        if act and act != self.oldAction and act.users == 0:
+            bpy.data.actions.remove(act)
+
+
+    def flushKeyBuffers(self):
+        adata = self.trgRig.animation_data
+        if adata and adata.action:
+            act = adata.action
+        else:
+            act = getNewAction(self.trgRig)
+        for banim in self.boneAnims.values():
+            banim.keys.flush(act)
+
+
+    def canRetargetBlock(self):
+        for banim in self.boneAnims.values():
+            if banim.keys is None:
+                return False
+        return True
+
+
+    def setSourcePoses(self, mats):
+        for banim in self.boneAnims.values():
+            banim.srcPoses = mats[banim.srcBone.name]
+
+
+    def retargetBlock(self, frames):
+        for banim in self.boneAnims.values():
+            banim.retargetBlock(frames)
+
+
+    def retargetFrame(self, frame, n):
+        for banim in self.boneAnims.values():
+            banim.retarget(frame, n)
+
+
+    def getWorkerBones(self):
+        names = list(self.boneAnims.keys())
+        bones = []
+        for banim in self.boneAnims.values():
+            parent = (names.index(banim.parent.trgBone.name) if banim.parent else -1)
+            bones.append((banim.srcBone.name, parent,
+                np.array(banim.aMatrix), np.array(banim.bMatrix), banim.locScale,
+                banim.order, banim.locks, banim.limits))
+        return bones
+
+
+    def addKeyBlock(self, keys, frames):
+        for banim,mats in zip(self.boneAnims.values(), keys):
+            banim.keys.addBlock(mats, frames)
+
+#
+#   retargetFrames(anims, frames, context, offset, nFrames, mats=None):
+#   Retarget a block of frames to all animations, which share the same
+#   source rig. The source pose is only evaluated once per frame.
+#   mats are the source poses of the frames, if they are already known.
+#
+
+def retargetFrames(anims, frames, context, offset, nFrames, mats=None):
+    srcFK = anims[0].srcFK
+    if srcFK:
+        if mats is None:
+            mats = srcFK.getMatrices(frames)
+        for anim in anims:
+            anim.setSourcePoses(mats)
+        if all([anim.canRetargetBlock() for anim in anims]):
+            for anim in anims:
+                anim.retargetBlock(frames)
+            showProgress(offset+len(frames)-1, frames[-1], nFrames, step=1)
+            return
+    objects = hideObjects(context, anims[0].srcRig)
+    scn = context.scene
+    try:
+        for n,frame in enumerate(frames):
+            if not srcFK:
                 setFrame(scn, frame)
-                showProgress(n+offset, frames[n], nFrames)
-                for banim in self.boneAnims.values():
-                    banim.retarget(frame)
-        finally:
-            unhideObjects(objects)
+            showProgress(n+offset, frames[n], nFrames)
+            for anim in anims:
+                anim.retargetFrame(frame, n)
+    finally:
+        unhideObjects(objects)
+
+ParallelChunkSize = 1000
+
+#
+#   iterRetargetFrames(anims, frames, context):
+#   Retarget all frames, and yield after each block of frames.
+#
+
+def iterRetargetFrames(anims, frames, context):
+    nFrames = len(frames)
+    if canRetargetParallel(anims, nFrames, context.scene):
+        yield from iterRetargetFramesParallel(anims, frames, context)
+    else:
+        index = 0
+        while index < nFrames:
+            retargetFrames(anims, frames[index:index+100], context, index, nFrames)
+            index += 100
+            yield
+
+
+def canRetargetParallel(anims, nFrames, scn):
+    return (nFrames >= 2*ParallelChunkSize and
+            getWorkerCount(scn) > 1 and
+            anims[0].srcFK is not None and
+            all([anim.canRetargetBlock() for anim in anims]))
+
+#
+#   iterRetargetFramesParallel(anims, frames, context):
+#   Retarget long animations in worker processes. The source FK is
+#   computed here, one chunk at a time, and the retarget math is done
+#   by kinematics.retargetChunk. Each chunk is submitted as soon as its
+#   source FK is done, so the FK of later chunks overlaps the workers,
+#   and iterPoolResults bounds the number of chunks in flight. Chunks
+#   where a worker failed are retargeted here, from the source poses
+#   that were sent, since a streamed source cannot go back. The pool is
+#   shared, so a batch of files does not start new workers per file.
+#
+
+def iterRetargetFramesParallel(anims, frames, context):
+    scn = context.scene
+    kinematics = getWorkerModule("kinematics")
+    nFrames = len(frames)
+    srcFK = anims[0].srcFK
+    rigs = [anim.getWorkerBones() for anim in anims]
+    srcNames = set([bone[0] for bones in rigs for bone in bones])
+    offsets = list(range(0, nFrames, ParallelChunkSize))
+    pending = {}
+
+    def iterArgs():
+        for offset in offsets:
+            mats = srcFK.getMatrices(frames[offset:offset+ParallelChunkSize])
+            srcPoses = pending[offset] = dict([(name,mats[name]) for name in srcNames])
+            yield (srcPoses, rigs)
+
+    results = iterPoolResults(scn, kinematics.retargetChunk, iterArgs(), len(offsets), shared=True)
+    try:
+        for offset,result in zip(offsets, results):
+            chunk = frames[offset:offset+ParallelChunkSize]
+            srcPoses = pending.pop(offset)
+            if result is None:
+                retargetFrames(anims, chunk, context, offset, nFrames, srcPoses)
+            else:
+                for anim,keys in zip(anims, result):
+                    anim.addKeyBlock(keys, chunk)
+                showProgress(offset+len(chunk)-1, chunk[-1], nFrames, step=1)
+            yield
+    finally:
+        results.close()
 
 
 class CBoneAnim:
 
     def __init__(self, srcBone, trgBone, parent, anim, context):
         self.name = srcBone.name
-        self.srcMatrices = {}
-        self.trgMatrices = {}
         self.srcMatrix = None
         self.trgMatrix = None
+        self.srcPoses = None
+        self.trgPoses = None
+        self.keys = None
         self.srcBone = srcBone
         self.trgBone = trgBone
         self.parent = parent
         self.order,self.locks = getLocks(trgBone, context)
+        self.limits = getRotationLimits(trgBone, anim.scene.McpUseLimits)
+        self.locScale = anim.locScale
         self.aMatrix = None
         if self.parent:
             self.bMatrix = trgBone.bone.matrix_local.inverted() @ self.parent.trgBone.bone.matrix_local
@@ -249,6 +596,9 @@ class CBoneAnim:
 
 
     def insertKeyFrame(self, mat, frame):
+        if self.keys:
+            self.keys.add(mat, frame)
+            return
         pb = self.trgBone
         insertRotation(pb, mat, frame)
         if not self.parent:
@@ -263,10 +613,27 @@ class CBoneAnim:
         self.aMatrix = srcmat.inverted() @ trgmat
 
 
-    def retarget(self, frame):
-        self.srcMatrix = self.srcBone.matrix.copy()
+    def retargetBlock(self, frames):
+        from .mcp_kernels.kinematics import retargetMatrices
+        src = self.srcPoses
+        parentTrg = (self.parent.trgPoses if self.parent else None)
+        mat3,self.trgPoses = retargetMatrices(
+            src, parentTrg, np.array(self.aMatrix), np.array(self.bMatrix),
+            self.locScale, self.order, self.locks, self.limits)
+        self.keys.addBlock(mat3, frames)
+        self.srcMatrix = Matrix(src[-1])
+        self.trgMatrix = Matrix(self.trgPoses[-1])
+
+
+    def retarget(self, frame, n=None):
+        if self.srcPoses is None:
+            self.srcMatrix = self.srcBone.matrix.copy()
+        else:
+            self.srcMatrix = Matrix(self.srcPoses[n])
         self.trgMatrix = self.srcMatrix @ self.aMatrix
         self.trgMatrix.col[3] = self.srcMatrix.col[3]
+        if self.locScale != 1:
+            self.trgMatrix.translation = self.locScale * self.srcMatrix.to_translation()
         if self.parent:
             mat1 = self.parent.trgMatrix.inverted() @ self.trgMatrix
         else:
@@ -275,13 +642,11 @@ class CBoneAnim:
         mat3 = correctMatrixForLocks(mat2, self.order, self.locks, self.trgBone, self.useLimits)
         self.insertKeyFrame(mat3, frame)
 
-        self.srcMatrices[frame] = self.srcMatrix
         mat1 = self.bMatrix.inverted() @ mat3
         if self.parent:
             self.trgMatrix = self.parent.trgMatrix @ mat1
         else:
             self.trgMatrix = mat1
-        self.trgMatrices[frame] = self.trgMatrix
 
         return
 
@@ -331,6 +696,28 @@ def getLocks(pb, context):
     return order,locks
 
 
+#
+#   getRotationLimits(pb, useLimits):
+#   Snapshot of the Limit Rotation constraints that correctMatrixForLocks
+#   applies, as (uses, mins, maxs) triples for correctMatricesForLocks.
+#
+
+def getRotationLimits(pb, useLimits):
+    limits = []
+    if not useLimits:
+        return limits
+    for cns in pb.constraints:
+        if (cns.type == 'LIMIT_ROTATION' and
+            cns.owner_space == 'LOCAL' and
+            not cns.mute and
+            cns.influence > 0.5):
+            limits.append((
+                (cns.use_limit_x, cns.use_limit_y, cns.use_limit_z),
+                (cns.min_x, cns.min_y, cns.min_z),
+                (cns.max_x, cns.max_y, cns.max_z)))
+    return limits
+
+
 def correctMatrixForLocks(mat, order, locks, pb, useLimits):
     head = Vector(mat.col[3])
 
@@ -395,55 +782,340 @@ class Retargeter:
 
 
     def retargetAnimation(self, context, srcRig, trgRig):
-        from .source import setSourceArmature
-        from .target import findTargetArmature
-        from .t_pose import setRigToFK
+        return self.retargetAnimations(context, srcRig, [trgRig])[0]
+
+
+    def retargetAnimations(self, context, srcRig, trgRigs, locScales=None):
+        return runSteps(self.iterRetargetAnimations(context, srcRig, trgRigs, locScales))
+
+    #
+    #   iterRetargetAnimations(context, srcRig, trgRigs, locScales=None):
+    #   Retarget the source animation to several targets in one pass.
+    #   locScales are the factors by which the source translations are
+    #   scaled for each target.
+    #   Yields after each block of frames and returns the (action, nFrames)
+    #   of each target. If it fails or is closed before it is done, the
+    #   targets get their old actions back.
+    #
+
+    def iterRetargetAnimations(self, context, srcRig, trgRigs, locScales=None):
         from .loop import getActiveFrames
 
-        startProgress("Retargeting %s => %s" % (srcRig.name, trgRig.name))
+        names = ", ".join([trgRig.name for trgRig in trgRigs])
+        startProgress("Retargeting %s => %s" % (srcRig.name, names))
         if srcRig.type != 'ARMATURE':
-            return None,0
+            return [(None,0) for trgRig in trgRigs]
         scn = context.scene
         frames = getActiveFrames(srcRig)
         nFrames = len(frames)
+        if not frames:
+            raise MocapError("No frames found.")
+        if locScales is None:
+            locScales = len(trgRigs)*[1.0]
+        if scn.McpStoreSourceHashes:
+            hashes = getSourceHashes(srcRig, frames)
+
+        anims = []
+        oldDatas = []
+        try:
+            for trgRig,locScale in zip(trgRigs, locScales):
+                anim,oldData = self.setupAnimation(context, srcRig, trgRig, frames, locScale)
+                anims.append(anim)
+                oldDatas.append(oldData)
+
+            yield from iterRetargetFrames(anims, frames, context)
+            for anim in anims:
+                anim.flushKeyBuffers()
+            setCurrentFrame(scn, frames[0])
+        except BaseException:
+            for anim in anims:
+                anim.rollback()
+            raise
+        finally:
+            for oldData in oldDatas:
+                restoreTargetData(oldData)
+
+        infos = []
+        for anim in anims:
+            act = self.finishAnimation(anim, srcRig.name)
+            if scn.McpStoreSourceHashes:
+                storeSourceHashes(act, hashes)
+            infos.append((act, nFrames))
+        endProgress("Retargeted %s --> %s" % (srcRig.name, names))
+        return infos
+
+    #
+    #   iterRetargetMotion(context, srcRig, trgRig, srcFK, nFrames, name):
+    #   Retarget frames 0 ... nFrames from a CMotionFK, where frame 0 is
+    #   the T-pose. srcRig is only used for its rest pose, and its mapping
+    #   must be cached.
+    #
+
+    def iterRetargetMotion(self, context, srcRig, trgRig, srcFK, nFrames, name):
+        if nFrames == 0:
+            raise MocapError("No frames found.")
+        startProgress("Retargeting %s => %s" % (name, trgRig.name))
+        scn = context.scene
+        frames = list(range(0, nFrames+1))
+        nFrames = len(frames)
+        anim,oldData = self.setupAnimation(context, srcRig, trgRig, frames, 1.0, srcFK=srcFK)
+        try:
+            yield from iterRetargetFrames([anim], frames, context)
+            anim.flushKeyBuffers()
+            setCurrentFrame(scn, frames[0])
+        except BaseException:
+            anim.rollback()
+            raise
+        finally:
+            restoreTargetData(oldData)
+        act = self.finishAnimation(anim, name)
+        endProgress("Retargeted %s --> %s" % (name, trgRig.name))
+        return (act, nFrames)
+
+
+    def finishAnimation(self, anim, name):
+        trgRig = anim.trgRig
+        setInterpolation(trgRig)
+        act = trgRig.animation_data.action
+        act.name = trgRig.name[:4] + name[2:]
+        act.use_fake_user = True
+        act["McpLocScale"] = anim.locScale
+        return act
+
+    #
+    #   retargetChangedFrames(context, srcRig, trgRig, frameRange=None):
+    #   Retarget only some frames and splice the keys into the existing
+    #   target action. If frameRange is None, the frames are those whose
+    #   source channels changed since the last retarget.
+    #
+
+    def retargetChangedFrames(self, context, srcRig, trgRig, frameRange=None):
+        from .loop import getActiveFrames
+
+        if srcRig.type != 'ARMATURE':
+            return 0
+        act = (trgRig.animation_data.action if trgRig.animation_data else None)
+        if act is None:
+            raise MocapError("%s has no action to update" % trgRig.name)
+        scn = context.scene
+        allFrames = getActiveFrames(srcRig)
+        if not allFrames:
+            raise MocapError("No frames found.")
+        oldHashes = loadSourceHashes(act)
+        hashes = None
+        if frameRange:
+            first,last = frameRange
+            frames = [frame for frame in allFrames if first <= frame <= last]
+        elif oldHashes is None:
+            raise MocapError(
+                "Action %s has no stored source channels.\n" % act.name +
+                "Enable Store Source Hashes and retarget again,\n" +
+                "or retarget a frame range instead")
+        else:
+            hashes = getSourceHashes(srcRig, allFrames)
+            frames = [frame for frame in allFrames
+                      if oldHashes.get(getFrameKey(frame)) != hashes[getFrameKey(frame)]]
+        nFrames = len(frames)
+        if nFrames == 0:
+            print("No changed frames in %s" % srcRig.name)
+            return 0
+        # Hash before setupAnimation, which keys the T-pose in the source
+        if hashes is None and (oldHashes is not None or scn.McpStoreSourceHashes):
+            hashes = getSourceHashes(srcRig, frames)
+
+        startProgress("Updating %d frames %s => %s" % (nFrames, srcRig.name, trgRig.name))
+        locScale = act.get("McpLocScale", 1.0)
+        anim,oldData = self.setupAnimation(context, srcRig, trgRig, frames, locScale, True)
+        try:
+            runSteps(iterRetargetFrames([anim], frames, context))
+            anim.flushKeyBuffers()
+            setCurrentFrame(scn, frames[0])
+        finally:
+            restoreTargetData(oldData)
+
+        if hashes is not None:
+            if oldHashes:
+                oldHashes.update(hashes)
+                hashes = oldHashes
+            storeSourceHashes(act, hashes)
+        endProgress("Updated %d frames %s --> %s" % (nFrames, srcRig.name, trgRig.name))
+        return nFrames
+
+
+    def setupAnimation(self, context, srcRig, trgRig, frames, locScale, keepAction=False, srcFK=None):
+        from .source import setSourceArmature
+        from .target import findTargetArmature
+        from .t_pose import setRigToFK
+
+        scn = context.scene
         setActiveObject(context, trgRig)
+        oldAction = None
         if trgRig.animation_data:
+            oldAction = trgRig.animation_data.action
             trgRig.animation_data.action = None
         setRigToFK(trgRig)
-
-        if frames:
-            setCurrentFrame(scn, frames[0])
-        else:
-            raise MocapError("No frames found.")
+        setCurrentFrame(scn, frames[0])
         oldData = changeTargetData(trgRig, scn)
 
         setSourceArmature(srcRig, scn)
         print("Retarget %s --> %s" % (srcRig.name, trgRig.name))
 
-        info = findTargetArmature(context, trgRig, self.useAutoTarget)
-        anim = CAnimation(srcRig, trgRig, info, context)
-        anim.putInTPoses(context)
+        mapping = None
+        if scn.McpUseMappingCache:
+            key = getMappingKey(srcRig, trgRig, scn, self.useAutoTarget)
+            mapping = _mappings.get(key)
+        if mapping:
+            print("Using cached mapping for %s" % mapping.armature)
+            trgRig.McpArmature = mapping.armature
+            anim = CAnimation(srcRig, trgRig, mapping, context, locScale=locScale, srcFK=srcFK)
+            anim.setTPoseMatrices(mapping)
+            mapping.putInTPoses(context, (None if srcFK else srcRig), trgRig)
+        else:
+            info = findTargetArmature(context, trgRig, self.useAutoTarget)
+            anim = CAnimation(srcRig, trgRig, info, context, locScale=locScale, srcFK=srcFK)
+            anim.putInTPoses(context)
+            if scn.McpUseMappingCache:
+                _mappings[key] = CMapping(anim)
+        anim.oldAction = oldAction
+        if keepAction and oldAction:
+            anim.rollback()
+        anim.keyErrors = self.getKeyErrors()
+        anim.initKeyBuffers(len(frames))
+        return anim, oldData
+
+    #
+    #   getKeyErrors():
+    #   The (location, rotation) errors to simplify the keys with while
+    #   retargeting, or None to key every frame.
+    #
+
+    def getKeyErrors(self):
+        return None
 
-        frameBlock = frames[0:100]
-        index = 0
-        try:
-            while frameBlock:
-                anim.retarget(frameBlock, context, index, nFrames)
-                index += 100
-                frameBlock = frames[index:index+100]
+#-------------------------------------------------------------
+#   Retarget mappings
+#
+#   The bone pairs and T-pose matrices found for a source and target
+#   rig are reused when the same rigs are retargeted again, so that
+#   identification and T-posing are skipped. The parent chain and the
+#   rest pose matrices B are rebuilt from the target rig, which is cheap.
+#   The key holds the rest poses of both rigs, so the mapping is not
+#   used after either rig has been edited. Only the rotations of the
+#   source rest pose are used, since the source is rescaled to each
+#   target and A only depends on rotations.
+#-------------------------------------------------------------
 
-            setCurrentFrame(scn, frames[0])
-        finally:
-            restoreTargetData(oldData)
+class CMapping:
+    def __init__(self, anim):
+        self.armature = anim.trgRig.McpArmature
+        self.bones = []
+        self.aMatrices = {}
+        for trgName,banim in anim.boneAnims.items():
+            self.bones.append((trgName, banim.srcBone.name))
+            self.aMatrices[trgName] = banim.aMatrix.copy()
+        self.srcPose = getPoseBasis(anim.srcRig)
+        self.trgPose = getPoseBasis(anim.trgRig)
+
+    #
+    #   putInTPoses(context, srcRig, trgRig):
+    #   Key the T-poses that CAnimation.putInTPoses keyed when the mapping
+    #   was made, so that all bones, also the unmapped ones, start out in
+    #   the same pose as without the cache. srcRig is None if the source
+    #   is not a keyed rig.
+    #
+
+    def putInTPoses(self, context, srcRig, trgRig):
+        setFrame(context.scene, 0)
+        if srcRig:
+            setPoseBasis(srcRig, self.srcPose)
+        setPoseBasis(trgRig, self.trgPose)
+        updateScene()
+
+
+def getPoseBasis(rig):
+    return dict([(pb.name, pb.matrix_basis.copy()) for pb in rig.pose.bones])
+
+
+def setPoseBasis(rig, pose):
+    from .t_pose import setKeys
+    for pb in rig.pose.bones:
+        pb.matrix_basis = pose.get(pb.name, Matrix())
+        setKeys(pb)
 
-        #anim.printResult(scn, 1)
 
-        setInterpolation(trgRig)
-        act = trgRig.animation_data.action
-        act.name = trgRig.name[:4] + srcRig.name[2:]
-        act.use_fake_user = True
-        endProgress("Retargeted %s --> %s" % (srcRig.name, trgRig.name))
-        return act,nFrames
+_mappings = {}
+
+def getRestPoseHash(sha, rig, useTranslation):
+    for bone in rig.data.bones:
+        if useTranslation:
+            mat = bone.matrix_local
+        else:
+            mat = bone.matrix_local.to_3x3().normalized()
+        pname = (bone.parent.name if bone.parent else "")
+        values = " ".join(["%.4f" % x for row in mat for x in row])
+        sha.update(("%s %s %s\n" % (bone.name, pname, values)).encode("utf-8"))
+
+
+def getMappingKey(srcRig, trgRig, scn, useAutoTarget):
+    sha = hashlib.sha1()
+    getRestPoseHash(sha, srcRig, False)
+    getRestPoseHash(sha, trgRig, True)
+    settings = (srcRig.McpArmature, scn.McpSourceTPose, useAutoTarget,
+                scn.McpIncludeFingers, scn.McpUseLimits, scn.McpClearLocks)
+    if not useAutoTarget:
+        settings += (scn.McpTargetRig, scn.McpTargetTPose)
+    sha.update(repr(settings).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def clearMappings():
+    global _mappings
+    _mappings = {}
+
+#-------------------------------------------------------------
+#   Source hashes
+#   If McpStoreSourceHashes is set, a hash of all source channels for
+#   each frame is stored on the target action, so changed frames can be
+#   retargeted again. The location scale of the retarget is always
+#   stored, as McpLocScale.
+#-------------------------------------------------------------
+
+def getFrameKey(frame):
+    return "%g" % frame
+
+
+def getSourceHashes(srcRig, frames):
+    act = srcRig.animation_data.action
+    fcurves = [fcu for fcu in act.fcurves if not fcu.mute]
+    fcurves.sort(key=lambda fcu: (fcu.data_path, fcu.array_index))
+    sha = hashlib.sha1()
+    for fcu in fcurves:
+        sha.update(("%s %d\n" % (fcu.data_path, fcu.array_index)).encode("utf-8"))
+    if fcurves:
+        values = np.array([getFCurveValues(fcu, frames) for fcu in fcurves]).transpose()
+    else:
+        values = np.zeros((len(frames), 0))
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    hashes = {}
+    for n,frame in enumerate(frames):
+        fsha = sha.copy()
+        fsha.update(values[n].tobytes())
+        hashes[getFrameKey(frame)] = fsha.hexdigest()
+    return hashes
+
+
+def storeSourceHashes(act, hashes):
+    act["McpSourceHashes"] = json.dumps(hashes)
+
+
+def loadSourceHashes(act):
+    string = act.get("McpSourceHashes")
+    if string is None:
+        return None
+    try:
+        return json.loads(string)
+    except ValueError:
+        return None
 
 #
 #   changeTargetData(rig, scn):
@@ -602,17 +1274,140 @@ class MCP_OT_RetargetSelectedToActive(HidePropsOperator, IsArmature, BvhRenamer,
         return HidePropsOperator.invoke(self, context, event)
 
 
-class MCP_OT_LoadAndRetarget(HideOperator, IsArmature, MultiFile, BvhFile, BvhLoader, BvhRenamer, Retargeter, TimeScaler, Simplifier, Bender):
-    bl_idname = "mcp.load_and_retarget"
-    bl_label = "Load And Retarget"
-    bl_description = "Load animation from bvh file to the active armature"
+class MCP_OT_RetargetActiveToSelected(HidePropsOperator, IsArmature, BvhRenamer, Retargeter):
+    bl_idname = "mcp.retarget_active_to_selected"
+    bl_label = "Retarget Active To Selected"
+    bl_description = "Retarget animation from the active (source) armature to all other selected (target) armatures in one pass"
+    bl_options = {'UNDO'}
+
+    def run(self, context):
+        from .load import checkObjectProblems
+        srcRig = context.object
+        trgRigs = [ob for ob in context.selected_objects if ob != srcRig and ob.type == 'ARMATURE']
+        if not trgRigs:
+            raise MocapError("No target armatures selected")
+        for trgRig in trgRigs:
+            checkObjectProblems(context, trgRig)
+        bpy.ops.object.select_all(action='DESELECT')
+        srcRig.select_set(True)
+        bpy.ops.object.duplicate()
+        tmpRig = context.object
+        try:
+            self.renameAndRescaleBvh(context, tmpRig, trgRigs[0])
+            locScales = [1.0]
+            if self.useAutoScale:
+                refScale = self.getTargetScale(trgRigs[0])
+                for trgRig in trgRigs[1:]:
+                    self.findTarget(context, trgRig)
+                    locScales.append(self.getTargetScale(trgRig)/refScale)
+            else:
+                locScales = len(trgRigs)*[1.0]
+            bpy.ops.object.mode_set(mode='OBJECT')
+            self.retargetAnimations(context, tmpRig, trgRigs, locScales)
+        finally:
+            bpy.ops.object.mode_set(mode='OBJECT')
+            bpy.ops.object.select_all(action='DESELECT')
+            tmpRig.select_set(True)
+            bpy.ops.object.delete()
+            for trgRig in trgRigs:
+                trgRig.select_set(True)
+            srcRig.select_set(True)
+            context.view_layer.objects.active = srcRig
+
+    def invoke(self, context, event):
+        ensureInited(context.scene)
+        return HidePropsOperator.invoke(self, context, event)
+
+
+class MCP_OT_UpdateRetarget(HidePropsOperator, IsArmature, BvhRenamer, Retargeter):
+    bl_idname = "mcp.update_retarget"
+    bl_label = "Update Retarget"
+    bl_description = "Retarget only changed frames from the other selected (source) armature, and splice them into the action of the active (target) armature"
     bl_options = {'UNDO'}
 
+    useFrameRange : BoolProperty(
+        name = "Frame Range",
+        description = "Retarget the given frame range instead of the frames with changed source channels",
+        default = False)
+
+    startFrame : IntProperty(
+        name = "Start Frame",
+        description = "First frame to retarget",
+        default = 1)
+
+    endFrame : IntProperty(
+        name = "End Frame",
+        description = "Last frame to retarget",
+        default = 250)
+
+    def draw(self, context):
+        BvhRenamer.draw(self, context)
+        self.layout.prop(self, "useFrameRange")
+        if self.useFrameRange:
+            self.layout.prop(self, "startFrame")
+            self.layout.prop(self, "endFrame")
+
+    def run(self, context):
+        from .load import checkObjectProblems
+        checkObjectProblems(context)
+        trgRig = context.object
+        srcRig = getOtherRig(context, trgRig)
+        if srcRig is None:
+            raise MocapError("No source armature found")
+        if self.useFrameRange:
+            frameRange = (self.startFrame, self.endFrame)
+        else:
+            frameRange = None
+        bpy.ops.object.select_all(action='DESELECT')
+        context.view_layer.objects.active = srcRig
+        srcRig.select_set(True)
+        bpy.ops.object.duplicate()
+        tmpRig = context.object
+        context.view_layer.objects.active = trgRig
+        try:
+            self.renameAndRescaleBvh(context, tmpRig, trgRig)
+            bpy.ops.object.mode_set(mode='OBJECT')
+            nFrames = self.retargetChangedFrames(context, tmpRig, trgRig, frameRange)
+            raise MocapMessage("%d frames updated" % nFrames)
+        finally:
+            bpy.ops.object.mode_set(mode='OBJECT')
+            bpy.ops.object.select_all(action='DESELECT')
+            tmpRig.select_set(True)
+            bpy.ops.object.delete()
+            trgRig.select_set(True)
+            context.view_layer.objects.active = trgRig
+
+    def invoke(self, context, event):
+        ensureInited(context.scene)
+        return HidePropsOperator.invoke(self, context, event)
+
+
+class LoadAndRetarget(MultiFile, BvhFile, BvhLoader, BvhRenamer, Retargeter, TimeScaler, Simplifier, Bender):
     useNLA : BoolProperty(
         name = "Create NLA Strips",
         description = "Create a NLA strip for each loaded action",
         default = False)
 
+    useSkeletonPool : BoolProperty(
+        name = "Reuse Source Skeletons",
+        description = "Files with the same hierarchy share one source armature, instead of building a new one for each file",
+        default = True)
+
+    useDirectPipeline : BoolProperty(
+        name = "Direct Retarget",
+        description = "Retarget files whose skeleton was already retargeted straight from the bvh channels, without keying a source armature. Needs reused source skeletons and the mapping cache",
+        default = False)
+
+    useStreaming : BoolProperty(
+        name = "Stream Frames",
+        description = "Read and retarget directly retargeted files in blocks of frames, so that memory use does not grow with the take length. Files are then not parsed ahead",
+        default = False)
+
+    useOnlineSimplify : BoolProperty(
+        name = "Simplify While Retargeting",
+        description = "Simplify the keys while they are retargeted, so that every frame is never keyed. Only for linear keys of whole channels, in the whole action",
+        default = True)
+
     def draw(self, context):
         BvhLoader.draw(self, context)
         BvhRenamer.draw(self, context)
@@ -620,18 +1415,41 @@ class MCP_OT_LoadAndRetarget(HideOperator, IsArmature, MultiFile, BvhFile, BvhLo
         self.layout.separator()
         TimeScaler.draw(self, context)
         Simplifier.draw(self, context)
+        if self.useSimplify:
+            self.layout.prop(self, "useOnlineSimplify")
         self.layout.prop(self, "useNLA")
-
-
-    def run(self, context):
-        from .load import checkObjectProblems
+        self.layout.prop(self, "useSkeletonPool")
+        if self.useSkeletonPool:
+            self.layout.prop(self, "useDirectPipeline")
+            if self.useDirectPipeline:
+                self.layout.prop(self, "useStreaming")
+
+    #
+    #   iterLoadAndRetarget(context):
+    #   Load and retarget all files to the active armature, and yield
+    #   after each block of frames.
+    #
+
+    def iterLoadAndRetarget(self, context):
+        from .load import checkObjectProblems, SkeletonPool
         checkObjectProblems(context)
         rig = context.object
         infos = []
-        for filepath in self.getFilePaths():
-            print("---------------")
-            info = self.retarget(context, filepath)
-            infos.append(info)
+        self.pool = (SkeletonPool() if self.useSkeletonPool else None)
+        filepaths = self.getFilePaths()
+        if self.canStream():
+            motions = [(filepath, None) for filepath in filepaths]
+        else:
+            motions = self.iterBvhMotions(context, filepaths)
+        try:
+            for filepath,motion in motions:
+                print("---------------")
+                info = yield from self.iterRetargetFile(context, rig, filepath, motion)
+                infos.append(info)
+        finally:
+            if self.pool:
+                self.pool.clear(context)
+                setActiveObject(context, rig)
         print("---------------")
         if self.useNLA:
             for act,size in infos:
@@ -642,32 +1460,141 @@ class MCP_OT_LoadAndRetarget(HideOperator, IsArmature, MultiFile, BvhFile, BvhLo
             rig.animation_data.action = None
         rig.select_set(True)
         context.view_layer.objects.active = rig
-        raise MocapMessage("BVH file(s) retargeted")
+        return infos
 
 
-    def retarget(self, context, filepath):
+    def iterRetargetFile(self, context, trgRig, filepath, motion=None):
         from .load import deleteSourceRig
 
         print("\n---------------\nLoad and retarget %s" % filepath)
         scn = context.scene
-        trgRig = context.object
-        srcRig = self.readBvhFile(context, filepath, scn, False)
+        if self.pool and self.useDirectPipeline:
+            info,motion = yield from self.iterRetargetDirect(context, trgRig, filepath, motion)
+            if info:
+                self.postProcess(context, trgRig)
+                return info
+        setActiveObject(context, trgRig)
+        srcRig = self.readBvhFile(context, filepath, scn, False, motion, self.pool)
         info = (None, 0)
         try:
-            self.renameAndRescaleBvh(context, srcRig, trgRig)
-            info = self.retargetAnimation(context, srcRig, trgRig)
-            scn = context.scene
-            if self.useBendPositive:
-                self.useKnees = self.useElbows = True
-                self.limbsBendPositive(trgRig, (0,1e6))
-            if self.useSimplify:
-                self.simplifyFCurves(context, trgRig)
-            if self.useTimeScale:
-                self.timescaleFCurves(trgRig)
+            if srcRig.McpRenamed:
+                self.tposeRenamedBvh(context, srcRig)
+            else:
+                scale = self.scale
+                boneNames = self.renameAndRescaleBvh(context, srcRig, trgRig)
+                if self.pool:
+                    if self.useAutoScale:
+                        scale *= self.scale
+                    self.pool.finish(srcRig, boneNames, scale)
+            infos = yield from self.iterRetargetAnimations(context, srcRig, [trgRig])
+            info = infos[0]
+            self.postProcess(context, trgRig)
         finally:
-            deleteSourceRig(context, srcRig, 'Y_')
+            if self.pool:
+                self.pool.release(context, srcRig)
+            else:
+                deleteSourceRig(context, srcRig, 'Y_')
         return info
 
+    #
+    #   iterRetargetDirect(context, trgRig, filepath, motion):
+    #   If an earlier file with the same hierarchy has been retargeted to
+    #   the same target, reuse its renamed and rescaled rest pose and its
+    #   cached mapping, whose source pose is the T-pose at frame 0. The bvh channels are then decoded, renamed and
+    #   scaled in memory, and the source pose is computed by CMotionFK.
+    #   With streaming, only the hierarchy is read first, and the frames
+    #   are read, decoded and retargeted one block at a time.
+    #   Returns (info, motion), where info is None if the file must be
+    #   loaded into a source armature. motion is then the parsed motion,
+    #   or None if only the hierarchy was read.
+    #
+
+    def iterRetargetDirect(self, context, trgRig, filepath, motion):
+        from .load import getBvhRigName
+        scn = context.scene
+        fileName = os.path.realpath(os.path.expanduser(filepath))
+        if os.path.splitext(fileName)[1].lower() != ".bvh":
+            raise MocapError("Not a bvh file: " + fileName)
+        flipMatrix = self.getFlipMatrix()
+        if self.canStream() and motion is None:
+            with open(fileName, "r") as fp:
+                root,nodes = self.readHierarchy(fp, flipMatrix)
+        else:
+            root,nodes,motion = self.loadBvhMotion(fileName, filepath, scn, flipMatrix, motion)
+        entry = self.pool.find(self.pool.getKey(root, self))
+        if entry is None or not scn.McpUseMappingCache:
+            return None, motion
+        key = getMappingKey(entry.rig, trgRig, scn, self.useAutoTarget)
+        if key not in _mappings:
+            return None, motion
+
+        print("Retarget directly with skeleton %s" % entry.rig.name)
+        root.buildRest(Vector((0,0,0)), None)
+        if motion is None:
+            stream = self.openMotionStream(fileName, filepath, root, nodes, flipMatrix, scn)
+            blocks = stream.iterBlocks()
+            nFrames = stream.nKeys
+        else:
+            bones = self.getMotionBones(motion, nodes, flipMatrix, scn)
+            blocks = iter([(0, bones)])
+            times = self.getMotionTimes(motion, scn)
+            if times is None:
+                nFrames = len(motion["data"])
+            else:
+                nFrames = len(times)
+        blocks = self.iterRenamedBlocks(blocks, entry)
+        try:
+            srcFK = CMotionFK(entry.rig, blocks, _mappings[key].srcPose)
+            info = yield from self.iterRetargetMotion(context, entry.rig, trgRig, srcFK, nFrames, getBvhRigName(filepath))
+        finally:
+            blocks.close()
+        return info, motion
+
+
+    def iterRenamedBlocks(self, blocks, entry):
+        try:
+            for start,bones in blocks:
+                channels = {}
+                for bname,(locs, quats) in bones.items():
+                    if bname not in entry.boneNames.keys():
+                        continue
+                    if locs is not None:
+                        locs = locs * entry.scale
+                    channels[entry.boneNames[bname]] = (locs, quats)
+                yield start, channels
+        finally:
+            if hasattr(blocks, "close"):
+                blocks.close()
+
+
+    def canStream(self):
+        return self.useStreaming and self.useSkeletonPool and self.useDirectPipeline
+
+
+    def getKeyErrors(self):
+        if self.canSimplifyOnline():
+            return (self.maxErrLoc, self.maxErrRot*pi/180)
+        return None
+
+
+    def canSimplifyOnline(self):
+        return (self.useSimplify and
+                self.useOnlineSimplify and
+                self.simplifyMode == 'LINEAR' and
+                self.useJointChannels and
+                not self.useSelected and
+                not self.useMarkers)
+
+
+    def postProcess(self, context, trgRig):
+        if self.useBendPositive:
+            self.useKnees = self.useElbows = True
+            self.limbsBendPositive(trgRig, (0,1e6))
+        if self.useSimplify and not self.canSimplifyOnline():
+            self.simplifyFCurves(context, trgRig)
+        if self.useTimeScale:
+            self.timescaleFCurves(trgRig)
+
 
     def invoke(self, context, event):
         ensureInited(context.scene)
@@ -675,6 +1602,84 @@ class MCP_OT_LoadAndRetarget(HideOperator, IsArmature, MultiFile, BvhFile, BvhLo
         return {'RUNNING_MODAL'}
 
 
+class MCP_OT_LoadAndRetarget(HideOperator, IsArmature, LoadAndRetarget):
+    bl_idname = "mcp.load_and_retarget"
+    bl_label = "Load And Retarget"
+    bl_description = "Load animation from bvh file to the active armature"
+    bl_options = {'UNDO'}
+
+    def run(self, context):
+        runSteps(self.iterLoadAndRetarget(context))
+        raise MocapMessage("BVH file(s) retargeted")
+
+#
+#   class MCP_OT_LoadAndRetargetModal:
+#   Same as Load And Retarget, but one block of frames is retargeted
+#   for each timer event, so the UI stays responsive. Esc cancels, and
+#   the file being retargeted is rolled back. Only view navigation is
+#   passed on; other events, like undo or deleting objects, could free
+#   the rigs and actions that are being retargeted.
+#
+
+NavigationEvents = [
+    'MOUSEMOVE', 'INBETWEEN_MOUSEMOVE', 'MIDDLEMOUSE', 'WHEELUPMOUSE', 'WHEELDOWNMOUSE',
+    'TRACKPADPAN', 'TRACKPADZOOM', 'MOUSEROTATE', 'NDOF_MOTION',
+]
+
+class MCP_OT_LoadAndRetargetModal(bpy.types.Operator, IsArmature, LoadAndRetarget):
+    bl_idname = "mcp.load_and_retarget_modal"
+    bl_label = "Load And Retarget In Background"
+    bl_description = "Load animation from bvh files to the active armature while the UI stays responsive. Press Esc to cancel"
+    bl_options = {'UNDO'}
+
+    def execute(self, context):
+        clearErrorMessage()
+        wm = context.window_manager
+        self.steps = self.iterLoadAndRetarget(bpy.context)
+        self.timer = wm.event_timer_add(0.01, window=context.window)
+        wm.modal_handler_add(self)
+        context.workspace.status_text_set("Retargeting bvh files. Press Esc to cancel")
+        return {'RUNNING_MODAL'}
+
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            try:
+                self.steps.close()
+            finally:
+                self.finish(context)
+            self.report({'WARNING'}, "Retargeting cancelled")
+            return {'CANCELLED'}
+        elif event.type in NavigationEvents:
+            return {'PASS_THROUGH'}
+        elif event.type != 'TIMER':
+            return {'RUNNING_MODAL'}
+        try:
+            next(self.steps)
+        except StopIteration:
+            self.finish(context)
+            self.report({'INFO'}, "BVH file(s) retargeted")
+            return {'FINISHED'}
+        except MocapError:
+            self.finish(context)
+            if getSilentMode():
+                print(getErrorMessage())
+            else:
+                bpy.ops.mcp.error('INVOKE_DEFAULT')
+            return {'CANCELLED'}
+        except Exception:
+            self.finish(context)
+            raise
+        return {'RUNNING_MODAL'}
+
+
+    def finish(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+
 class MCP_OT_ClearTempProps(BvhOperator):
     bl_idname = "mcp.clear_temp_props"
     bl_label = "Clear Temporary Properties"
@@ -698,7 +1703,10 @@ class MCP_OT_ClearTempProps(BvhOperator):
 classes = [
     MCP_OT_RetargetRenamedToActive,
     MCP_OT_RetargetSelectedToActive,
+    MCP_OT_RetargetActiveToSelected,
+    MCP_OT_UpdateRetarget,
     MCP_OT_LoadAndRetarget,
+    MCP_OT_LoadAndRetargetModal,
     MCP_OT_ClearTempProps,
 ]
 
@@ -713,6 +1721,21 @@ def initialize():
         description="Clear X and Z rotation locks",
         default=False)
 
+    bpy.types.Scene.McpUseDirectFK = BoolProperty(
+        name = "Direct Forward Kinematics",
+        description = "Compute the source bone matrices from the source action, instead of evaluating the scene at every frame",
+        default = True)
+
+    bpy.types.Scene.McpUseMappingCache = BoolProperty(
+        name = "Cache Retarget Mappings",
+        description = "Reuse bone pairs and T-pose matrices when the same source skeleton is retargeted to the same target again",
+        default = True)
+
+    bpy.types.Scene.McpStoreSourceHashes = BoolProperty(
+        name = "Store Source Hashes",
+        description = "Store a hash of the source channels of each frame in the retargeted action, so that Update Retarget can find the changed frames. Makes retargeting slower and blend files larger",
+        default = False)
+
     bpy.types.Scene.McpIncludeFingers = BoolProperty(
         name = "Include Fingers",
         description = "Include finger bones",
@@ -725,5 +1748,6 @@ def initialize():
 
 
 def uninitialize():
+    shutdownSharedPool()
     for cls in classes:
         bpy.utils.unregister_class(cls)
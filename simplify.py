@@ -29,6 +29,7 @@
 
 
 import bpy
+import numpy as np
 from math import pi
 from .utils import *
 
@@ -112,12 +113,26 @@ class Simplifier(FCurvesGetter):
         min=0.001,
         default=0.1)
 
+    simplifyMode : EnumProperty(
+        items = [('LINEAR', "Linear Keys", "Keep a subset of the keys, with linear interpolation"),
+                 ('BEZIER', "Bezier Fit", "Keep fewer keys, joined by Bezier segments with fitted handles")],
+        name = "Simplify Mode",
+        description = "How the kept keys are interpolated",
+        default = 'LINEAR')
+
+    useJointChannels : BoolProperty(
+        name="Simplify Channels Together",
+        description="All components of a location or rotation share the same keys. The error is the distance or the rotation angle",
+        default=True)
+
     def draw(self, context):
         self.layout.prop(self, "useSimplify")
         if self.useSimplify:
             FCurvesGetter.draw(self, context)
             self.layout.prop(self, "maxErrLoc")
             self.layout.prop(self, "maxErrRot")
+            self.layout.prop(self, "simplifyMode")
+            self.layout.prop(self, "useJointChannels")
         self.layout.separator()
 
 
@@ -131,35 +146,44 @@ class Simplifier(FCurvesGetter):
         if not fcurves:
             return
     
+        tasks = []
+        if self.useJointChannels:
+            channels,fcurves = groupFCurves(fcurves)
+            for fcus in channels:
+                tasks += self.getChannelTasks(fcus, rig, minTime, maxTime)
         for fcu in fcurves:
-            self.simplifyFCurve(fcu, rig.animation_data.action, minTime, maxTime)
-        setInterpolation(rig)
+            tasks.append(self.getFCurveTask(fcu, minTime, maxTime))
+        tasks = [task for task in tasks if task]
+        results = computeReductions(scn, tasks)
+        for task,result in zip(tasks, results):
+            self.applyReduction(task, result)
+        if self.simplifyMode == 'LINEAR':
+            setInterpolation(rig)
         print("F-curves simplified")
     
         
     def splitFCurvePoints(self, fcu, minTime, maxTime):
+        n = len(fcu.keyframe_points)
+        co = np.empty(2*n, dtype=np.float32)
+        fcu.keyframe_points.foreach_get("co", co)
+        xs = co[0::2]
+        ys = co[1::2]
         if minTime == 'All':
-            points = fcu.keyframe_points
-            before = []
-            after = []
+            inside = np.ones(n, dtype=bool)
         else:
-            points = []
-            before = []
-            after = []
-            for pt in fcu.keyframe_points:
-                t = pt.co[0]
-                if t < minTime:
-                    before.append(pt.co)
-                elif t > maxTime:
-                    after.append(pt.co)
-                else:
-                    points.append(pt)
-        return (points, before, after)
-    
-    
-    def simplifyFCurve(self, fcu, act, minTime, maxTime):
-        #print("WARNING: F-curve simplification turned off")
-        #return
+            inside = (xs >= minTime) & (xs <= maxTime)
+        return (xs, ys, inside)
+
+    #
+    #   Simplification is done in tasks. A task is (fcus, splits, points,
+    #   args), where fcus are F-curves with the same key times as split
+    #   by splitFCurvePoints, points are the indices of the keys to
+    #   simplify, and args are the arguments of curves.reduceKeys.
+    #   Several F-curves are the components of one channel and share
+    #   the kept keys.
+    #
+
+    def getFCurveTask(self, fcu, minTime, maxTime):
         words = fcu.data_path.split('.')
         if words[-1] == 'location':
             maxErr = self.maxErrLoc
@@ -169,60 +193,153 @@ class Simplifier(FCurvesGetter):
             maxErr = self.maxErrRot * pi/180
         else:
             raise MocapError("Unknown FCurve type %s" % words[-1])
-    
-        (points, before, after) = self.splitFCurvePoints(fcu, minTime, maxTime)
-    
-        nPoints = len(points)
-        nBefore = len(before)
-        nAfter = len(after)
-        if nPoints <= 2:
-            return
-        keeps = []
-        new = [0, nPoints-1]
-        while new:
-            keeps += new
-            keeps.sort()
-            new = self.iterateFCurves(points, keeps, maxErr)
-        newVerts = []
-        for n in keeps:
-            newVerts.append(points[n].co.copy())
-        nNewPoints = len(newVerts)
-    
-        oldOffset = nBefore+nPoints
-        newOffset = nBefore+nNewPoints
-        for n in range(nAfter):
-            fcu.keyframe_points[n+newOffset].co = fcu.keyframe_points[n+oldOffset].co.copy()
-        n = nBefore+nPoints+nAfter
-        n1 = nBefore+nNewPoints+nAfter
-        while n > n1:
-            n -= 1
-            kp = fcu.keyframe_points[n]
-            fcu.keyframe_points.remove(kp)
-        for n in range(nNewPoints):
-            fcu.keyframe_points[n+nBefore].co = newVerts[n]
-    
-    
-    def iterateFCurves(self, points, keeps, maxErr):
-        new = []
-        for edge in range(len(keeps)-1):
-            n0 = keeps[edge]
-            n1 = keeps[edge+1]
-            (x0, y0) = points[n0].co
-            (x1, y1) = points[n1].co
-            if x1 > x0:
-                dxdn = (x1-x0)/(n1-n0)
-                dydx = (y1-y0)/(x1-x0)
-                err = 0
-                for n in range(n0+1, n1):
-                    (x, y) = points[n].co
-                    xn = n0 + dxdn*(n-n0)
-                    yn = y0 + dydx*(xn-x0)
-                    if abs(y-yn) > err:
-                        err = abs(y-yn)
-                        worst = n
-                if err > maxErr:
-                    new.append(worst)
-        return new
+
+        split = self.splitFCurvePoints(fcu, minTime, maxTime)
+        return self.getTask([fcu], [split], maxErr, None, 'XYZ')
+
+    #
+    #   getChannelTasks(fcus, rig, minTime, maxTime):
+    #   One task for all components of a bone channel, or one task per
+    #   component if they have different key times.
+    #
+
+    def getChannelTasks(self, fcus, rig, minTime, maxTime):
+        channel = fcus[0].data_path.split('.')[-1]
+        if channel == 'location':
+            maxErr = self.maxErrLoc
+        else:
+            maxErr = self.maxErrRot * pi/180
+
+        splits = [self.splitFCurvePoints(fcu, minTime, maxTime) for fcu in fcus]
+        (xs, ys, inside) = splits[0]
+        for (xs1, ys1, inside1) in splits[1:]:
+            if len(xs1) != len(xs) or (xs1 != xs).any():
+                return [self.getFCurveTask(fcu, minTime, maxTime) for fcu in fcus]
+        order = getRotationOrder(rig, fcus[0].data_path)
+        return [self.getTask(fcus, splits, maxErr, channel, order)]
+
+
+    def getTask(self, fcus, splits, maxErr, channel, order):
+        (xs, ys, inside) = splits[0]
+        points = np.flatnonzero(inside)
+        if len(points) <= 2:
+            return None
+        if len(fcus) == 1:
+            values = ys[points].astype(float)
+        else:
+            values = np.array([ys1[points] for (xs1, ys1, inside1) in splits], dtype=float).transpose()
+        args = (xs[points].astype(float), values, maxErr, channel, order, self.simplifyMode)
+        return (fcus, splits, points, args)
+
+
+    def applyReduction(self, task, result):
+        (fcus, splits, points, args) = task
+        (mask, slopes) = result
+        xs = splits[0][0]
+        keep = np.ones(len(xs), dtype=bool)
+        keep[points] = mask
+        if slopes is not None:
+            fitted = points[mask]
+            slopes = slopes.reshape((len(fitted), -1))
+            for n,fcu in enumerate(fcus):
+                setBezierKeys(fcu, keep, fitted, slopes[:,n])
+        elif not keep.all():
+            for fcu,(xs1, ys1, inside1) in zip(fcus, splits):
+                setFCurveKeys(fcu, xs[keep], ys1[keep])
+
+#
+#   computeReductions(scn, tasks):
+#   The results of curves.reduceKeys for all tasks. Large actions are
+#   split into batches that are simplified by worker processes.
+#
+
+ParallelKeyCount = 100000
+
+def computeReductions(scn, tasks):
+    from .mcp_kernels.curves import reduceKeys
+    nKeys = sum([task[3][1].size for task in tasks])
+    nWorkers = getWorkerCount(scn)
+    if nKeys < ParallelKeyCount or nWorkers <= 1:
+        return [reduceKeys(*task[3]) for task in tasks]
+    curves = getWorkerModule("curves")
+    nBatches = min(4*nWorkers, len(tasks))
+    bounds = np.linspace(0, len(tasks), nBatches+1).astype(int)
+    batches = [tasks[first:last] for first,last in zip(bounds[:-1], bounds[1:])]
+    argslist = [([task[3] for task in batch],) for batch in batches]
+    results = []
+    for batch,result in zip(batches, iterPoolResults(scn, curves.reduceKeysList, argslist)):
+        if result is None:
+            result = [reduceKeys(*task[3]) for task in batch]
+        results += result
+    return results
+
+#
+#   setBezierKeys(fcu, keep, fitted, slopes):
+#   Keep the keys in the mask keep. The keys with indices fitted get
+#   Bezier interpolation and aligned handles with the fitted slopes, one
+#   slope per key. The left handle of the first key and the right handle
+#   of the last key belong to the segments outside, and are left alone,
+#   as are the other keys.
+#
+
+def setBezierKeys(fcu, keep, fitted, slopes):
+    points = getFCurvePoints(fcu)
+    xs = points["co"][:,0]
+    ys = points["co"][:,1]
+    x0 = xs[fitted[:-1]]
+    dx = (xs[fitted[1:]] - x0)/3
+    rights = points["handle_right"]
+    lefts = points["handle_left"]
+    rights[fitted[:-1],0] = x0 + dx
+    rights[fitted[:-1],1] = ys[fitted[:-1]] + slopes[:-1]*dx
+    lefts[fitted[1:],0] = xs[fitted[1:]] - dx
+    lefts[fitted[1:],1] = ys[fitted[1:]] - slopes[1:]*dx
+    points["interpolation"][fitted[:-1]] = Interpolations['BEZIER']
+    points["handle_right_type"][fitted[0]] = HandleTypes['FREE']
+    points["handle_left_type"][fitted[-1]] = HandleTypes['FREE']
+    points["handle_left_type"][fitted[1:-1]] = HandleTypes['ALIGNED']
+    points["handle_right_type"][fitted[1:-1]] = HandleTypes['ALIGNED']
+    for attr in points.keys():
+        points[attr] = points[attr][keep]
+    setFCurvePoints(fcu, points)
+
+#
+#   groupFCurves(fcurves):
+#   Split F-curves into channels that can be simplified together, as
+#   lists of F-curves sorted by array index, and the remaining F-curves.
+#
+
+ChannelSizes = {
+    'location' : 3,
+    'rotation_quaternion' : 4,
+    'rotation_euler' : 3,
+}
+
+def groupFCurves(fcurves):
+    paths = {}
+    for fcu in fcurves:
+        if fcu.data_path not in paths.keys():
+            paths[fcu.data_path] = []
+        paths[fcu.data_path].append(fcu)
+    channels = []
+    singles = []
+    for path,fcus in paths.items():
+        size = ChannelSizes.get(path.split('.')[-1])
+        fcus.sort(key=lambda fcu: fcu.array_index)
+        if size and [fcu.array_index for fcu in fcus] == list(range(size)):
+            channels.append(fcus)
+        else:
+            singles += fcus
+    return channels, singles
+
+
+def getRotationOrder(rig, path):
+    words = path.split('"')
+    if len(words) > 1 and words[0] == "pose.bones[":
+        pb = rig.pose.bones.get(words[1])
+        if pb and pb.rotation_mode in ['XYZ', 'XZY', 'YXZ', 'YZX', 'ZXY', 'ZYX']:
+            return pb.rotation_mode
+    return 'XYZ'
 
 #
 #   TimeScaler
@@ -276,6 +393,10 @@ class TimeScaler:
                 elif (vm > upper) and (vk < lower):
                     inserts.append((tm, vm, tn,vk))
             pk.co = (tn,vk)
+            hl = pk.handle_left
+            hr = pk.handle_right
+            pk.handle_left = (self.factor*(hl[0]-t0) + t0, hl[1])
+            pk.handle_right = (self.factor*(hr[0]-t0) + t0, hr[1])
             tm = tn
             vm = vk
 
@@ -341,6 +462,8 @@ class MCP_OT_SimplifyFCurves(BvhPropsOperator, IsArmature, Simplifier):
         FCurvesGetter.draw(self, context)
         self.layout.prop(self, "maxErrLoc")
         self.layout.prop(self, "maxErrRot")
+        self.layout.prop(self, "simplifyMode")
+        self.layout.prop(self, "useJointChannels")
     
     def run(self, context):
         self.useSimplify = True
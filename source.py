@@ -314,8 +314,10 @@ class MCP_OT_InitKnownRigs(bpy.types.Operator):
 
     def execute(self, context):
         from .target import initTargets
+        from .retarget import clearMappings
         initSources(context.scene)
         initTargets(context.scene)
+        clearMappings()
         return{'FINISHED'}
 
 
@@ -136,16 +136,23 @@ def guessArmatureFromList(rig, scn, infos):
 
 
 def matchAllBones(rig, info, scn):
-    if not hasAllBones(info.fingerprint, rig):
-        return False
-    if hasSomeBones(info.illegal, rig):
-        return False
+    return matchBoneNames(rig.data.bones.keys(), info, scn)
+
+
+def matchBoneNames(bnames, info, scn):
+    bnames = set(bnames)
+    for bname in info.fingerprint:
+        if bname not in bnames:
+            return False
+    for bname in info.illegal:
+        if bname in bnames:
+            return False
     for bname,mhx in info.bones:
         if bname in info.optional:
             continue
         if (mhx[0:2] == "f_" and not scn.McpIncludeFingers):
             continue
-        elif bname not in rig.data.bones.keys():
+        elif bname not in bnames:
             if scn.McpVerbose:
                 print("Missing bone:", bname)
             return False
@@ -0,0 +1,251 @@
+#
+#   Regression tests for mcp_kernels.curves.
+#   Run with pytest from the add-on folder. Blender is not needed.
+#
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mcp_kernels import curves, kinematics
+
+
+def randomWalk(rng, n, k=None, scale=1.0):
+    shape = (n,) if k is None else (n, k)
+    return np.cumsum(rng.normal(size=shape)*scale, axis=0)
+
+#
+#   Reference Ramer-Douglas-Peucker, recursive and one point at a time.
+#
+
+def referenceRDP(xs, ys, maxErr):
+    keep = np.zeros(len(xs), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    def split(n0, n1):
+        if n1 - n0 < 2:
+            return
+        t = (xs[n0+1:n1] - xs[n0]) / (xs[n1] - xs[n0])
+        errs = np.abs(ys[n0+1:n1] - (ys[n0] + t*(ys[n1] - ys[n0])))
+        worst = np.argmax(errs)
+        if errs[worst] > maxErr:
+            keep[n0+1+worst] = True
+            split(n0, n0+1+worst)
+            split(n0+1+worst, n1)
+
+    split(0, len(xs)-1)
+    return keep
+
+#
+#   simplifyPoints
+#
+
+@pytest.mark.parametrize("seed", range(20))
+def test_simplifyPoints_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(3, 400))
+    xs = np.cumsum(rng.uniform(0.5, 2, n))
+    ys = randomWalk(rng, n)
+    maxErr = rng.uniform(0.05, 2)
+    keep = curves.simplifyPoints(xs, ys, maxErr)
+    assert (keep == referenceRDP(xs, ys, maxErr)).all()
+
+
+def test_simplifyPoints_keeps_line_ends():
+    xs = np.arange(50, dtype=float)
+    keep = curves.simplifyPoints(xs, 3*xs + 1, 0.01)
+    assert np.flatnonzero(keep).tolist() == [0, 49]
+
+
+def interpolateKeys(xs, ys, keep):
+    return np.array([np.interp(xs, xs[keep], y[keep]) for y in ys.T]).T
+
+
+def getRotationAngles(mats0, mats1):
+    traces = np.einsum("nij,nij->n", mats0, mats1)
+    return np.arccos(np.clip((traces-1)/2, -1, 1))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_simplifyPoints_location_bound(seed):
+    rng = np.random.default_rng(seed)
+    xs = np.arange(300, dtype=float)
+    ys = randomWalk(rng, 300, 3, 0.1)
+    keep = curves.simplifyPoints(xs, ys, 0.2, 'location')
+    errs = np.linalg.norm(ys - interpolateKeys(xs, ys, keep), axis=1)
+    assert errs.max() <= 0.2
+    assert keep.sum() < 300
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_simplifyPoints_quaternion_bound(seed):
+    rng = np.random.default_rng(seed)
+    xs = np.arange(300, dtype=float)
+    quats = randomWalk(rng, 300, 4, 0.02) + (1, 0, 0, 0)
+    quats /= np.linalg.norm(quats, axis=1)[:,None]
+    keep = curves.simplifyPoints(xs, quats, 0.05, 'rotation_quaternion')
+    yi = interpolateKeys(xs, quats, keep)
+    yi /= np.linalg.norm(yi, axis=1)[:,None]
+    angles = 2*np.arccos(np.minimum(np.abs(np.sum(quats*yi, axis=1)), 1))
+    assert angles.max() <= 0.05 + 1e-9
+    assert keep.sum() < 300
+
+
+@pytest.mark.parametrize("order", ["XYZ", "ZXY"])
+def test_simplifyPoints_euler_bound(order):
+    rng = np.random.default_rng(0)
+    xs = np.arange(300, dtype=float)
+    eulers = randomWalk(rng, 300, 3, 0.02)
+    keep = curves.simplifyPoints(xs, eulers, 0.05, 'rotation_euler', order)
+    mats = kinematics.eulersToMatrices(eulers, order)
+    mati = kinematics.eulersToMatrices(interpolateKeys(xs, eulers, keep), order)
+    assert getRotationAngles(mats, mati).max() <= 0.05 + 1e-9
+    assert keep.sum() < 300
+
+
+def test_simplifyPoints_channel_shares_keys():
+    xs = np.arange(50, dtype=float)
+    ys = np.zeros((50, 3))
+    ys[:,0] = xs
+    ys[25,2] = 1
+    keep = curves.simplifyPoints(xs, ys, 0.1, 'location')
+    assert np.flatnonzero(keep).tolist() == [0, 24, 25, 26, 49]
+
+#
+#   KeyReducer
+#
+
+def reduceInBlocks(reducer, xs, ys, blockSize):
+    for first in range(0, len(xs), blockSize):
+        reducer.add(xs[first:first+blockSize], ys[first:first+blockSize])
+    return reducer.finish()
+
+
+def test_KeyReducer_tent_is_lossless():
+    xs = np.arange(20, dtype=float)
+    ys = 10 - np.abs(xs - 10)
+    for blockSize in [1, 3, 7, 20]:
+        keyXs,keyYs = reduceInBlocks(curves.KeyReducer(0.001), xs, ys, blockSize)
+        assert keyXs.tolist() == [0, 10, 19]
+        assert keyYs.tolist() == [0, 10, 1]
+
+
+@pytest.mark.parametrize("blockSize", [1, 10, 97])
+def test_KeyReducer_location_bound(blockSize):
+    rng = np.random.default_rng(blockSize)
+    xs = np.arange(500, dtype=float)
+    ys = randomWalk(rng, 500, 3, 0.1)
+    keyXs,keyYs = reduceInBlocks(curves.KeyReducer(0.2, 'location', maxWindow=100), xs, ys, blockSize)
+    assert keyXs[0] == 0 and keyXs[-1] == 499
+    keep = np.isin(xs, keyXs)
+    assert np.array_equal(ys[keep], keyYs)
+    errs = np.linalg.norm(ys - interpolateKeys(xs, ys, keep), axis=1)
+    assert errs.max() <= 0.2
+    assert len(keyXs) < 500
+
+
+@pytest.mark.parametrize("blockSize", [1, 10, 97])
+def test_KeyReducer_rotation_bound(blockSize):
+    rng = np.random.default_rng(blockSize)
+    xs = np.arange(500, dtype=float)
+    eulers = randomWalk(rng, 500, 3, 0.02)
+    reducer = curves.KeyReducer(0.05, 'rotation_euler', 'ZXY')
+    keyXs,keyYs = reduceInBlocks(reducer, xs, eulers, blockSize)
+    keep = np.isin(xs, keyXs)
+    mats = kinematics.eulersToMatrices(eulers, 'ZXY')
+    mati = kinematics.eulersToMatrices(interpolateKeys(xs, eulers, keep), 'ZXY')
+    assert getRotationAngles(mats, mati).max() <= 0.05 + 1e-9
+    assert len(keyXs) < 500
+
+#
+#   fitBezierPoints
+#
+
+def evalHermite(xs, keep, ys, slopes):
+    kept = np.flatnonzero(keep)
+    values = ys.reshape((len(xs), -1))
+    slopes = slopes.reshape((len(kept), -1))
+    yi = np.empty(values.shape)
+    for s,(n0,n1) in enumerate(zip(kept[:-1], kept[1:])):
+        h = xs[n1] - xs[n0]
+        t = ((xs[n0:n1+1] - xs[n0])/h)[:,None]
+        yi[n0:n1+1] = ((2*t**3 - 3*t**2 + 1)*values[n0] + (t**3 - 2*t**2 + t)*h*slopes[s] +
+                       (3*t**2 - 2*t**3)*values[n1] + (t**3 - t**2)*h*slopes[s+1])
+    return yi.reshape(ys.shape)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_fitBezierPoints_bound(seed):
+    rng = np.random.default_rng(seed)
+    xs = np.cumsum(rng.uniform(0.5, 2, 300))
+    ys = np.sin(xs/10) + randomWalk(rng, 300, scale=0.01)
+    keep,slopes = curves.fitBezierPoints(xs, ys, 0.05)
+    assert slopes.shape == (keep.sum(),)
+    assert np.abs(ys - evalHermite(xs, keep, ys, slopes)).max() <= 0.05
+    assert keep.sum() < curves.simplifyPoints(xs, ys, 0.05).sum()
+
+
+def test_fitBezierPoints_location_bound():
+    rng = np.random.default_rng(0)
+    xs = np.arange(300, dtype=float)
+    ys = randomWalk(rng, 300, 3, 0.1)
+    keep,slopes = curves.fitBezierPoints(xs, ys, 0.2, 'location')
+    assert slopes.shape == (keep.sum(), 3)
+    errs = np.linalg.norm(ys - evalHermite(xs, keep, ys, slopes), axis=1)
+    assert errs.max() <= 0.2
+
+
+def test_fitBezierPoints_cubic_needs_two_keys():
+    xs = np.arange(11, dtype=float)
+    keep,slopes = curves.fitBezierPoints(xs, xs**3, 1e-3)
+    assert np.flatnonzero(keep).tolist() == [0, 10]
+    assert np.allclose(slopes, [0, 300], atol=1e-3)
+
+
+def test_solveTridiagonal():
+    rng = np.random.default_rng(0)
+    diag = rng.uniform(2, 3, 20)
+    off = rng.uniform(-1, 1, 19)
+    rhs = rng.normal(size=(20, 3))
+    mat = np.diag(diag) + np.diag(off, 1) + np.diag(off, -1)
+    assert np.allclose(curves.solveTridiagonal(diag, off, rhs), np.linalg.solve(mat, rhs))
+
+#
+#   mergeKeyPoints
+#
+
+def getKeyPoints(frames, values, interpolation, handleType):
+    n = len(frames)
+    co = np.stack((frames, values), axis=1).astype(np.float32)
+    return {
+        "co" : co,
+        "interpolation" : np.full(n, interpolation, dtype=np.int32),
+        "handle_left_type" : np.full(n, handleType, dtype=np.int32),
+        "handle_right_type" : np.full(n, handleType, dtype=np.int32),
+        "handle_left" : co - (1, 0.5),
+        "handle_right" : co + (1, 0.5),
+    }
+
+
+def test_mergeKeyPoints_keeps_existing_keys():
+    points = getKeyPoints(np.array([0, 10, 20]), np.array([0.0, 1.0, 2.0]), 0, 3)
+    merged = curves.mergeKeyPoints(points, np.array([10, 15]), np.array([4.0, 5.0]), 1, 4)
+    assert np.array_equal(merged["co"], [[0, 0], [10, 4], [15, 5], [20, 2]])
+    assert list(merged["interpolation"]) == [0, 0, 1, 0]
+    assert list(merged["handle_left_type"]) == [3, 3, 4, 3]
+    assert list(merged["handle_right_type"]) == [3, 3, 4, 3]
+    assert np.array_equal(merged["handle_left"][[0, 3]], points["handle_left"][[0, 2]])
+    assert np.array_equal(merged["handle_left"][1], [9, 3.5])
+    assert np.array_equal(merged["handle_right"][1], [11, 4.5])
+    assert np.array_equal(merged["handle_left"][2], [15, 5])
+    assert np.array_equal(merged["handle_right"][2], [15, 5])
+
+
+def test_mergeKeyPoints_empty_curve():
+    points = getKeyPoints(np.zeros(0), np.zeros(0), 0, 3)
+    merged = curves.mergeKeyPoints(points, np.array([1, 2]), np.array([3.0, 4.0]), 1, 4)
+    assert np.array_equal(merged["co"], [[1, 3], [2, 4]])
+    assert list(merged["interpolation"]) == [1, 1]
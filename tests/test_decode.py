@@ -0,0 +1,195 @@
+#
+#   Regression tests for mcp_kernels.decode.
+#   Run with pytest from the add-on folder. Blender is not needed.
+#
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mcp_kernels import decode, kinematics, motion
+
+Header = """HIERARCHY
+ROOT Hips
+{
+  OFFSET 0 0 0
+  CHANNELS 6 Xposition Yposition Zposition Zrotation Xrotation Yrotation
+  JOINT Chest
+  {
+    OFFSET 0 1 0
+    CHANNELS 3 Zrotation Xrotation Yrotation
+    End Site
+    {
+      OFFSET 0 1 0
+    }
+  }
+}
+MOTION
+Frames: %d
+Frame Time: %s
+"""
+
+RotIndices = [('Z', 1), ('X', 1), ('Y', 1)]
+
+
+def writeBvh(path, rows, frameTime="0.033333", nFrames=None):
+    with open(path, "w") as fp:
+        fp.write(Header % ((nFrames or len(rows)), frameTime))
+        for row in rows:
+            fp.write(" ".join(["%g" % x for x in row]) + "\n")
+    return str(path)
+
+
+def getRows(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.round(rng.uniform(-90, 90, (n, 9)), 3)
+
+
+def getRotation(seed):
+    rng = np.random.default_rng(seed)
+    q,r = np.linalg.qr(rng.normal(size=(3,3)))
+    return q * np.sign(np.linalg.det(q))
+
+
+def getPlan():
+    mat = getRotation(1)
+    hips = ((np.arange(3), np.array([2, 0, 1]), np.array([1.0, -1.0, 1.0]), mat, np.array([0.5, 1, 2])),
+            (3, RotIndices, getRotation(2), getRotation(3)))
+    chest = (None, (6, RotIndices, None, None))
+    return [("Hips",) + hips, ("Chest",) + chest]
+
+
+def test_decodeChannels_matches_reference():
+    data = getRows(50)
+    plan = getPlan()
+    bones = decode.decodeChannels(data, plan)
+    assert list(bones.keys()) == ["Hips", "Chest"]
+    locs,quats = bones["Hips"]
+    columns,axes,signs,mat,head = plan[0][1]
+    for row,loc in zip(data, locs):
+        vec = np.zeros(3)
+        vec[2], vec[0], vec[1] = row[0], -row[1], row[2]
+        assert np.allclose(loc, mat @ vec - head)
+    pre,post = plan[0][2][2:]
+    assert np.allclose(quats, kinematics.eulerChannelsToQuaternions(data[:,3:6], RotIndices, pre, post))
+    locs,quats = bones["Chest"]
+    assert locs is None
+    assert np.allclose(quats, kinematics.eulerChannelsToQuaternions(data[:,6:9], RotIndices))
+
+
+def test_decodeMotionFile_matches_main_thread_decoding(tmp_path):
+    path = writeBvh(tmp_path/"take.bvh", getRows(200))
+    settings = (30, True, 1, 0, 1000, False)
+    result = decode.decodeMotionFile(path, getPlan(), settings)
+    parsed = motion.parseMotionFile(path, *settings)
+    assert np.array_equal(result["data"], parsed["data"])
+    bones = decode.decodeMotion(parsed, getPlan(), 30, False)
+    for bname,(locs, quats) in bones.items():
+        assert np.array_equal(result["bones"][bname][1], quats)
+
+
+def test_decodeMotionFile_resamples(tmp_path):
+    path = writeBvh(tmp_path/"take.bvh", getRows(200), "0.008333")
+    settings = (30, True, 1, 0, 1000, True)
+    result = decode.decodeMotionFile(path, getPlan(), settings)
+    times = decode.getSceneTimes(result, 30)
+    assert len(times) == 51
+    for bname,(locs, quats) in result["bones"].items():
+        assert len(quats) == len(times)
+        assert np.allclose(np.linalg.norm(quats, axis=1), 1)
+    locs = result["bones"]["Hips"][0]
+    full = decode.decodeChannels(result["data"], getPlan())["Hips"][0]
+    assert np.allclose(locs, full[times.astype(int)])
+
+
+def test_decodeMotionFile_without_plan_only_parses(tmp_path):
+    path = writeBvh(tmp_path/"take.bvh", getRows(20))
+    result = decode.decodeMotionFile(path, None, (30, True, 1, 0, 1000, False))
+    assert "bones" not in result
+    assert len(result["data"]) == 20
+
+
+def test_decodeMotionFile_uses_cache(tmp_path):
+    path = writeBvh(tmp_path/"take.bvh", getRows(20))
+    settings = (30, True, 1, 0, 1000, False)
+    folder = str(tmp_path/"cache")
+    cache = motion.MotionCache(folder, 1<<30)
+    parsed = motion.parseMotionFile(path, *settings)
+    cached = dict(parsed)
+    cached["data"] = parsed["data"] + 1
+    cache.save("abc", cached)
+    result = decode.decodeMotionFile(path, getPlan(), settings, (folder, "abc"))
+    assert np.array_equal(result["data"], cached["data"])
+    os.remove(cache.getPath("abc"))
+    result = decode.decodeMotionFile(path, getPlan(), settings, (folder, "abc"))
+    assert np.array_equal(result["data"], parsed["data"])
+
+
+def readStream(stream):
+    blocks = list(stream.iterBlocks())
+    starts = [start for start,bones in blocks]
+    assert starts == sorted(starts)
+    bones = {}
+    for start,block in blocks:
+        assert start == decode.countKeys(bones)
+        bones = decode.joinBones(bones, block)
+    assert decode.countKeys(bones) == stream.nKeys
+    return bones
+
+
+def assertSameBones(bones1, bones2):
+    assert list(bones1.keys()) == list(bones2.keys())
+    for bname,(locs, quats) in bones1.items():
+        locs2,quats2 = bones2[bname]
+        assert (locs is None) == (locs2 is None)
+        if locs is not None:
+            assert np.allclose(locs, locs2)
+        assert np.allclose(quats, quats2)
+
+
+@pytest.mark.parametrize("frameTime,settings,blockSize", [
+    ("0.033333", (30, True, 1, 0, 1000, False), 64),
+    ("0.033333", (30, True, 1, 7, 300, False), 50),
+    ("0.008333", (30, True, 1, 3, 1000, False), 37),
+    ("0.008333", (30, False, 3, 0, 1000, False), 1000),
+    ("0.008333", (30, True, 1, 0, 1000, True), 64),
+    ("0.008333", (30, True, 1, 11, 100, True), 25),
+    ("0.033367", (30, True, 1, 0, 1000, True), 10),
+])
+def test_MotionStream_matches_decodeMotion(tmp_path, frameTime, settings, blockSize):
+    path = writeBvh(tmp_path/"take.bvh", getRows(500), frameTime)
+    cache = motion.MotionCache(str(tmp_path/"cache"), 1<<30)
+    parsed = motion.parseMotionFile(path, *settings)
+    bones = decode.decodeMotion(parsed, getPlan(), settings[0], settings[-1])
+    for n in range(2):
+        stream = decode.MotionStream(path, getPlan(), settings, cache, "abc", {"extra": np.arange(3)}, blockSize)
+        assertSameBones(readStream(stream), bones)
+        assert cache.contains("abc")
+    cached = cache.load("abc")
+    assert np.array_equal(cached["data"], parsed["data"])
+    assert np.array_equal(cached["extra"], np.arange(3))
+    assert int(cached["first"]) == parsed["first"]
+
+
+def test_MotionStream_rejects_short_file(tmp_path):
+    path = writeBvh(tmp_path/"take.bvh", getRows(100), nFrames=120)
+    cache = motion.MotionCache(str(tmp_path/"cache"), 1<<30)
+    stream = decode.MotionStream(path, getPlan(), (30, True, 1, 0, 1000, False), cache, "abc", None, 32)
+    with pytest.raises(ValueError, match="fewer than 120 frames"):
+        readStream(stream)
+    assert not cache.contains("abc")
+    assert os.listdir(cache.folder) == []
+
+
+def test_MotionStream_closed_early_is_not_cached(tmp_path):
+    path = writeBvh(tmp_path/"take.bvh", getRows(100))
+    cache = motion.MotionCache(str(tmp_path/"cache"), 1<<30)
+    stream = decode.MotionStream(path, getPlan(), (30, True, 1, 0, 1000, False), cache, "abc", None, 32)
+    blocks = stream.iterBlocks()
+    next(blocks)
+    blocks.close()
+    assert not cache.contains("abc")
+    assert os.listdir(cache.folder) == []
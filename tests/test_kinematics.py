@@ -0,0 +1,293 @@
+#
+#   Regression tests for mcp_kernels.kinematics.
+#   Run with pytest from the add-on folder. Blender is not needed.
+#
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mcp_kernels import kinematics
+
+
+def getRotation(seed):
+    rng = np.random.default_rng(seed)
+    q,r = np.linalg.qr(rng.normal(size=(3,3)))
+    return q * np.sign(np.linalg.det(q))
+
+
+def rotationMatrix(angle, axis):
+    c,s = np.cos(angle), np.sin(angle)
+    if axis == 'X':
+        return np.array(((1, 0, 0), (0, c, -s), (0, s, c)))
+    elif axis == 'Y':
+        return np.array(((c, 0, s), (0, 1, 0), (-s, 0, c)))
+    else:
+        return np.array(((c, -s, 0), (s, c, 0), (0, 0, 1)))
+
+
+def quaternionMatrix(quat):
+    w,x,y,z = quat
+    return np.array((
+        (1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)),
+        (2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)),
+        (2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y))))
+
+#
+#   eulerChannelsToQuaternions
+#
+
+@pytest.mark.parametrize("indices", [
+    [('Z', 1), ('X', 1), ('Y', 1)],
+    [('X', 1), ('Y', 1), ('Z', 1)],
+    [('X', 1), ('Z', 1), ('Y', -1)],
+    [('Y', 1), ('Z', -1), ('X', 1)],
+])
+@pytest.mark.parametrize("usePrePost", [False, True])
+def test_eulerChannelsToQuaternions_matches_reference(indices, usePrePost):
+    rng = np.random.default_rng(0)
+    values = rng.uniform(-180, 180, (200, 3))
+    values[:10] = [0, 0, 0]
+    values[10:20] = [180, 0, 0]
+    values[20:30] = [90, 90, 0]
+    pre = post = None
+    if usePrePost:
+        pre,post = getRotation(1), getRotation(2)
+    quats = kinematics.eulerChannelsToQuaternions(values, indices, pre, post)
+    assert quats.shape == (200, 4)
+    assert np.allclose(np.linalg.norm(quats, axis=1), 1)
+    for row,quat in zip(values, quats):
+        mat = np.identity(3)
+        for angle,(axis, sign) in zip(row, indices):
+            mat = mat @ rotationMatrix(sign*angle*kinematics.D, axis)
+        if usePrePost:
+            mat = pre @ mat @ post
+        assert np.allclose(quaternionMatrix(quat), mat)
+        if np.trace(mat) > 0:
+            assert quat[0] > 0
+
+#
+#   Resampling
+#
+
+def test_resample_same_rate_copies_frames():
+    times = kinematics.getResampleTimes(1, 1000, 1/(30*0.033333))
+    assert np.array_equal(times, np.arange(1000))
+
+
+@pytest.mark.parametrize("fps,frameTime", [(30, 0.008333), (30, 0.0083333), (30, 0.016667), (24, 0.041667), (60, 0.008333)])
+def test_resample_rounded_frame_time_is_snapped(fps, frameTime):
+    step = 1/(fps*frameTime)
+    assert kinematics.snapResampleStep(step) == round(step)
+
+
+def test_resample_integer_ratio_keeps_last_frame():
+    times = kinematics.getResampleTimes(4, 4000, 1/(30*0.0083333))
+    assert np.array_equal(times, np.arange(0, 3997, 4))
+
+
+def test_resample_ntsc_is_not_snapped():
+    step = 1/((30/1.001)*(1/30))
+    assert kinematics.snapResampleStep(step) == step
+    times = kinematics.getResampleTimes(0, 1000, step)
+    assert len(times) == 1000
+    assert np.allclose(np.diff(times), step)
+
+
+def test_resample_quaternions_stay_normalized():
+    rng = np.random.default_rng(0)
+    quats = rng.normal(size=(20, 4))
+    quats /= np.linalg.norm(quats, axis=1)[:,None]
+    times = np.linspace(0, 19, 77)
+    res = kinematics.resampleQuaternions(quats, times)
+    assert np.allclose(np.linalg.norm(res, axis=1), 1)
+    assert np.allclose(np.abs(np.sum(res[::4]*quats, axis=1)), 1)
+
+#
+#   Source FK channels
+#
+
+@pytest.mark.parametrize("order", sorted(kinematics.EulerOrders.keys()))
+def test_eulersToMatrices_matches_reference(order):
+    rng = np.random.default_rng(0)
+    eulers = rng.uniform(-np.pi, np.pi, (50, 3))
+    mats = kinematics.eulersToMatrices(eulers, order)
+    for euler,mat in zip(eulers, mats):
+        ref = np.identity(3)
+        for axis in order:
+            ref = rotationMatrix(euler["XYZ".index(axis)], axis) @ ref
+        assert np.allclose(mat, ref)
+
+
+def test_axisAnglesToMatrices_matches_reference():
+    rng = np.random.default_rng(0)
+    axisAngles = np.empty((50, 4))
+    axisAngles[:,0] = rng.uniform(-2*np.pi, 2*np.pi, 50)
+    axisAngles[:,1:] = rng.normal(size=(50, 3))*rng.uniform(0.1, 10, (50, 1))
+    axisAngles[0] = (1.0, 0, 0, 0)
+    mats = kinematics.axisAnglesToMatrices(axisAngles)
+    assert np.allclose(mats[0], np.identity(3))
+    for (angle, x, y, z),mat in zip(axisAngles[1:], mats[1:]):
+        axis = np.array((x, y, z))/np.linalg.norm((x, y, z))
+        cross = np.array(((0, -axis[2], axis[1]), (axis[2], 0, -axis[0]), (-axis[1], axis[0], 0)))
+        ref = np.identity(3) + np.sin(angle)*cross + (1 - np.cos(angle))*(cross @ cross)
+        assert np.allclose(mat, ref)
+
+
+def test_quaternionsToMatrices_normalizes():
+    rng = np.random.default_rng(0)
+    quats = rng.normal(size=(50, 4))
+    quats[0] = 0
+    mats = kinematics.quaternionsToMatrices(quats)
+    assert np.allclose(mats[0], np.identity(3))
+    for quat,mat in zip(quats[1:], mats[1:]):
+        assert np.allclose(mat, quaternionMatrix(quat/np.linalg.norm(quat)))
+
+
+def test_composeMatrices():
+    rng = np.random.default_rng(0)
+    locs = rng.normal(size=(20, 3))
+    rots = np.array([getRotation(seed) for seed in range(20)])
+    scales = rng.uniform(0.5, 2, (20, 3))
+    mats = kinematics.composeMatrices(locs, rots, scales)
+    for loc,rot,scale,mat in zip(locs, rots, scales, mats):
+        ref = np.identity(4)
+        ref[:3,:3] = rot @ np.diag(scale)
+        ref[:3,3] = loc
+        assert np.allclose(mat, ref)
+
+#
+#   Target channels, as written by KeyBuffer
+#
+
+def getTargetMatrices(n):
+    mats = np.tile(np.identity(4), (n, 1, 1))
+    for seed in range(n):
+        mats[seed,:3,:3] = getRotation(seed)
+    return mats
+
+
+@pytest.mark.parametrize("order", sorted(kinematics.EulerOrders.keys()))
+def test_matricesToEulers_round_trip(order):
+    mats = getTargetMatrices(50)
+    eulers = kinematics.matricesToEulers(mats, order)
+    assert np.allclose(kinematics.eulersToMatrices(eulers, order), mats[:,:3,:3])
+
+
+def test_matricesToAxisAngles_round_trip():
+    mats = getTargetMatrices(50)
+    axisAngles = kinematics.matricesToAxisAngles(mats)
+    assert np.allclose(kinematics.axisAnglesToMatrices(axisAngles), mats[:,:3,:3])
+
+
+def test_matricesToQuaternions_round_trip():
+    mats = getTargetMatrices(50)
+    quats = kinematics.matricesToQuaternions(mats)
+    assert np.allclose(np.linalg.norm(quats, axis=1), 1)
+    assert np.allclose(kinematics.quaternionsToMatrices(quats), mats[:,:3,:3])
+
+#
+#   Locks and rotation limits
+#
+
+def eulerMatrix(euler, order):
+    mat = np.identity(3)
+    for axis in order:
+        mat = rotationMatrix(euler["XYZ".index(axis)], axis) @ mat
+    return mat
+
+
+LimitX = ((True, False, False), (-0.5, 0, 0), (0.3, 0, 0))
+LimitYZ = ((False, True, True), (0, -0.2, -1.0), (0, 0.4, 0.1))
+
+@pytest.mark.parametrize("order", ["XYZ", "YZX", "ZXY"])
+@pytest.mark.parametrize("locks,limits", [
+    ([], []),
+    ([1], []),
+    ([], [LimitX]),
+    ([2], [LimitYZ]),
+    ([0], [LimitX, LimitYZ]),
+])
+def test_correctMatricesForLocks_matches_reference(order, locks, limits):
+    rng = np.random.default_rng(0)
+    eulers = rng.uniform(-1.2, 1.2, (50, 3))
+    mats = np.tile(np.identity(4), (50, 1, 1))
+    mats[:,:3,3] = rng.normal(size=(50, 3))
+    for euler,mat in zip(eulers, mats):
+        mat[:3,:3] = eulerMatrix(euler, order)
+    result = kinematics.correctMatricesForLocks(mats, order, locks, limits)
+    assert np.allclose(result[:,:,3], mats[:,:,3])
+    assert np.allclose(result[:,3,:3], 0)
+    for euler,mat in zip(eulers, result):
+        euler = euler.copy()
+        euler[locks] = 0
+        for uses,mins,maxs in limits:
+            for n in range(3):
+                if uses[n]:
+                    euler[n] = min(maxs[n], max(mins[n], euler[n]))
+        assert np.allclose(mat[:3,:3], eulerMatrix(euler, order))
+
+#
+#   retargetMatrices, one frame at a time as CBoneAnim.retarget
+#
+
+def getPoseMatrices(n, seed):
+    rng = np.random.default_rng(seed)
+    mats = np.tile(np.identity(4), (n, 1, 1))
+    for k in range(n):
+        mats[k,:3,:3] = getRotation(seed*n + k)
+    mats[:,:3,3] = rng.normal(size=(n, 3))
+    return mats
+
+
+def referenceRetarget(src, parentTrg, aMat, bMat, locScale, order, locks, limits):
+    keys = []
+    trgs = []
+    for n,srcMat in enumerate(src):
+        trg = srcMat @ aMat
+        trg[:,3] = srcMat[:,3]
+        trg[:3,3] *= locScale
+        if parentTrg is None:
+            mat1 = trg
+        else:
+            mat1 = np.linalg.inv(parentTrg[n]) @ trg
+        mat3 = kinematics.correctMatricesForLocks((bMat @ mat1)[None], order, locks, limits)[0]
+        mat1 = np.linalg.inv(bMat) @ mat3
+        if parentTrg is None:
+            trgs.append(mat1)
+        else:
+            trgs.append(parentTrg[n] @ mat1)
+        keys.append(mat3)
+    return np.array(keys), np.array(trgs)
+
+
+@pytest.mark.parametrize("locks,limits", [([], []), ([1], [LimitX])])
+@pytest.mark.parametrize("locScale", [1.0, 0.5])
+def test_retargetMatrices_matches_reference(locks, limits, locScale):
+    src = getPoseMatrices(30, 1)
+    parentTrg = getPoseMatrices(30, 2)
+    aMat = getPoseMatrices(1, 3)[0]
+    bMat = getPoseMatrices(1, 4)[0]
+    for parent in [None, parentTrg]:
+        keys,trgs = kinematics.retargetMatrices(src, parent, aMat, bMat, locScale, "XYZ", locks, limits)
+        refKeys,refTrgs = referenceRetarget(src, parent, aMat, bMat, locScale, "XYZ", locks, limits)
+        assert np.allclose(keys, refKeys)
+        assert np.allclose(trgs, refTrgs)
+
+
+def test_retargetChunk_chains_parents():
+    srcPoses = {"hips" : getPoseMatrices(20, 1), "spine" : getPoseMatrices(20, 2)}
+    aMat = getPoseMatrices(1, 3)[0]
+    bMat = getPoseMatrices(1, 4)[0]
+    bones = [
+        ("hips", -1, aMat, bMat, 0.5, "XYZ", [], []),
+        ("spine", 0, bMat, aMat, 0.5, "ZXY", [0], []),
+    ]
+    (keys,) = kinematics.retargetChunk(srcPoses, [bones])
+    hipKeys,hipTrgs = referenceRetarget(srcPoses["hips"], None, aMat, bMat, 0.5, "XYZ", [], [])
+    spineKeys,spineTrgs = referenceRetarget(srcPoses["spine"], hipTrgs, bMat, aMat, 0.5, "ZXY", [0], [])
+    assert np.allclose(keys[0], hipKeys)
+    assert np.allclose(keys[1], spineKeys)
@@ -0,0 +1,298 @@
+#
+#   Regression tests for mcp_kernels.motion.
+#   Run with pytest from the add-on folder. Blender is not needed.
+#
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mcp_kernels import motion
+
+Header = """HIERARCHY
+ROOT Hips
+{
+  OFFSET 0 0 0
+  CHANNELS 6 Xposition Yposition Zposition Zrotation Xrotation Yrotation
+  JOINT Chest
+  {
+    OFFSET 0 1 0
+    CHANNELS 3 Zrotation Xrotation Yrotation
+    End Site
+    {
+      OFFSET 0 1 0
+    }
+  }
+}
+MOTION
+Frames: %d
+Frame Time: 0.033333
+"""
+
+NChannels = 9
+
+
+def writeBvh(path, rows, blank=""):
+    with open(path, "w") as fp:
+        fp.write(Header % len(rows))
+        for row in rows:
+            fp.write(" ".join(["%g" % x for x in row]) + "\n" + blank)
+    return str(path)
+
+
+def getRows(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.round(rng.uniform(-180, 180, (n, NChannels)), 3)
+
+
+def readFile(path, first, last, ssFactor=1, reader=motion.readMotion):
+    with open(path, "r") as fp:
+        nChannels,nFrames,frameTime = motion.readHeader(fp)
+        return reader(fp, nChannels, first, last, ssFactor)
+
+#
+#   readMotion
+#
+
+@pytest.mark.parametrize("first,last,ssFactor", [(0, 99, 1), (10, 60, 1), (0, 99, 3), (30, 500, 2), (50, 10, 1)])
+def test_readMotion_matches_line_loop(tmp_path, first, last, ssFactor):
+    path = writeBvh(tmp_path/"take.bvh", getRows(100))
+    data = readFile(path, first, last, ssFactor)
+    ref = readFile(path, first, last, ssFactor, motion.readMotionLines)
+    assert data.shape == ref.shape
+    assert np.array_equal(data, ref)
+
+
+def test_readMotion_skips_blank_lines(tmp_path):
+    rows = getRows(40)
+    path = writeBvh(tmp_path/"take.bvh", rows, blank=" \t\n\n")
+    assert np.array_equal(readFile(path, 0, 39), rows)
+    assert np.array_equal(readFile(path, 5, 20, 5), rows[5:21:5])
+
+
+@pytest.mark.parametrize("line", ["1 2 3 4 5 6 7 8", "1 2 3 4 5 6 7 8 9 10", "1 2 3 4 x 6 7 8 9"])
+def test_readMotion_rejects_bad_line(tmp_path, line):
+    path = writeBvh(tmp_path/"take.bvh", getRows(20))
+    with open(path, "r") as fp:
+        lines = fp.readlines()
+    lines[-8] = line + "\n"
+    with open(path, "w") as fp:
+        fp.writelines(lines)
+    with pytest.raises(ValueError, match="Frame 12"):
+        readFile(path, 0, 19)
+    assert np.array_equal(readFile(path, 13, 19), getRows(20)[13:])
+
+
+def test_parseMotionFile_window(tmp_path):
+    rows = getRows(200)
+    path = writeBvh(tmp_path/"take.bvh", rows)
+    result = motion.parseMotionFile(path, 30, False, 2, 10, 40)
+    assert result["ssFactor"] == 2
+    assert result["first"] == 20
+    assert result["nFrames"] == 200
+    assert np.array_equal(result["data"], rows[20:81:2])
+
+#
+#   FrameIndex
+#
+
+@pytest.mark.parametrize("step,chunkSize", [(256, 1<<24), (3, 256), (1, 300)])
+def test_FrameIndex_matches_readMotion(tmp_path, step, chunkSize):
+    rows = getRows(150)
+    path = writeBvh(tmp_path/"take.bvh", rows, blank="\n  \n")
+    index = motion.FrameIndex(path, step, chunkSize)
+    for first,last,ssFactor in [(0, 149, 1), (7, 8, 1), (40, 120, 4), (149, 149, 1), (100, 400, 2), (20, 10, 1)]:
+        data = index.readRange(NChannels, first, last, ssFactor)
+        assert np.array_equal(data, rows[first:last+1:ssFactor])
+
+
+def test_FrameIndex_without_final_newline(tmp_path):
+    rows = getRows(10)
+    path = writeBvh(tmp_path/"take.bvh", rows)
+    with open(path, "r") as fp:
+        text = fp.read()
+    with open(path, "w") as fp:
+        fp.write(text.rstrip("\n"))
+    index = motion.FrameIndex(path, 4, 256)
+    assert np.array_equal(index.readRange(NChannels, 5, 9, 1), rows[5:])
+
+
+def test_FrameIndex_rejects_bad_line_in_range(tmp_path):
+    rows = getRows(100)
+    path = writeBvh(tmp_path/"take.bvh", rows)
+    with open(path, "r") as fp:
+        lines = fp.readlines()
+    lines[-40] = " ".join(["1"]*(NChannels-1)) + "\n"
+    with open(path, "w") as fp:
+        fp.writelines(lines)
+    index = motion.FrameIndex(path, 8, 256)
+    with pytest.raises(ValueError, match="Frame 60"):
+        index.readRange(NChannels, 50, 70, 1)
+    assert np.array_equal(index.readRange(NChannels, 61, 99, 1), rows[61:])
+    assert np.array_equal(index.readRange(NChannels, 10, 59, 1), rows[10:60])
+
+
+def test_readMotionRange_rebuilds_index_for_changed_file(tmp_path):
+    path = writeBvh(tmp_path/"take.bvh", getRows(50, seed=1))
+    assert np.array_equal(motion.readMotionRange(path, NChannels, 10, 20, 1), getRows(50, seed=1)[10:21])
+    rows = getRows(80, seed=2)
+    writeBvh(tmp_path/"take.bvh", rows, blank="\n")
+    os.utime(path, (1, 1))
+    assert np.array_equal(motion.readMotionRange(path, NChannels, 10, 70, 1), rows[10:71])
+
+@pytest.mark.parametrize("first,last,ssFactor,blockSize", [(0, 299, 1, 64), (5, 250, 3, 7), (10, 20, 1, 1000), (0, 400, 2, 50)])
+def test_iterMotionBlocks_matches_readMotion(tmp_path, first, last, ssFactor, blockSize):
+    rows = getRows(300)
+    path = writeBvh(tmp_path/"take.bvh", rows, blank="\n")
+    blocks = list(motion.iterMotionBlocks(path, NChannels, first, last, ssFactor, blockSize))
+    assert all([len(data) <= blockSize for data in blocks])
+    assert np.array_equal(np.concatenate(blocks), rows[first:last+1:ssFactor])
+
+#
+#   MotionCache
+#
+
+def getStruct(seed):
+    return {
+        "names" : np.array(["Hips", "Chest"]),
+        "parents" : np.array([-1, 0]),
+        "data" : getRows(1000, seed),
+        "first" : 3,
+        "frameTime" : 0.0083333,
+    }
+
+
+def getFolderSize(folder):
+    return sum([os.path.getsize(os.path.join(folder, fname)) for fname in os.listdir(folder)])
+
+
+def test_MotionCache_round_trip(tmp_path):
+    cache = motion.MotionCache(str(tmp_path/"cache"), 1<<30)
+    struct = getStruct(0)
+    assert cache.load("abc") is None
+    assert not cache.contains("abc")
+    cache.save("abc", struct)
+    assert cache.contains("abc")
+    loaded = cache.load("abc")
+    assert set(loaded.keys()) == set(struct.keys())
+    for key,value in struct.items():
+        assert np.array_equal(loaded[key], value)
+    assert loaded["names"].tolist() == ["Hips", "Chest"]
+
+
+def test_MotionCache_removes_bad_file(tmp_path):
+    cache = motion.MotionCache(str(tmp_path/"cache"), 1<<30)
+    cache.save("abc", getStruct(0))
+    with open(cache.getPath("abc"), "wb") as fp:
+        fp.write(b"not a zip file")
+    assert cache.load("abc") is None
+    assert not cache.contains("abc")
+
+
+def test_MotionCache_keys(tmp_path):
+    cache = motion.MotionCache(str(tmp_path/"cache"), 1<<30)
+    path = writeBvh(tmp_path/"take.bvh", getRows(10))
+    key = cache.getKey(path, (30, True))
+    assert cache.getKey(path, (30, True)) == key
+    assert cache.getKey(path, (24, True)) != key
+    os.utime(path, (1, 1))
+    assert cache.getKey(path, (30, True)) == key
+    writeBvh(tmp_path/"take.bvh", getRows(10, seed=1))
+    assert cache.getKey(path, (30, True)) != key
+
+
+def test_MotionCache_evicts_least_recently_used(tmp_path):
+    folder = str(tmp_path/"cache")
+    cache = motion.MotionCache(folder, 1<<30)
+    cache.save("a", getStruct(0))
+    cache.maxSize = int(2.5*getFolderSize(folder))
+    os.utime(cache.getPath("a"), (1, 1))
+    cache.save("b", getStruct(1))
+    os.utime(cache.getPath("b"), (2, 2))
+    cache.save("c", getStruct(2))
+    assert [cache.contains(key) for key in "abc"] == [False, True, True]
+    assert cache.load("b") is not None
+    os.utime(cache.getPath("c"), (3, 3))
+    cache.save("d", getStruct(3))
+    assert [cache.contains(key) for key in "bcd"] == [True, False, True]
+    assert getFolderSize(folder) <= cache.maxSize
+
+
+def test_MotionCache_writes_blocks(tmp_path):
+    cache = motion.MotionCache(str(tmp_path/"cache"), 1<<30)
+    struct = getStruct(0)
+    data = struct["data"]
+    writer = cache.openWriter("abc", data.shape)
+    for start in range(0, len(data), 300):
+        writer.write(data[start:start+300])
+    assert not cache.contains("abc")
+    writer.finish(struct)
+    loaded = cache.load("abc", useMmap=True)
+    assert isinstance(loaded["data"], np.memmap)
+    assert np.array_equal(loaded["data"], data)
+    assert loaded["names"].tolist() == ["Hips", "Chest"]
+
+
+def test_MotionCache_drops_incomplete_writes(tmp_path):
+    cache = motion.MotionCache(str(tmp_path/"cache"), 1<<30)
+    struct = getStruct(0)
+    writer = cache.openWriter("abc", struct["data"].shape)
+    writer.write(struct["data"][:10])
+    writer.finish(struct)
+    assert not cache.contains("abc")
+    writer = cache.openWriter("abc", struct["data"].shape)
+    writer.write(struct["data"][:10])
+    writer.close()
+    assert os.listdir(cache.folder) == []
+
+#
+#   scanHeader
+#
+
+def test_scanHeader(tmp_path):
+    path = writeBvh(tmp_path/"take.bvh", getRows(25))
+    header = motion.scanHeader(path)
+    assert header["joints"] == ["Hips", "Chest"]
+    assert header["parents"] == [-1, 0]
+    assert header["channels"] == [
+        ["Xposition", "Yposition", "Zposition", "Zrotation", "Xrotation", "Yrotation"],
+        ["Zrotation", "Xrotation", "Yrotation"]]
+    assert header["nFrames"] == 25
+    assert header["frameTime"] == pytest.approx(0.033333)
+
+
+def test_getTopologyHash(tmp_path):
+    path = writeBvh(tmp_path/"take.bvh", getRows(10))
+    key = motion.getTopologyHash(motion.scanHeader(path))
+    with open(path, "r") as fp:
+        text = fp.read()
+    variants = [
+        (text.replace("OFFSET 0 1 0", "OFFSET 0 2 0").replace("Frames: 10", "Frames: 9"), True),
+        (text.replace("Chest", "Spine"), False),
+        (text.replace("CHANNELS 3 Zrotation Xrotation", "CHANNELS 3 Xrotation Zrotation"), False),
+    ]
+    for n,(variant, same) in enumerate(variants):
+        path = str(tmp_path/("variant%d.bvh" % n))
+        with open(path, "w") as fp:
+            fp.write(variant)
+        assert (motion.getTopologyHash(motion.scanHeader(path)) == key) == same
+
+
+@pytest.mark.parametrize("old,new,error", [
+    ("HIERARCHY", "HIERARCHY\nMOTION", "No rig defined"),
+    ("ROOT Hips", "HIPS", "Joint Chest inside End Site"),
+    ("MOTION", "", "No MOTION block"),
+    ("  }\n}", "  }\n}\n}", "Unbalanced braces"),
+])
+def test_scanBvhFile_reports_errors(tmp_path, old, new, error):
+    path = writeBvh(tmp_path/"take.bvh", getRows(10))
+    with open(path, "r") as fp:
+        text = fp.read()
+    with open(path, "w") as fp:
+        fp.write(text.replace(old, new))
+    result = motion.scanBvhFile(path)
+    assert error in result["error"]
+    assert result["size"] == os.path.getsize(path)
@@ -29,6 +29,9 @@
 import bpy
 from bpy.props import *
 import math
+import os
+import sys
+import numpy as np
 from mathutils import *
 
 D = math.pi/180
@@ -170,7 +173,7 @@ def insertLocation(pb, mat, frame=None):
     if frame is None:
         frame = bpy.context.scene.frame_current
     pb.location = mat.to_translation()
-    pb.keyframe_insert("location", group=pb.name)
+    pb.keyframe_insert("location", frame=frame, group=pb.name)
 
 
 def insertRotation(pb, mat, frame=None):
@@ -186,6 +189,278 @@ def insertRotation(pb, mat, frame=None):
         pb.rotation_euler = mat.to_euler(pb.rotation_mode)
         pb.keyframe_insert("rotation_euler", frame=frame, group=pb.name)
 
+#
+#    Bulk keyframe writing.
+#    Creates all keyframes of an F-curve at once with foreach_set,
+#    instead of one keyframe_insert call per frame. When an F-curve
+#    shrinks, its keyframes are cleared and added again, since removing
+#    them is one call per keyframe. Older Blender versions have no
+#    clear, and then they are still removed one by one.
+#
+
+Interpolations = {'CONSTANT' : 0, 'LINEAR' : 1, 'BEZIER' : 2}
+
+def setKeyframeCount(fcu, n):
+    kps = fcu.keyframe_points
+    nOld = len(kps)
+    if n > nOld:
+        kps.add(n-nOld)
+    elif n < nOld:
+        if hasattr(kps, "clear"):
+            kps.clear()
+            kps.add(n)
+        else:
+            for m in range(nOld-n):
+                kps.remove(kps[-1], fast=True)
+
+
+def setFCurveKeys(fcu, frames, values, interpolation='LINEAR'):
+    n = len(frames)
+    setKeyframeCount(fcu, n)
+    co = np.empty(2*n, dtype=np.float32)
+    co[0::2] = frames
+    co[1::2] = values
+    kps = fcu.keyframe_points
+    kps.foreach_set("co", co)
+    kps.foreach_set("interpolation", np.full(n, Interpolations[interpolation], dtype=np.int32))
+    fcu.update()
+
+
+#
+#    getFCurvePoints(fcu):
+#    setFCurvePoints(fcu, points):
+#    All keyframe data of an F-curve as a dict of arrays, one row per
+#    keyframe, and back. setFCurvePoints resizes the F-curve.
+#
+
+HandleTypes = {'FREE' : 0, 'AUTO' : 1, 'VECTOR' : 2, 'ALIGNED' : 3, 'AUTO_CLAMPED' : 4}
+
+KeyframeAttributes = [
+    ("co", 2, np.float32),
+    ("interpolation", 1, np.int32),
+    ("handle_left_type", 1, np.int32),
+    ("handle_right_type", 1, np.int32),
+    ("handle_left", 2, np.float32),
+    ("handle_right", 2, np.float32),
+]
+
+def getFCurvePoints(fcu):
+    kps = fcu.keyframe_points
+    n = len(kps)
+    points = {}
+    for attr,size,dtype in KeyframeAttributes:
+        values = np.empty(n*size, dtype=dtype)
+        kps.foreach_get(attr, values)
+        if size > 1:
+            values = values.reshape((n, size))
+        points[attr] = values
+    return points
+
+
+def setFCurvePoints(fcu, points):
+    setKeyframeCount(fcu, len(points["co"]))
+    kps = fcu.keyframe_points
+    for attr,size,dtype in KeyframeAttributes:
+        kps.foreach_set(attr, np.ascontiguousarray(points[attr], dtype=dtype).ravel())
+    fcu.update()
+
+
+def setBoneKeys(act, bname, channel, frames, values):
+    path = 'pose.bones["%s"].%s' % (bname, channel)
+    for index in range(values.shape[1]):
+        fcu = act.fcurves.find(path, index=index)
+        if fcu is None:
+            fcu = act.fcurves.new(path, index=index, action_group=bname)
+        setFCurveKeys(fcu, frames, values[:,index])
+
+
+#
+#    getFCurveValues(fcu, frames):
+#    Evaluate an F-curve at many frames. Linear curves without modifiers
+#    are interpolated with NumPy, others are evaluated frame by frame.
+#
+
+def getFCurveValues(fcu, frames):
+    kps = fcu.keyframe_points
+    n = len(kps)
+    if n > 0 and not fcu.modifiers and fcu.extrapolation == 'CONSTANT':
+        ipos = np.empty(n, dtype=np.int32)
+        kps.foreach_get("interpolation", ipos)
+        if (ipos[:-1] == Interpolations['LINEAR']).all():
+            co = np.empty(2*n, dtype=np.float32)
+            kps.foreach_get("co", co)
+            return np.interp(frames, co[0::2], co[1::2])
+    return np.array([fcu.evaluate(frame) for frame in frames])
+
+
+#
+#    addBoneKeys(act, bname, channel, frames, values):
+#    Like setBoneKeys, but keeps the existing keys at other frames,
+#    as keyframe_insert does. Existing keys keep their interpolation
+#    and handles, and only new keys are linear.
+#
+
+def addBoneKeys(act, bname, channel, frames, values):
+    from .mcp_kernels.curves import mergeKeyPoints
+    path = 'pose.bones["%s"].%s' % (bname, channel)
+    for index in range(values.shape[1]):
+        fcu = act.fcurves.find(path, index=index)
+        if fcu is None:
+            fcu = act.fcurves.new(path, index=index, action_group=bname)
+            setFCurveKeys(fcu, frames, values[:,index])
+            continue
+        points = mergeKeyPoints(getFCurvePoints(fcu), frames, values[:,index],
+            Interpolations['LINEAR'], HandleTypes['AUTO_CLAMPED'])
+        setFCurvePoints(fcu, points)
+
+#
+#    class KeyBuffer:
+#    Collects the matrices of a pose bone during retargeting, and writes
+#    them as keyframes in one go. The channels are the same as those of
+#    insertRotation and insertLocation. Matrices are converted to channel
+#    values a block at a time, and only the values are kept for the take.
+#
+
+class KeyBuffer:
+    def __init__(self, pb, nFrames, useLocation, blockSize=100):
+        self.pb = pb
+        self.useLocation = useLocation
+        self.path = getRotationPath(pb)
+        self.blockFrames = np.empty(blockSize)
+        self.mats = np.empty((blockSize, 4, 4))
+        self.n = 0
+        self.frames = np.empty(nFrames)
+        self.rots = np.empty((nFrames, RotationSizes[self.path]), dtype=np.float32)
+        if useLocation:
+            self.locs = np.empty((nFrames, 3), dtype=np.float32)
+        else:
+            self.locs = None
+        self.count = 0
+
+
+    def add(self, mat, frame):
+        if self.n == len(self.blockFrames):
+            self.convert()
+        self.blockFrames[self.n] = frame
+        self.mats[self.n] = mat
+        self.n += 1
+
+
+    def addBlock(self, mats, frames):
+        self.convert()
+        self.addValues(np.asarray(frames, dtype=float), *self.getValues(mats))
+
+
+    def convert(self):
+        if self.n > 0:
+            self.addValues(self.blockFrames[:self.n], *self.getValues(self.mats[:self.n]))
+            self.n = 0
+
+
+    def getValues(self, mats):
+        rots = getRotationValues(self.pb, mats)
+        if self.useLocation:
+            return rots, mats[:,:3,3]
+        else:
+            return rots, None
+
+
+    def addValues(self, frames, rots, locs):
+        m = self.count
+        n = len(frames)
+        self.frames[m:m+n] = frames
+        self.rots[m:m+n] = rots
+        if locs is not None:
+            self.locs[m:m+n] = locs
+        self.count += n
+
+
+    def flush(self, act):
+        self.convert()
+        if self.count == 0:
+            return
+        pb = self.pb
+        frames = self.frames[:self.count]
+        addBoneKeys(act, pb.name, self.path, frames, self.rots[:self.count])
+        if self.useLocation:
+            addBoneKeys(act, pb.name, "location", frames, self.locs[:self.count])
+        self.count = 0
+
+
+RotationSizes = {
+    "rotation_quaternion" : 4,
+    "rotation_axis_angle" : 4,
+    "rotation_euler" : 3,
+}
+
+def getRotationPath(pb):
+    if pb.rotation_mode == 'QUATERNION':
+        return "rotation_quaternion"
+    elif pb.rotation_mode == 'AXIS_ANGLE':
+        return "rotation_axis_angle"
+    else:
+        return "rotation_euler"
+
+
+def getRotationValues(pb, mats):
+    from .mcp_kernels.kinematics import normalizeMatrices, matricesToQuaternions, matricesToEulers, matricesToAxisAngles
+    if pb.rotation_mode == 'QUATERNION':
+        return matricesToQuaternions(normalizeMatrices(mats))
+    elif pb.rotation_mode == 'AXIS_ANGLE':
+        return matricesToAxisAngles(mats)
+    else:
+        return matricesToEulers(mats, pb.rotation_mode)
+
+#
+#    class ReducedKeyBuffer:
+#    A KeyBuffer that simplifies the keys while they are collected, so
+#    that only the simplified keys are stored and written. Each block of
+#    channel values is passed to a KeyReducer, with the errors measured
+#    as by the simplifier with joint channels. maxErrRot is in radians.
+#    Axis-angle rotations are kept unsimplified.
+#
+
+class ReducedKeyBuffer(KeyBuffer):
+    def __init__(self, pb, useLocation, maxErrLoc, maxErrRot, blockSize=100):
+        from .mcp_kernels.curves import KeyReducer
+        KeyBuffer.__init__(self, pb, 0, useLocation, blockSize)
+        if self.path == "rotation_axis_angle":
+            self.rotation = KeyReducer(0)
+        elif self.path == "rotation_quaternion":
+            self.rotation = KeyReducer(maxErrRot, self.path)
+        else:
+            self.rotation = KeyReducer(maxErrRot, self.path, pb.rotation_mode)
+        if useLocation:
+            self.location = KeyReducer(maxErrLoc, "location")
+        else:
+            self.location = None
+
+
+    def addValues(self, frames, rots, locs):
+        self.rotation.add(frames, rots)
+        if self.location:
+            self.location.add(frames, locs)
+
+
+    def flush(self, act):
+        self.convert()
+        pb = self.pb
+        frames,values = self.rotation.finish()
+        if len(frames) > 0:
+            addBoneKeys(act, pb.name, self.path, frames, values)
+        if self.location:
+            frames,locs = self.location.finish()
+            if len(frames) > 0:
+                addBoneKeys(act, pb.name, "location", frames, locs)
+
+
+def getNewAction(rig):
+    if rig.animation_data is None:
+        rig.animation_data_create()
+    act = bpy.data.actions.new(rig.name + "Action")
+    rig.animation_data.action = act
+    return act
+
 #
 #    setInterpolation(rig):
 #
@@ -196,12 +471,155 @@ def setInterpolation(rig):
     act = rig.animation_data.action
     if not act:
         return
+    linear = Interpolations['LINEAR']
     for fcu in act.fcurves:
-        for pt in fcu.keyframe_points:
-            pt.interpolation = 'LINEAR'
+        n = len(fcu.keyframe_points)
+        fcu.keyframe_points.foreach_set("interpolation", np.full(n, linear, dtype=np.int32))
         fcu.extrapolation = 'CONSTANT'
     return
 
+#-------------------------------------------------------------
+#   Worker processes
+#
+#   Workers are started with spawn, and may only run functions from
+#   the bpy-free modules in mcp_kernels (motion, kinematics, curves).
+#   This package is loaded as a top-level package, so that the workers
+#   do not import the add-on package, whose __init__ imports bpy. The
+#   add-on folder is only added to sys.path in the workers.
+#-------------------------------------------------------------
+
+def getWorkerCount(scn):
+    nWorkers = scn.McpWorkerCount
+    if nWorkers <= 0:
+        nWorkers = os.cpu_count() or 1
+    return nWorkers
+
+
+def getWorkerModule(name):
+    import importlib
+    if "mcp_kernels" not in sys.modules:
+        import importlib.util
+        folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcp_kernels")
+        spec = importlib.util.spec_from_file_location(
+            "mcp_kernels", os.path.join(folder, "__init__.py"),
+            submodule_search_locations=[folder])
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["mcp_kernels"] = module
+        spec.loader.exec_module(module)
+    return importlib.import_module("mcp_kernels." + name)
+
+
+def getProcessPool(nWorkers):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    ctx = multiprocessing.get_context("spawn")
+    # Blender 2.83 - 2.90: sys.executable is the blender binary
+    python = getattr(bpy.app, "binary_path_python", None) or sys.executable
+    ctx.set_executable(python)
+    import site
+    folder = os.path.dirname(os.path.abspath(__file__))
+    return ProcessPoolExecutor(nWorkers, mp_context=ctx, initializer=site.addsitedir, initargs=(folder,))
+
+#
+#   getSharedPool(nWorkers):
+#   shutdownSharedPool():
+#   A process pool that is left running between calls, so that work
+#   split into many short calls, like retargeting the files of a batch,
+#   does not start new workers each time. It is replaced if the worker
+#   count changed or a worker died, and shut down on unregister.
+#
+
+_SharedPool = None
+_SharedPoolSize = 0
+
+def getSharedPool(nWorkers):
+    global _SharedPool, _SharedPoolSize
+    if _SharedPool is not None:
+        if _SharedPoolSize == nWorkers and not getattr(_SharedPool, "_broken", False):
+            return _SharedPool
+        shutdownSharedPool()
+    _SharedPool = getProcessPool(nWorkers)
+    _SharedPoolSize = nWorkers
+    return _SharedPool
+
+
+def shutdownSharedPool():
+    global _SharedPool
+    if _SharedPool is not None:
+        _SharedPool.shutdown(wait=True)
+        _SharedPool = None
+
+
+def iterPoolResults(scn, func, argslist, nItems=None, shared=False):
+    """iterPoolResults(scn, func, argslist, nItems=None, shared=False)
+
+    Run func(*args) for each args in argslist in worker processes,
+    and yield the results in order. func must be taken from a module
+    returned by getWorkerModule. A result is None if the worker failed,
+    and the caller should then redo that item itself.
+    At most PoolWindow items per worker are submitted ahead of the
+    result that is yielded, to bound the memory of the results that
+    are waiting. argslist may be a generator, and its items are then
+    made while the workers run.
+    nItems is the number of items, if argslist is a generator.
+    With one worker, or one item, nothing is run and only None is yielded.
+    If shared, the pool of getSharedPool is used and left running.
+    """
+    nWorkers = getWorkerCount(scn)
+    if hasattr(argslist, "__len__"):
+        nItems = len(argslist)
+    if nItems is not None:
+        nWorkers = min(nWorkers, nItems)
+    if nWorkers <= 1:
+        for args in argslist:
+            yield None
+        return
+    try:
+        if shared:
+            pool = getSharedPool(getWorkerCount(scn))
+        else:
+            pool = getProcessPool(nWorkers)
+    except (OSError, RuntimeError) as err:
+        print("Could not start worker processes: %s" % err)
+        for args in argslist:
+            yield None
+        return
+    from collections import deque
+    futures = deque()
+    try:
+        for args in argslist:
+            futures.append(submitToPool(pool, func, args))
+            if len(futures) >= PoolWindow*nWorkers:
+                yield getPoolResult(futures.popleft())
+        while futures:
+            yield getPoolResult(futures.popleft())
+    finally:
+        for future in futures:
+            if future:
+                future.cancel()
+        if not shared:
+            pool.shutdown(wait=True)
+
+
+PoolWindow = 2
+
+def submitToPool(pool, func, args):
+    try:
+        return pool.submit(func, *args)
+    except (OSError, RuntimeError) as err:
+        print("Could not start worker processes: %s" % err)
+        return None
+
+
+def getPoolResult(future):
+    if future is None:
+        return None
+    try:
+        return future.result()
+    except Exception as err:
+        print("Worker process failed: %s" % err)
+        return None
+
 #-------------------------------------------------------------
 #   Progress
 #-------------------------------------------------------------
@@ -223,6 +641,20 @@ def showProgress(n, frame, nFrames, step=20):
     wm = bpy.context.window_manager
     wm.progress_update(int(pct))
 
+#
+#   runSteps(steps):
+#   Run a generator that yields after each step of a long operation,
+#   and return its return value. Modal operators call next() on the
+#   same generators, one step per timer event.
+#
+
+def runSteps(steps):
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
 #-------------------------------------------------------------
 #   Error handling
 #-------------------------------------------------------------